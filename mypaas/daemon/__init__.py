@@ -9,3 +9,4 @@ Dependencies: asgineer, psutil
 
 from ._api import main_handler
 from ._statsgen import SystemStatsProducer
+from ._registry import ContainerRegistry
@@ -4,7 +4,15 @@ Entrypoint for the MyPaas daemon.
 
 import asgineer
 
-from mypaas.daemon import main_handler, SystemStatsProducer
+from mypaas.daemon import main_handler, SystemStatsProducer, ContainerRegistry
+from mypaas.server import clear_stale_drain_routes
+
+# Deploys do not survive a restart, so drain routes that are left are stale
+clear_stale_drain_routes()
+
+# Keep track of the Docker containers, for the stats producer
+container_registry = ContainerRegistry()
+container_registry.start()
 
 
 @asgineer.to_asgi
@@ -12,7 +20,7 @@ async def main(request):
     return await main_handler(request)
 
 
-stats_producer = SystemStatsProducer()
+stats_producer = SystemStatsProducer(registry=container_registry)
 stats_producer.start()
 
 
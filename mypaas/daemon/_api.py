@@ -11,8 +11,10 @@ import logging
 import datetime
 import asyncio
 import zipfile
+import tempfile
+import threading
 
-from mypaas.server import get_deploy_generator, get_public_key
+from mypaas.server import get_deploy_generator, get_service_name, get_public_key
 
 
 logger = logging.getLogger("mypaasd")
@@ -23,8 +25,13 @@ os.environ.setdefault("LC_ALL", "C.UTF-8")
 # Keep track of tokens that have been used. These expire after x seconds.
 invalid_tokens = queue.deque()  # contains (timestamp, token) tuples
 
-# Keep track of whether a deploy is in progress.
-deploy_in_progress = False
+# Deploys of the same service are done one at a time, in the order in which
+# they arrive. Deploys of different services run in parallel (the number
+# of simultaneous image builds is limited in get_deploy_generator).
+deploy_queues = {}  # service_name -> list of entries, the first is deploying
+
+# The interval to send something while waiting, to keep the connection alive
+QUEUE_HEARTBEAT_INTERVAL = 5
 
 
 # %% Utilities
@@ -139,7 +146,7 @@ stats server.
 
 
 async def main_handler(request):
-    """Main entry point"""
+    """Main entry point."""
     if request.path.startswith("/daemon/"):
         path = request.path[7:]
     else:
@@ -178,36 +185,127 @@ async def push(request):
 
 async def push_generator(fingerprint, payload):
     """Generator that extracts given zipfile and does the deploy."""
-    global deploy_in_progress
-
-    # Make sure that only one push happens at a given time
-    if deploy_in_progress:
-        yield f"Another deploy is in progress by {deploy_in_progress}. Please wait.\n"
-        while deploy_in_progress:
-            await asyncio.sleep(1)
-            yield "."
-    deploy_in_progress = True  # Really, really make sure we set this back to False!
-
     try:
         logger.warn(f"Deploy invoked by {fingerprint}")  # log
         yield f"Hi! This is the MyPaas server. Let's deploy this!\n"
         yield f"Signature validated with public key (fingerprint {fingerprint}).\n"
 
-        # Extract zipfile
+        # Extract zipfile (in a thread, since it can take a while)
         yield "Extracting ...\n"
-        deploy_dir = os.path.expanduser("~/_mypaas/deploy_cache")
-        shutil.rmtree(deploy_dir, ignore_errors=True)
-        os.makedirs(deploy_dir, exist_ok=True)
+        loop = asyncio.get_event_loop()
+        deploy_dir, service_name = await loop.run_in_executor(
+            None, extract_payload, payload
+        )
+
+        # Wait for our turn, then deploy
+        async for step in queued_deploy_generator(
+            service_name, fingerprint, deploy_dir
+        ):
+            yield step
+
+    except Exception as err:
+        yield "FAIL: " + str(err)
+
+
+def extract_payload(payload):
+    """Extract the given zipfile into a new directory in the deploy cache.
+    Returns the directory and the name of the service in it.
+    """
+    deploy_cache = os.path.expanduser("~/_mypaas/deploy_cache")
+    os.makedirs(deploy_cache, exist_ok=True)
+    deploy_dir = tempfile.mkdtemp(prefix="push-", dir=deploy_cache)
+    try:
         with zipfile.ZipFile(io.BytesIO(payload), "r") as zf:
             zf.extractall(deploy_dir)
+        return deploy_dir, get_service_name(deploy_dir)
+    except Exception:
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        raise
+
+
+async def queued_deploy_generator(service_name, fingerprint, deploy_dir):
+    """Generator that waits until the deploys of this service that are
+    ahead in the queue are done, and then does the deploy.
+
+    The deploy runs in a thread, so that the event loop stays responsive,
+    and its steps (including the build output) are streamed as they come
+    in. The deploy is completed even if the client disconnects; the next
+    deploy of the service waits for it. The deploy dir is removed afterwards.
+    """
+    entry = {"fingerprint": fingerprint, "changed": asyncio.Event()}
+    service_queue = deploy_queues.setdefault(service_name, [])
+    service_queue.append(entry)
+
+    def leave_queue():
+        service_queue.remove(entry)
+        for other_entry in service_queue:
+            other_entry["changed"].set()
+        if not service_queue:
+            deploy_queues.pop(service_name, None)
+
+    started = False
+    try:
+        # Wait until we're at the front of the queue
+        position = 0
+        while service_queue[0] is not entry:
+            if service_queue.index(entry) != position:
+                position = service_queue.index(entry)
+                deploying = service_queue[0]["fingerprint"]
+                yield (
+                    f"Another deploy of {service_name} is in progress by {deploying}. "
+                    f"Position in queue: {position}.\n"
+                )
+            entry["changed"].clear()
+            try:
+                await asyncio.wait_for(
+                    entry["changed"].wait(), QUEUE_HEARTBEAT_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                yield "."
+        if position:
+            yield "\n"
 
         # Deploy
-        await asyncio.sleep(0.1)
-        for step in get_deploy_generator(deploy_dir):
-            yield step + "\n"
-            await asyncio.sleep(0.1)
+        loop = asyncio.get_event_loop()
+        steps = asyncio.Queue()
+        thread = threading.Thread(
+            target=run_deploy,
+            args=(deploy_dir, loop, steps.put_nowait, leave_queue),
+            daemon=True,
+        )
+        thread.start()
+        started = True
+        while True:
+            step = await steps.get()
+            if step is None:
+                break
+            yield step
+
+    finally:
+        if not started:
+            leave_queue()
+            shutil.rmtree(deploy_dir, ignore_errors=True)
+
 
+def run_deploy(deploy_dir, loop, put_step, on_done):
+    """Do the deploy (in a worker thread). The steps are passed to
+    put_step, followed by None, and on_done is called just before that.
+    Both are called in the event loop.
+    """
+
+    def call_in_loop(func, *args):
+        try:
+            loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:  # pragma: no cover
+            pass  # loop is closed
+
+    try:
+        for step in get_deploy_generator(deploy_dir):
+            call_in_loop(put_step, step + "\n")
     except Exception as err:
-        yield "FAIL: " + str(err)
+        logger.warn(f"Deploy failed: {err}")
+        call_in_loop(put_step, "FAIL: " + str(err))
     finally:
-        deploy_in_progress = False
+        shutil.rmtree(deploy_dir, ignore_errors=True)
+        call_in_loop(on_done)
+        call_in_loop(put_step, None)
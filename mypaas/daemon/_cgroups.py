@@ -0,0 +1,160 @@
+"""
+Reading resource usage of containers from the cgroup v2 file system.
+Each Docker container has its own cgroup, which accounts for all the
+processes in the container. Depending on the cgroup driver, its path is
+system.slice/docker-<id>.scope or docker/<id>.
+"""
+
+import os
+import re
+
+from mypaas.utils import dockercall
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CONTAINER_CGROUP_PATTERNS = [
+    ("system.slice", re.compile(r"^docker-([0-9a-f]{64})\.scope$")),  # systemd
+    ("docker", re.compile(r"^([0-9a-f]{64})$")),  # cgroupfs
+]
+
+
+def is_cgroup2(root=CGROUP_ROOT):
+    """Get whether the (unified) cgroup v2 hierarchy is mounted at root."""
+    return os.path.isfile(os.path.join(root, "cgroup.controllers"))
+
+
+def find_container_cgroups(root=CGROUP_ROOT):
+    """Get a dict that maps container id to the path of its cgroup."""
+    cgroups = {}
+    for dirname, pattern in CONTAINER_CGROUP_PATTERNS:
+        try:
+            fnames = os.listdir(os.path.join(root, dirname))
+        except OSError:
+            continue
+        for fname in fnames:
+            m = pattern.match(fname)
+            if m:
+                cgroups[m.group(1)] = os.path.join(root, dirname, fname)
+    return cgroups
+
+
+def get_container_cgroup(id, root=CGROUP_ROOT):
+    """Get the path of the cgroup of the container with the given (full)
+    id, or None if it has none (e.g. because it is not running).
+    """
+    for path in (
+        os.path.join(root, "system.slice", f"docker-{id}.scope"),
+        os.path.join(root, "docker", id),
+    ):
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def get_own_cgroup(root=CGROUP_ROOT):
+    """Get the path of the cgroup of this process, or None."""
+    try:
+        with open("/proc/self/cgroup", "rb") as f:
+            for line in f.read().decode().splitlines():
+                if line.startswith("0::"):
+                    return os.path.join(root, line[3:].strip("/"))
+    except OSError:  # pragma: no cover
+        pass
+    return None
+
+
+def get_container_names(ids):
+    """Get a dict that maps container id to the name of the group to
+    send stats to, for the given (running) containers. The name is taken
+    from the mypaas.container label, or from the MYPAAS_CONTAINER env var
+    for containers that were deployed before that label was set.
+    Containers without either are not MyPaas containers and are omitted.
+    Returns None if Docker could not be queried (e.g. when a container
+    has just stopped), so that the caller can try again later.
+    """
+    names = {}
+    if not ids:
+        return names
+    fmt = '{{.Id}} {{index .Config.Labels "mypaas.container"}}'
+    fmt += " {{range .Config.Env}}{{.}} {{end}}"
+    try:
+        output = dockercall("inspect", "--format", fmt, *ids)
+    except Exception:
+        return None
+    for line in output.splitlines():
+        id, _, rest = line.partition(" ")
+        if id not in ids:
+            continue  # e.g. an error message
+        label, _, env = rest.partition(" ")
+        name = label
+        if not name:
+            for part in env.split():
+                if part.startswith("MYPAAS_CONTAINER="):
+                    name = part.split("=", 1)[1]
+        if name:
+            names[id] = name
+    return names
+
+
+def _read_keyvalues(filename):
+    with open(filename, "rb") as f:
+        text = f.read().decode()
+    result = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(" ")
+        if value.isnumeric():
+            result[key] = int(value)
+    return result
+
+
+def read_cpu_stat(path):
+    """Read cpu.stat, e.g. usage_usec, nr_throttled and throttled_usec."""
+    return _read_keyvalues(os.path.join(path, "cpu.stat"))
+
+
+def has_cpu_limit(path):
+    """Get whether the cgroup has a cpu limit (i.e. can be throttled)."""
+    try:
+        with open(os.path.join(path, "cpu.max"), "rb") as f:
+            return not f.read().decode().startswith("max")
+    except OSError:
+        return False
+
+
+def read_memory(path):
+    """Read the memory usage in bytes, not counting the inactive page cache
+    (like docker stats does), since the kernel can reclaim that.
+    """
+    with open(os.path.join(path, "memory.current"), "rb") as f:
+        current = int(f.read().decode().strip())
+    try:
+        inactive_file = _read_keyvalues(os.path.join(path, "memory.stat")).get(
+            "inactive_file", 0
+        )
+    except OSError:  # pragma: no cover
+        inactive_file = 0
+    return max(0, current - inactive_file)
+
+
+def read_io_stat(path):
+    """Read io.stat, and return the total bytes read and written."""
+    rbytes = wbytes = 0
+    try:
+        with open(os.path.join(path, "io.stat"), "rb") as f:
+            text = f.read().decode()
+    except OSError:
+        return 0, 0
+    for line in text.splitlines():
+        for part in line.split()[1:]:
+            key, _, value = part.partition("=")
+            if key == "rbytes":
+                rbytes += int(value)
+            elif key == "wbytes":
+                wbytes += int(value)
+    return rbytes, wbytes
+
+
+def read_pids(path):
+    """Get the pids of the processes in the cgroup."""
+    with open(os.path.join(path, "cgroup.procs"), "rb") as f:
+        return [int(pid) for pid in f.read().decode().split()]
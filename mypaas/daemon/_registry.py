@@ -0,0 +1,147 @@
+"""
+In-memory registry of the Docker containers, kept up to date by
+subscribing to Docker events.
+"""
+
+import time
+import logging
+import threading
+
+from mypaas.utils import get_docker_client
+
+from ._cgroups import CGROUP_ROOT, get_container_cgroup
+
+
+logger = logging.getLogger("mypaas.daemon")
+
+# The container events that can change what we know about a container.
+# Note that e.g. exec events (which happen on each health check) are ignored.
+CONTAINER_ACTIONS = {
+    "create",
+    "start",
+    "restart",
+    "die",
+    "kill",
+    "oom",
+    "stop",
+    "pause",
+    "unpause",
+    "rename",
+    "update",
+    "destroy",
+}
+
+
+def get_container_info(d, cgroup_root=CGROUP_ROOT):
+    """Get a dict with info on a container, from the dict produced
+    by inspecting it.
+    """
+    config = d.get("Config") or {}
+    state = d.get("State") or {}
+    labels = config.get("Labels") or {}
+    # The name of the group to send stats to
+    mypaas_container = labels.get("mypaas.container", "")
+    for part in config.get("Env") or []:
+        if not mypaas_container and part.startswith("MYPAAS_CONTAINER="):
+            mypaas_container = part.split("=", 1)[1]
+    running = bool(state.get("Running", False))
+    return {
+        "id": d["Id"],
+        "name": d.get("Name", "").lstrip("/"),
+        "labels": labels,
+        "mypaas_container": mypaas_container,
+        "state": state.get("Status", ""),
+        "health": (state.get("Health") or {}).get("Status", ""),
+        "running": running,
+        "pid": state.get("Pid", 0) if running else 0,
+        "started_at": state.get("StartedAt", ""),
+        "cgroup": get_container_cgroup(d["Id"], cgroup_root) if running else None,
+    }
+
+
+class ContainerRegistry(threading.Thread):
+    """Thread that keeps an in-memory view of all Docker containers (their
+    names, labels, state, pid and cgroup), by listing them once, and then
+    following the Docker event stream. Deploys and the stats producer can
+    get the containers from here, without calling Docker.
+
+    If the connection to Docker is lost, the registry is not synced until
+    it has reconnected and listed the containers again.
+    """
+
+    def __init__(self, client=None, cgroup_root=CGROUP_ROOT):
+        super().__init__()
+        self.setDaemon(True)
+        self._stop = False
+        self._client = client or get_docker_client()
+        self._cgroup_root = cgroup_root
+        self._lock = threading.Lock()
+        self._containers = {}  # id -> info
+        self._synced = threading.Event()
+
+    def run(self):
+        while not self._stop:
+            try:
+                self._follow_events()
+            except Exception as err:
+                logger.error("Lost connection to Docker events: " + str(err))
+            self._synced.clear()
+            time.sleep(2)
+
+    def _follow_events(self):
+        # Ask for the events since just before the listing, so we miss none.
+        # Events for containers that we already know are harmless.
+        since = int(time.time()) - 1
+        self._sync_all()
+        filters = {"type": ["container"]}
+        for event in self._client.events(since=since, filters=filters):
+            if self._stop:
+                break
+            self._handle_event(event)
+
+    def _sync_all(self):
+        containers = {}
+        for d in self._client.list_containers(all=True):
+            try:
+                d = self._client.inspect_container(d["Id"])
+            except Exception:
+                continue  # removed in the mean time
+            info = get_container_info(d, self._cgroup_root)
+            containers[info["id"]] = info
+        with self._lock:
+            self._containers = containers
+        self._synced.set()
+
+    def _handle_event(self, event):
+        action = event.get("Action", event.get("status", ""))
+        action = action.split(":")[0]  # e.g. "health_status: healthy"
+        id = (event.get("Actor") or {}).get("ID", "") or event.get("id", "")
+        if not id:
+            return
+        if action == "destroy":
+            with self._lock:
+                self._containers.pop(id, None)
+        elif action in CONTAINER_ACTIONS or action == "health_status":
+            try:
+                d = self._client.inspect_container(id)
+            except Exception:
+                with self._lock:
+                    self._containers.pop(id, None)  # probably removed
+                return
+            info = get_container_info(d, self._cgroup_root)
+            with self._lock:
+                self._containers[info["id"]] = info
+
+    def is_synced(self):
+        """Get whether the registry is in sync with Docker."""
+        return self._synced.is_set()
+
+    def wait_synced(self, timeout=None):
+        """Wait for the registry to be synced. Returns is_synced()."""
+        return self._synced.wait(timeout)
+
+    def get_containers(self, running=True):
+        """Get a list of dicts with info on the (running) containers."""
+        with self._lock:
+            infos = list(self._containers.values())
+        return [info.copy() for info in infos if info["running"] or not running]
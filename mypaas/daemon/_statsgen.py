@@ -1,3 +1,4 @@
+import os
 import json
 import time
 import socket
@@ -6,24 +7,57 @@ import threading
 
 import psutil
 
+from ._cgroups import (
+    CGROUP_ROOT,
+    is_cgroup2,
+    find_container_cgroups,
+    get_own_cgroup,
+    get_container_names,
+    read_cpu_stat,
+    has_cpu_limit,
+    read_memory,
+    read_io_stat,
+    read_pids,
+)
+
 
 logger = logging.getLogger("mypaas.daemon")
 
 stats_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+# Stats are sent as a JSON list of stats dicts, in as few datagrams as
+# possible. This is well below the max UDP payload (on loopback).
+MAX_DATAGRAM_SIZE = 60000
+
 
 class SystemStatsProducer(threading.Thread):
     """Thead that produces measurements on the system and mypaas services,
     and sends these stats to the mypaas stats server.
-    Currently measuring CPU, RAM and disk.
+    Currently measuring CPU, RAM and disk. The stats of each tick are
+    sent together, so the stats server can process them in one batch.
+
+    On hosts with cgroup v2, the services are measured via the cgroups of
+    their containers, which account for all processes in a container,
+    and also provide cpu throttling and disk io. Otherwise, the services
+    are found by scanning the environment of all processes. If a (synced)
+    ContainerRegistry is given, the containers are obtained from it.
     """
 
-    def __init__(self):
+    def __init__(self, cgroup_root=CGROUP_ROOT, registry=None):
         super().__init__()
         self.setDaemon(True)
         self._stop = False
         self._service_processes = {}
         self._create_times = {}
+        self._cgroup_root = cgroup_root
+        self._registry = registry
+        self._use_cgroups = is_cgroup2(cgroup_root)
+        self._cgroup_ids = set()
+        self._container_names = {}  # container id -> name
+        self._service_cgroups = {}  # name -> list of cgroup paths
+        self._cpu_usages = {}  # cgroup path -> (time, usage_usec, throttled_usec)
+        self._io_usages = {}  # cgroup path -> (rbytes, wbytes)
+        self._pending = []
 
     def run(self):
         t = time.time()
@@ -40,6 +74,7 @@ class SystemStatsProducer(threading.Thread):
                     self._do_each_1_seconds()
                 except Exception:  # pragma: no cover
                     pass
+                self._flush()
 
             if t > time10:
                 time10 = t + 10
@@ -47,9 +82,30 @@ class SystemStatsProducer(threading.Thread):
                     self._do_each_10_seconds()
                 except Exception:  # pragma: no cover
                     pass
+                self._flush()
 
     def _send(self, stat):
-        stats_socket.sendto(json.dumps(stat).encode(), ("localhost", 8125))
+        self._pending.append(stat)
+
+    def _flush(self):
+        """Send the pending stats, packed in as few datagrams as possible."""
+        pending, self._pending = self._pending, []
+        parts, size = [], 0
+        for stat in pending:
+            part = json.dumps(stat).encode()
+            if parts and size + len(part) + 1 > MAX_DATAGRAM_SIZE:
+                self._send_datagram(b"[" + b",".join(parts) + b"]")
+                parts, size = [], 1
+            parts.append(part)
+            size += len(part) + 1
+        if parts:
+            self._send_datagram(b"[" + b",".join(parts) + b"]")
+
+    def _send_datagram(self, data):
+        try:
+            stats_socket.sendto(data, ("localhost", 8125))
+        except Exception as err:  # pragma: no cover
+            logger.error("Failed to send stats: " + str(err))
 
     def _do_each_1_seconds(self):
         self._measure_stats_of_system()
@@ -58,6 +114,7 @@ class SystemStatsProducer(threading.Thread):
     def _do_each_10_seconds(self):
         self._measure_system_disk_usage()
         self._collect_services()
+        self._measure_io_of_services()
         self._detect_startups()
 
     def _measure_stats_of_system(self):
@@ -80,6 +137,8 @@ class SystemStatsProducer(threading.Thread):
             logger.error("Failed to send system measurements: " + str(err))
 
     def _measure_stats_of_services(self):
+        if self._use_cgroups:
+            return self._measure_stats_of_service_cgroups()
         for container_name, p in self._service_processes.items():
             try:
                 stat = {
@@ -93,13 +152,80 @@ class SystemStatsProducer(threading.Thread):
                     f"Failed to send {container_name} measurements: " + str(err)
                 )
 
-    def _detect_startups(self):
+    def _measure_stats_of_service_cgroups(self):
+        for container_name, paths in self._service_cgroups.items():
+            try:
+                t = time.time()
+                stat = {"group": container_name}
+                stat["mem|num|iB"] = sum(read_memory(path) for path in paths)
+                # Cpu usage and throttling from the increase since the last time
+                cpu_usecs = throttled_usecs = dt = 0
+                cpu_limit = False
+                for path in paths:
+                    cpu_stat = read_cpu_stat(path)
+                    usage = t, cpu_stat["usage_usec"], cpu_stat.get("throttled_usec", 0)
+                    prev = self._cpu_usages.get(path, None)
+                    self._cpu_usages[path] = usage
+                    if prev is not None and t > prev[0]:
+                        dt = t - prev[0]
+                        cpu_usecs += max(0, usage[1] - prev[1])
+                        throttled_usecs += max(0, usage[2] - prev[2])
+                        cpu_limit = cpu_limit or has_cpu_limit(path)
+                if dt:
+                    stat["cpu|num|%"] = max(0.01, cpu_usecs / (dt * 1e4))
+                    if cpu_limit:
+                        throttled = throttled_usecs / (dt * 1e4)
+                        stat["throttled|num|%"] = min(100, throttled)
+                self._send(stat)
+            except Exception as err:  # pragma: no cover
+                logger.error(
+                    f"Failed to send {container_name} measurements: " + str(err)
+                )
+
+    def _measure_io_of_services(self):
+        for container_name, paths in self._service_cgroups.items():
+            try:
+                rbytes = wbytes = 0
+                has_prev = False
+                for path in paths:
+                    usage = read_io_stat(path)
+                    prev = self._io_usages.get(path, None)
+                    self._io_usages[path] = usage
+                    if prev is not None:
+                        has_prev = True
+                        rbytes += max(0, usage[0] - prev[0])
+                        wbytes += max(0, usage[1] - prev[1])
+                if has_prev:
+                    stat = {
+                        "group": container_name,
+                        "io_read|count|iB": rbytes,
+                        "io_write|count|iB": wbytes,
+                    }
+                    self._send(stat)
+            except Exception as err:  # pragma: no cover
+                logger.error(f"Failed to send {container_name} io: " + str(err))
+
+    def _get_create_times(self):
+        create_times = {}
         for container_name, p in self._service_processes.items():
-            # Get process creation time and our stored creation time
             try:
-                create_time = p.create_time()
+                create_times[container_name] = p.create_time()
             except Exception:
-                continue  # p.create_time may not be available on each OS
+                pass  # p.create_time may not be available on each OS
+        for container_name, paths in self._service_cgroups.items():
+            # The oldest process in the container(s) is the main process
+            try:
+                pids = [pid for path in paths for pid in read_pids(path)]
+                create_times[container_name] = min(
+                    psutil.Process(pid).create_time() for pid in pids
+                )
+            except Exception:
+                pass  # e.g. no processes or a process just ended
+        return create_times
+
+    def _detect_startups(self):
+        for container_name, create_time in self._get_create_times().items():
+            # Get our stored creation time
             ref_create_time = self._create_times.get(container_name, 0)
             # If it's different and uptime is less than a minute, assume its a startup
             # Note that we can get false positives if *this* process restarts within
@@ -117,6 +243,10 @@ class SystemStatsProducer(threading.Thread):
                         )
 
     def _collect_services(self):
+        if self._use_cgroups:
+            return self._collect_service_cgroups()
+        elif self._registry is not None and self._registry.is_synced():
+            return self._collect_service_processes_from_registry()
         try:
             processes = {}
             for p in psutil.process_iter():
@@ -129,3 +259,68 @@ class SystemStatsProducer(threading.Thread):
             self._service_processes = processes
         except Exception as err:  # pragma: no cover
             logger.error("Failed to collect service processes: " + str(err))
+
+    def _collect_service_processes_from_registry(self):
+        try:
+            pids = {}
+            for info in self._registry.get_containers():
+                if info["mypaas_container"] and info["pid"]:
+                    pids[info["mypaas_container"]] = info["pid"]
+            own_name = os.getenv("MYPAAS_CONTAINER", "")
+            if own_name:
+                pids[own_name] = os.getpid()
+            processes = {}
+            for container_name, pid in pids.items():
+                # Reuse Process objects, so that cpu_percent() keeps working
+                p = self._service_processes.get(container_name, None)
+                if p is None or p.pid != pid:
+                    p = psutil.Process(pid)
+                processes[container_name] = p
+            self._service_processes = processes
+        except Exception as err:  # pragma: no cover
+            logger.error("Failed to collect service processes: " + str(err))
+
+    def _get_container_names(self, ids):
+        return get_container_names(ids)
+
+    def _get_service_cgroups(self):
+        """Get a dict that maps service container names to cgroup paths."""
+        service_cgroups = {}
+        if self._registry is not None and self._registry.is_synced():
+            for info in self._registry.get_containers():
+                if info["mypaas_container"] and info["cgroup"]:
+                    # Multiple during a roll deploy
+                    service_cgroups.setdefault(info["mypaas_container"], []).append(
+                        info["cgroup"]
+                    )
+            return service_cgroups
+        cgroups = find_container_cgroups(self._cgroup_root)
+        # Only ask Docker for the names when the containers have changed.
+        # If that fails, the old names are used, and we try again next time.
+        if set(cgroups) != self._cgroup_ids:
+            container_names = self._get_container_names(set(cgroups))
+            if container_names is not None:
+                self._container_names = container_names
+                self._cgroup_ids = set(cgroups)
+        for id, container_name in self._container_names.items():
+            if id in cgroups:
+                service_cgroups.setdefault(container_name, []).append(cgroups[id])
+        return service_cgroups
+
+    def _collect_service_cgroups(self):
+        try:
+            service_cgroups = self._get_service_cgroups()
+            # The daemon itself runs in a cgroup too (as a systemd service)
+            own_name = os.getenv("MYPAAS_CONTAINER", "")
+            own_cgroup = get_own_cgroup(self._cgroup_root)
+            if own_name and own_cgroup and os.path.isdir(own_cgroup):
+                service_cgroups.setdefault(own_name, []).append(own_cgroup)
+            self._service_cgroups = service_cgroups
+            # Forget about cgroups that are gone
+            paths = set(path for paths in service_cgroups.values() for path in paths)
+            for usages in (self._cpu_usages, self._io_usages):
+                for path in list(usages):
+                    if path not in paths:
+                        usages.pop(path)
+        except Exception as err:  # pragma: no cover
+            logger.error("Failed to collect service cgroups: " + str(err))
@@ -9,7 +9,8 @@ Dependencies: asgineer
 
 from ._init import init, restart
 from ._traefik import init_router, restart_router
-from ._deploy import deploy, get_deploy_generator
+from ._deploy import deploy, get_deploy_generator, get_service_name
+from ._drain import clear_stale_drain_routes
 from ._auth import get_public_key
 from ._daemon import restart_daemon
 from ._stats import restart_stats
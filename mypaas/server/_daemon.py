@@ -38,4 +38,4 @@ WantedBy=multi-user.target
 """
 
 # Note: the MYPAAS_CONTAINER is for the deamon's statsgen to
-# discover this process and measure its CPU and ram.
+# discover this process (or its cgroup) and measure its CPU and ram.
@@ -4,16 +4,35 @@ The code to deploy a service specified in a Dockerfile.
 
 import os
 import time
-import json
+import threading
+import http.client
+import datetime
 from urllib.parse import urlparse
 
-from ..utils import dockercall
+from ..utils import get_docker_client
 from ._auth import load_config
+from ._drain import drain_containers, clear_drain_routes, set_drain_routes
 
 
 alphabet = "abcdefghijklmnopqrstuvwxyz"
 identifier_chars = alphabet + alphabet.upper() + "0123456789" + "_"
 
+# Readiness of new containers in a rolling deploy
+READY_POLL_INTERVAL = 0.5
+MIN_UPTIME_WITHOUT_HEALTHCHECK = 5  # seconds
+DEFAULT_DEPLOY_TIMEOUT = 300  # seconds
+
+# Limit the number of image builds that run at the same time. Can be set
+# with max_parallel_builds in the deploy section of the server config.
+DEFAULT_MAX_PARALLEL_BUILDS = 2
+_build_condition = threading.Condition()
+_builds_in_progress = 0
+
+# Deploys of different services run at the same time. Images are only
+# pruned when no other deploy is in progress.
+_deploy_lock = threading.Lock()
+_deploys_in_progress = 0
+
 # Cannot map a volume onto these
 FORBIDDEN_DIRS = ["~/.ssh", "~/_mypaas"]
 for d in list(FORBIDDEN_DIRS):
@@ -42,6 +61,24 @@ def deploy(deploy_dir):
         print(step)
 
 
+def get_service_name(deploy_dir):
+    """Get the (clean) name of the service in the given deploy directory,
+    or an empty string if the Dockerfile does not specify it.
+    """
+    with open(os.path.join(deploy_dir, "Dockerfile"), "rt", encoding="utf-8") as f:
+        dockerfile_text = f.read()
+    for line in dockerfile_text.splitlines():
+        if not line.lstrip().startswith("#"):
+            continue
+        line = line.lstrip("# \t")
+        if line.startswith("mypaas.service"):
+            key, _, val = line.partition("=")
+            val = val.strip("'\" \t\r\n")
+            if key.strip() == "mypaas.service" and val:
+                return clean_name(val, ".-/")
+    return ""
+
+
 def get_deploy_generator(deploy_dir):
     """Get a generator that does the deploy, one step at a time, yielding
     a desciption of each step.
@@ -66,6 +103,10 @@ def get_deploy_generator(deploy_dir):
     maxcpu = None
     maxmem = None
     healthcheck = None
+    maxsurge = 1
+    maxunavailable = 0
+    deploy_timeout = DEFAULT_DEPLOY_TIMEOUT
+    drain_timeout = None
 
     # Read the Dockerfile
     with open(dockerfile, "rt", encoding="utf-8") as f:
@@ -137,6 +178,14 @@ def get_deploy_generator(deploy_dir):
             elif key == "mypaas.maxmem":
                 assert all(c in "0123456789kmgtKMGT" for c in val)
                 maxmem = val
+            elif key == "mypaas.maxsurge":
+                maxsurge = int(val)
+            elif key == "mypaas.maxunavailable":
+                maxunavailable = int(val)
+            elif key == "mypaas.deploytimeout":
+                deploy_timeout = parse_duration(val)
+            elif key == "mypaas.drain":
+                drain_timeout = parse_duration(val)
             else:
                 raise ValueError(f"Invalid mypaas deploy option: {key}")
 
@@ -152,6 +201,10 @@ def get_deploy_generator(deploy_dir):
         raise ValueError(
             "No service name given. Use '# mypaas.service=xxxx' in Dockerfile."
         )
+    if maxsurge < 0 or maxunavailable < 0 or maxsurge + maxunavailable < 1:
+        raise ValueError(
+            "The maxsurge and maxunavailable must be >= 0, and not both zero."
+        )
 
     # Get clean names
     service_name = clean_name(service_name, ".-/")  # suited for an env var
@@ -165,7 +218,7 @@ def get_deploy_generator(deploy_dir):
         cmd.append("--label=" + x)
 
     # Construct command to start the container
-    cmd = ["run", "-d", "--restart=always"]
+    cmd = ["--restart=always"]
 
     # Apply limits
     if maxcpu:
@@ -249,27 +302,82 @@ def get_deploy_generator(deploy_dir):
     cmd.append(f"--env=MYPAAS_SERVICE={service_name}")
     cmd.append(f"--env=MYPAAS_SCALE={scale}")
     cmd.append(f"--env=MYPAAS_PORT={port}")
-    # --env=MYPAAS_CONTAINER is set in the functions below.
+    # --env=MYPAAS_CONTAINER and the mypaas.container label are set below.
+
+    # Old containers can be drained before they are stopped. The routes from
+    # the labels are then temporarily overruled via Traefik's file provider.
+    # Drain routes of this service that are still there are stale (e.g. of
+    # an interrupted deploy), because deploys of a service do not overlap.
+    set_drain_routes(traefik_service_name, "")
+    drain_options = None
+    if drain_timeout is not None:
+        router_labels = {}
+        for arg in cmd:
+            if arg.startswith("--label=traefik.http.routers."):
+                k, _, v = arg.split("=", 1)[1].partition("=")
+                router_labels[k] = v
+        drain_options = {
+            "port": port,
+            "timeout": drain_timeout,
+            "traefik_service_name": traefik_service_name,
+            "labels": router_labels,
+        }
 
     # Deploy!
     if scale and scale > 0:
         if scale_option == "roll":
-            return _deploy_scale_roll(
-                container_infos, deploy_dir, service_name, force_pull, cmd, scale
+            roll_options = {
+                "healthcheck": healthcheck,
+                "port": port,
+                "maxsurge": maxsurge,
+                "maxunavailable": maxunavailable,
+                "timeout": deploy_timeout,
+            }
+            gen = _deploy_scale_roll(
+                container_infos,
+                deploy_dir,
+                service_name,
+                force_pull,
+                cmd,
+                scale,
+                roll_options,
+                drain_options,
             )
         else:
-            return _deploy_scale_safe(
-                container_infos, deploy_dir, service_name, force_pull, cmd, scale
+            gen = _deploy_scale_safe(
+                container_infos,
+                deploy_dir,
+                service_name,
+                force_pull,
+                cmd,
+                scale,
+                drain_options,
             )
     else:
-        return _deploy_no_scale(
-            container_infos, deploy_dir, service_name, force_pull, cmd
+        gen = _deploy_no_scale(
+            container_infos, deploy_dir, service_name, force_pull, cmd, drain_options
         )
+    return _count_deploy(gen)
+
+
+def _count_deploy(gen):
+    """Generator that runs the given deploy generator, while keeping track
+    of the number of deploys in progress.
+    """
+    global _deploys_in_progress
+    with _deploy_lock:  # wait for images being pruned
+        _deploys_in_progress += 1
+    try:
+        yield from gen
+    finally:
+        with _deploy_lock:
+            _deploys_in_progress -= 1
 
 
 def _deploy_no_scale(
-    container_infos, deploy_dir, service_name, force_pull, prepared_cmd
+    container_infos, deploy_dir, service_name, force_pull, prepared_cmd, drain_options
 ):
+    docker = get_docker_client()
     image_name = clean_name(service_name, ".-:/")
     base_container_name = clean_name(image_name, ".-")
     new_name = f"{base_container_name}"
@@ -278,11 +386,7 @@ def _deploy_no_scale(
     yield f"deploying {service_name} to container {new_name}"
     time.sleep(1)
 
-    yield "building image"
-    if force_pull:
-        dockercall("build", "--pull", "-t", image_name, deploy_dir)
-    else:
-        dockercall("build", "-t", image_name, deploy_dir)
+    yield from build_image(docker, deploy_dir, image_name, force_pull)
 
     # There typically is one, but there may be more, if we had failed
     # deploys or if previously deployed with scale > 1
@@ -292,42 +396,52 @@ def _deploy_no_scale(
     yield f"renaming {len(old_ids)} container(s)"
     for i, id in enumerate(old_ids.keys()):
         try:
-            dockercall("rename", id, base_container_name + f".old.{unique}.{i+1}")
+            docker.rename_container(id, base_container_name + f".old.{unique}.{i+1}")
         except Exception:
             yield "Rename failed. Probably a crashed container -> removing!"
-            dockercall("rm", "-f", id, fail_ok=True)
-
-    for id, name in old_ids.items():
-        yield f"stopping container (was {name})"
-        dockercall("stop", id, fail_ok=True)
+            docker.remove_container(id, force=True, fail_ok=True)
 
     try:
+        if drain_options and old_ids:
+            yield from drain_containers(docker, old_ids, [], drain_options)
+        for id, name in old_ids.items():
+            yield f"stopping container (was {name})"
+            docker.stop_container(id, fail_ok=True)
         yield f"starting new container {new_name}"
         cmd = prepared_cmd.copy()
         cmd.append(f"--env=MYPAAS_CONTAINER={new_name}")
+        cmd.append(f"--label=mypaas.container={new_name}")
         cmd.extend([f"--name={new_name}", image_name])
-        dockercall(*cmd)
+        docker.run_container(cmd)
     except Exception:
         yield "fail -> recovering"
-        dockercall("rm", "-f", new_name, fail_ok=True)
+        docker.remove_container(new_name, force=True, fail_ok=True)
         for id, name in old_ids.items():
-            dockercall("rename", id, name, fail_ok=True)
-            dockercall("start", id, fail_ok=True)
+            docker.rename_container(id, name, fail_ok=True)
+            docker.start_container(id, fail_ok=True)
         raise
     else:
         yield f"removing {len(old_ids)} old container(s)"
         for id in old_ids.keys():
-            dockercall("rm", id, fail_ok=True)
+            docker.remove_container(id, fail_ok=True)
+    finally:
+        if drain_options:
+            clear_drain_routes(drain_options)
 
-    yield "pruning"
-    dockercall("container", "prune", "--force")
-    dockercall("image", "prune", "--force")
+    yield from prune_images(docker)
     yield f"done deploying {service_name}"
 
 
 def _deploy_scale_safe(
-    container_infos, deploy_dir, service_name, force_pull, prepared_cmd, scale
+    container_infos,
+    deploy_dir,
+    service_name,
+    force_pull,
+    prepared_cmd,
+    scale,
+    drain_options,
 ):
+    docker = get_docker_client()
     image_name = clean_name(service_name, ".-:/")
     base_container_name = clean_name(image_name, ".-")
 
@@ -335,11 +449,7 @@ def _deploy_scale_safe(
     yield f"deploying {service_name} to containers {base_container_name}.1..{scale}"
     time.sleep(1)
 
-    yield "building image"
-    if force_pull:
-        dockercall("build", "--pull", "-t", image_name, deploy_dir)
-    else:
-        dockercall("build", "-t", image_name, deploy_dir)
+    yield from build_image(docker, deploy_dir, image_name, force_pull)
 
     old_ids = get_id_name_for_this_service(container_infos)
     unique = str(int(time.time()))
@@ -347,62 +457,71 @@ def _deploy_scale_safe(
     yield f"renaming {len(old_ids)} current containers"
     for i, id in enumerate(old_ids.keys()):
         try:
-            dockercall("rename", id, base_container_name + f".old.{unique}.{i+1}")
+            docker.rename_container(id, base_container_name + f".old.{unique}.{i+1}")
         except Exception:
             yield "Rename failed. Probably a crashed container -> removing!"
-            dockercall("rm", "-f", id, fail_ok=True)
-
-    for id, name in old_ids.items():
-        yield f"stopping container (was {name})"
-        dockercall("stop", id, fail_ok=True)
+            docker.remove_container(id, force=True, fail_ok=True)
 
     # Keep track of started containers, in case we must shut them down
     new_pool = []
 
     try:
+        if drain_options and old_ids:
+            yield from drain_containers(docker, old_ids, [], drain_options)
+        for id, name in old_ids.items():
+            yield f"stopping container (was {name})"
+            docker.stop_container(id, fail_ok=True)
         for i in range(scale):
             new_name = f"{base_container_name}.{i+1}"
             yield f"starting new container {new_name}"
             new_pool.append(new_name)
             cmd = prepared_cmd.copy()
             cmd.append(f"--env=MYPAAS_CONTAINER={new_name}")
+            cmd.append(f"--label=mypaas.container={new_name}")
             cmd.extend([f"--name={new_name}", image_name])
-            dockercall(*cmd)
+            docker.run_container(cmd)
     except Exception:
         yield "fail -> recovering"
         for name in new_pool:
-            dockercall("stop", name, fail_ok=True)
-            dockercall("rm", name, fail_ok=True)
+            docker.stop_container(name, fail_ok=True)
+            docker.remove_container(name, fail_ok=True)
         for id, name in old_ids.items():
-            dockercall("rename", id, name, fail_ok=True)
-            dockercall("start", id, fail_ok=True)
+            docker.rename_container(id, name, fail_ok=True)
+            docker.start_container(id, fail_ok=True)
         raise
     else:
         yield f"removing {len(old_ids)} old containers"
         for id in old_ids.keys():
-            dockercall("rm", id, fail_ok=True)
+            docker.remove_container(id, fail_ok=True)
+    finally:
+        if drain_options:
+            clear_drain_routes(drain_options)
 
-    yield "pruning"
-    dockercall("container", "prune", "--force")
-    dockercall("image", "prune", "--force")
+    yield from prune_images(docker)
     yield f"done deploying {service_name}"
 
 
 def _deploy_scale_roll(
-    container_infos, deploy_dir, service_name, force_pull, prepared_cmd, scale
+    container_infos,
+    deploy_dir,
+    service_name,
+    force_pull,
+    prepared_cmd,
+    scale,
+    roll_options,
+    drain_options,
 ):
+    docker = get_docker_client()
     image_name = clean_name(service_name, ".-:/")
     base_container_name = clean_name(image_name, ".-")
+    maxsurge = roll_options["maxsurge"]
+    maxunavailable = roll_options["maxunavailable"]
 
     yield ""
     yield f"rolling deploy of {service_name} to containers {base_container_name}.1..{scale}"
     time.sleep(1)
 
-    yield "building image"
-    if force_pull:
-        dockercall("build", "--pull", "-t", image_name, deploy_dir)
-    else:
-        dockercall("build", "-t", image_name, deploy_dir)
+    yield from build_image(docker, deploy_dir, image_name, force_pull)
 
     old_ids = get_id_name_for_this_service(container_infos)
     unique = str(int(time.time()))
@@ -410,10 +529,10 @@ def _deploy_scale_roll(
     yield f"renaming {len(old_ids)} current containers (and wait 2s)"
     for i, id in enumerate(old_ids.keys()):
         try:
-            dockercall("rename", id, base_container_name + f".old.{unique}.{i+1}")
+            docker.rename_container(id, base_container_name + f".old.{unique}.{i+1}")
         except Exception:
             yield "Rename failed. Probably a crashed container -> removing!"
-            dockercall("rm", "-f", id, fail_ok=True)
+            docker.remove_container(id, force=True, fail_ok=True)
 
     # Give things a bit of time to settle
     time.sleep(2)
@@ -421,55 +540,180 @@ def _deploy_scale_roll(
     # Prepare pools
     old_pool = list(old_ids.keys())  # we pop and stop containers from this pool
     new_pool = []  # we add started containers to this pool
+    ready = set()  # the names of new containers that are ready
 
-    # Determine how long to wait each time before stopping an old container,
-    # based on the assumption that a container boots within 5 seconds.
-    # In essence, we dont want to close the last old container before the first
-    # new container is fully operational.
-    max_time_we_expect_a_container_to_boot = 5
-    pause_per_step = 1 + max_time_we_expect_a_container_to_boot / max(1, len(old_pool))
+    # An old container is only stopped when a new container has become ready
+    # (i.e. healthy) in its place. At most maxsurge containers more than scale
+    # run at any time, and at most maxunavailable less than scale are ready.
+    # The deploy timeout covers the roll (including drains), not the build.
+    deadline = time.time() + roll_options["timeout"]
 
     try:
-        for i in range(scale):
-            # Start up a new container
-            new_name = f"{base_container_name}.{i+1}"
-            yield f"starting new container {new_name} (and wait {pause_per_step:0.1f}s)"
-            new_pool.append(new_name)
-            cmd = prepared_cmd.copy()
-            cmd.append(f"--env=MYPAAS_CONTAINER={new_name}")
-            cmd.extend([f"--name={new_name}", image_name])
-            dockercall(*cmd)
-            # Stop a container from the pool
-            if old_pool:
-                time.sleep(pause_per_step)
+        while True:
+            # Start new containers, as far as the surge allows
+            while len(new_pool) < scale and (
+                len(new_pool) + len(old_pool) < scale + maxsurge
+            ):
+                new_name = f"{base_container_name}.{len(new_pool) + 1}"
+                yield f"starting new container {new_name}"
+                new_pool.append(new_name)
+                cmd = prepared_cmd.copy()
+                cmd.append(f"--env=MYPAAS_CONTAINER={new_name}")
+                cmd.append(f"--label=mypaas.container={new_name}")
+                cmd.extend([f"--name={new_name}", image_name])
+                docker.run_container(cmd)
+            # Stop old containers, as far as availability allows
+            while old_pool and len(ready) + len(old_pool) > scale - maxunavailable:
                 id = old_pool.pop(0)
+                if drain_options:
+                    keep = sorted(ready) + old_pool
+                    drain_ids = {id: old_ids[id]}
+                    yield from drain_containers(docker, drain_ids, keep, drain_options)
                 yield f"stopping old container (was {old_ids[id]})"
-                dockercall("stop", id, fail_ok=True)
-                time.sleep(0.5)  # Again give it time to settle
+                docker.stop_container(id, fail_ok=True)
+            if len(ready) >= scale and not old_pool:
+                break
+            # Wait for the new containers to become ready
+            if time.time() > deadline:
+                raise RuntimeError(
+                    f"Deploy timeout: {len(ready)} of {scale} containers are ready."
+                )
+            time.sleep(READY_POLL_INTERVAL)
+            for name in new_pool:
+                if name not in ready:
+                    readiness = get_container_readiness(docker, name, roll_options)
+                    if readiness == "ready":
+                        yield f"container {name} is ready"
+                        ready.add(name)
+                    elif readiness == "failed":
+                        raise RuntimeError(f"Container {name} failed to start.")
     except Exception:
         yield "fail -> recovering"
         for name in new_pool:
-            dockercall("stop", name, fail_ok=True)
-            dockercall("rm", name, fail_ok=True)
+            docker.stop_container(name, fail_ok=True)
+            docker.remove_container(name, fail_ok=True)
         for id, name in old_ids.items():
-            dockercall("rename", id, name, fail_ok=True)
+            docker.rename_container(id, name, fail_ok=True)
             if id not in old_pool:
-                dockercall("start", id, fail_ok=True)
+                docker.start_container(id, fail_ok=True)
         raise
     else:
-        for id in old_pool:
-            yield f"stopping old container (was {old_ids[id]})"
-            dockercall("stop", id, fail_ok=True)
         yield f"removing {len(old_ids)} old containers"
         for id in old_ids.keys():
-            dockercall("rm", id, fail_ok=True)
+            docker.remove_container(id, fail_ok=True)
+    finally:
+        if drain_options:
+            clear_drain_routes(drain_options)
 
-    yield "pruning"
-    dockercall("container", "prune", "--force")
-    dockercall("image", "prune", "--force")
+    yield from prune_images(docker)
     yield f"done deploying {service_name}"
 
 
+def prune_images(docker):
+    """Generator that removes dangling images (e.g. the previous image of
+    the service), but only if no other deploy is in progress, because the
+    prune could remove the images that another deploy is building. Stopped
+    containers are not pruned; each deploy removes its own old containers.
+    """
+    with _deploy_lock:
+        nother = _deploys_in_progress - 1
+        if nother <= 0:
+            docker.prune_images()
+    if nother > 0:
+        yield f"not pruning images, {nother} other deploy(s) in progress"
+    else:
+        yield "pruned images"
+
+
+def build_image(docker, deploy_dir, image_name, force_pull, max_builds=None):
+    """Generator that builds the image, waiting until fewer than max_builds
+    other builds are in progress (by default taken from the server config).
+    Yields the lines of the build output as they come in.
+    """
+    global _builds_in_progress
+    if max_builds is None:
+        deploy_config = load_config().get("deploy", {})
+        max_builds = deploy_config.get("max_parallel_builds", 0)
+        max_builds = int(max_builds or DEFAULT_MAX_PARALLEL_BUILDS)
+
+    with _build_condition:
+        nbuilds = _builds_in_progress
+    if nbuilds >= max_builds:
+        yield f"waiting for one of {nbuilds} builds in progress to finish"
+    with _build_condition:
+        while _builds_in_progress >= max_builds:
+            _build_condition.wait()
+        _builds_in_progress += 1
+
+    try:
+        yield "building image"
+        for line in docker.iter_build_image(deploy_dir, image_name, force_pull):
+            yield "    " + line
+    finally:
+        with _build_condition:
+            _builds_in_progress -= 1
+            _build_condition.notify()
+
+
+def get_container_readiness(docker, name, roll_options):
+    """Get whether a (new) container is "ready", "starting" or "failed".
+    If the service has a healthcheck, it is used to query the container
+    over the Docker network. Otherwise the container's Docker health status
+    is used if it has one (i.e. a HEALTHCHECK in the Dockerfile). Otherwise
+    it is considered ready when it has been running for a few seconds.
+    """
+    d = docker.inspect_container(name)
+    state = d.get("State") or {}
+    if not state.get("Running", False):
+        return "starting" if state.get("Restarting", False) else "failed"
+    healthcheck = roll_options["healthcheck"]
+    health = (state.get("Health") or {}).get("Status", "")
+    if healthcheck:
+        networks = (d.get("NetworkSettings") or {}).get("Networks") or {}
+        for network in networks.values():
+            if network.get("IPAddress", ""):
+                url = f"http://{network['IPAddress']}:{roll_options['port']}"
+                timeout = parse_duration(healthcheck["timeout"])
+                if check_url(url + healthcheck["path"], timeout):
+                    return "ready"
+        return "starting"
+    elif health:
+        return {"healthy": "ready", "unhealthy": "failed"}.get(health, "starting")
+    else:
+        started = state.get("StartedAt", "")
+        started = started.rpartition(".")[0] or started.rstrip("Z")
+        started = datetime.datetime.strptime(started, "%Y-%m-%dT%H:%M:%S")
+        started = started.replace(tzinfo=datetime.timezone.utc).timestamp()
+        if time.time() - started >= MIN_UPTIME_WITHOUT_HEALTHCHECK:
+            return "ready"
+        return "starting"
+
+
+def check_url(url, timeout):
+    """Get whether a GET request to the given url gives a 2xx or 3xx response."""
+    url = urlparse(url)
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    conn = http.client.HTTPConnection(url.netloc, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        return conn.getresponse().status < 400
+    except Exception:
+        return False
+    finally:
+        conn.close()
+
+
+def parse_duration(val):
+    """Parse a duration like "500ms", "10s", "5m" or "1h" into seconds."""
+    val = val.strip().lower()
+    for unit, factor in (("ms", 0.001), ("s", 1), ("m", 60), ("h", 3600)):
+        if val.endswith(unit):
+            return float(val.rpartition(unit)[0]) * factor
+    return float(val)
+
+
 def get_id_name_for_this_service(container_infos):
     """Get a dict mapping id->name for all containers corresponding to the
     current service.
@@ -483,18 +727,15 @@ def get_id_name_for_this_service(container_infos):
 
 
 def get_containers_info(service_name):
-    """Get a list of dicts with info on each currently running container."""
-    # Get current container ids
-    ids = dockercall("container", "ls", "--format", "{{.ID}}").split()
-    # Get info for each container
+    """Get a list of dicts with info on each currently running container.
+    This asks Docker directly (with a single call), rather than using the
+    daemon's container registry, which is only eventually consistent.
+    """
     container_infos = []
-    for id in ids:
-        name_json = dockercall(
-            "inspect", "--format", "{{.Name}}@{{json .Config.Labels}}", id
-        )
-        name, json_str = name_json.split("@", 1)
+    for d in get_docker_client().list_containers():
+        name = d["Names"][0].lstrip("/") if d.get("Names") else ""
         container_infos.append(
-            {"id": id, "name": name.lstrip("/"), "labels": json.loads(json_str)}
+            {"id": d["Id"], "name": name, "labels": d.get("Labels") or {}}
         )
     # Mark containers that match our service name
     base_container_name = clean_name(service_name, ".-")
@@ -0,0 +1,165 @@
+"""
+Draining of old containers during a deploy. Traefik gets its routes for
+a service from the labels of its containers, and these cannot be changed.
+Therefore, to stop routing requests to the old containers, a file with
+routes is added to the routes directory (watched by Traefik's file
+provider), which take precedence over the routes from the labels, and
+which point only to the containers that stay. Then we wait until the
+connections to the old containers are closed, before stopping them. The
+file is removed at the end of the deploy.
+"""
+
+import os
+import json
+import time
+
+
+ROUTES_DIR = "~/_mypaas/routes"
+DRAIN_PREFIX = "drain-"
+DRAIN_PRIORITY = 100000  # routes from labels have priority len(rule)
+DRAIN_SETTLE_TIME = 2  # the time for Traefik to pick up the new routes
+DRAIN_POLL_INTERVAL = 0.5
+
+
+def get_drain_routes(traefik_service_name, labels, urls):
+    """Get the TOML for the routes of a service (obtained from the labels
+    of its containers), but pointing to the given server urls.
+    """
+    # Collect the properties of each router
+    routers = {}
+    prefix = "traefik.http.routers."
+    for key, val in labels.items():
+        if key.startswith(prefix):
+            router_name, _, prop = key.split(prefix, 1)[1].partition(".")
+            routers.setdefault(router_name, {})[prop] = val
+
+    service = f"{traefik_service_name}-drain"
+    lines = []
+    for router_name, props in sorted(routers.items()):
+        if "rule" not in props:
+            continue
+        section = f"http.routers.{router_name}-drain"
+        lines.append(f"[{section}]")
+        lines.append(f"  rule = {json.dumps(props['rule'])}")
+        lines.append(f"  service = {json.dumps(service)}")
+        lines.append(f"  priority = {DRAIN_PRIORITY}")
+        for prop in ("entrypoints", "middlewares"):
+            if prop in props:
+                values = [v.strip() for v in props[prop].split(",")]
+                lines.append(f"  {prop} = {json.dumps(values)}")
+        tls_props = [prop for prop in sorted(props) if prop.startswith("tls.")]
+        if tls_props:
+            lines.append(f"  [{section}.tls]")
+            for prop in tls_props:
+                lines.append(f"    {prop[4:]} = {json.dumps(props[prop])}")
+    lines.append(f"[http.services.{service}.loadBalancer]")
+    for url in urls:
+        lines.append(f"  [[http.services.{service}.loadBalancer.servers]]")
+        lines.append(f"    url = {json.dumps(url)}")
+    return "\n".join(lines) + "\n"
+
+
+def set_drain_routes(traefik_service_name, toml):
+    """Write the given drain routes for the given service to its own file
+    in the routes directory. The file is replaced atomically, so that
+    Traefik never reads a partial file. If toml is empty, the file is
+    removed.
+    """
+    dirname = os.path.expanduser(ROUTES_DIR)
+    filename = os.path.join(dirname, f"{DRAIN_PREFIX}{traefik_service_name}.toml")
+    if toml:
+        tempname = filename + ".tmp"  # Traefik ignores this extension
+        with open(tempname, "wb") as f:
+            f.write(toml.encode())
+        os.replace(tempname, filename)
+    elif os.path.isfile(filename):
+        os.remove(filename)
+
+
+def clear_stale_drain_routes():
+    """Remove all drain routes files, e.g. of a deploy that was interrupted
+    by a restart. Call this when no deploys are in progress.
+    """
+    dirname = os.path.expanduser(ROUTES_DIR)
+    if os.path.isdir(dirname):
+        for fname in os.listdir(dirname):
+            if fname.startswith(DRAIN_PREFIX):
+                os.remove(os.path.join(dirname, fname))
+
+
+def count_connections(pid, port):
+    """Count the established TCP connections on the given (local) port
+    in the network namespace of the process with the given pid. Traefik
+    does not keep idle connections to the containers open (see the
+    serversTransport in its config), so each connection is a request
+    that is in flight (or a websocket).
+    """
+    count = 0
+    for fname in ("tcp", "tcp6"):
+        try:
+            with open(f"/proc/{pid}/net/{fname}", "rb") as f:
+                lines = f.read().decode().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            parts = line.split()
+            if len(parts) > 3 and parts[3] == "01":  # ESTABLISHED
+                if int(parts[1].rpartition(":")[2], 16) == port:
+                    count += 1
+    return count
+
+
+def get_container_url(docker, id, port):
+    """Get the url at which Traefik can reach the container, or None."""
+    d = docker.inspect_container(id)
+    networks = (d.get("NetworkSettings") or {}).get("Networks") or {}
+    for network in networks.values():
+        if network.get("IPAddress", ""):
+            return f"http://{network['IPAddress']}:{port}"
+    return None
+
+
+def drain_containers(docker, old_ids, keep, drain_options):
+    """Generator that drains the given old containers (a dict id -> name),
+    routing new requests to the containers in keep (ids or names) instead.
+    Waits until the old containers have no active connections, or until the
+    drain timeout. Yields messages for the deploy stream.
+    """
+    port = drain_options["port"]
+    if not os.path.isdir(os.path.expanduser(ROUTES_DIR)):
+        yield "no routes dir for draining, run 'mypaas server init' to create it"
+    elif drain_options["labels"]:
+        urls = [get_container_url(docker, id, port) for id in keep]
+        toml = get_drain_routes(
+            drain_options["traefik_service_name"],
+            drain_options["labels"],
+            [url for url in urls if url],
+        )
+        set_drain_routes(drain_options["traefik_service_name"], toml)
+        time.sleep(DRAIN_SETTLE_TIME)
+
+    pids = {}
+    for id in old_ids:
+        state = docker.inspect_container(id).get("State") or {}
+        if state.get("Running", False):
+            pids[id] = state.get("Pid", 0)
+
+    names = ", ".join(old_ids.values())
+    t0 = time.time()
+    while True:
+        n = sum(count_connections(pid, port) for pid in pids.values())
+        if n == 0:
+            yield f"drained {names} in {time.time() - t0:0.1f}s"
+            break
+        elif time.time() - t0 > drain_options["timeout"]:
+            yield f"drain timeout for {names} ({n} active connections left)"
+            break
+        time.sleep(DRAIN_POLL_INTERVAL)
+
+
+def clear_drain_routes(drain_options):
+    """Remove the drain routes of the service, so that Traefik routes
+    via the labels of the containers again.
+    """
+    if drain_options["labels"]:
+        set_drain_routes(drain_options["traefik_service_name"], "")
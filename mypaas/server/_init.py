@@ -8,7 +8,7 @@ from ._traefik import init_router, restart_router
 from ._stats import restart_stats
 from ._daemon import restart_daemon
 from ._auth import server_key_filename, load_config, save_config
-from ..utils import dockercall
+from ..utils import get_docker_client
 
 
 def init():
@@ -56,7 +56,7 @@ def init():
 
     # Create Docker network
     print("Creating Docker network 'mypaas-net'")
-    dockercall("network", "create", "mypaas-net", fail_ok=True)
+    get_docker_client().create_network("mypaas-net", fail_ok=True)
 
     # Traefik also needs to so some setup
     init_router()
@@ -25,6 +25,10 @@ def restart_stats():
         # Put required files in deploy dir
         shutil.rmtree(deploy_dir, ignore_errors=True)
         shutil.copytree(STATS_LIB_DIR, os.path.join(deploy_dir, "stats"))
+        # Transpile the client code now, so the server does not have to
+        from ..stats.clientjs import write_client_js
+
+        write_client_js(os.path.join(deploy_dir, "stats"))
         with open(os.path.join(deploy_dir, "Dockerfile"), "wb") as f:
             f.write(dockerfile.encode())
         # Deploy
@@ -47,7 +51,7 @@ RUN apt update \
     && apt install -y python3-psutil python3-pip \
     && pip3 --no-cache-dir install pip --upgrade \
     && pip3 --no-cache-dir install uvicorn uvloop httptools \
-    && pip3 --no-cache-dir install asgineer>=0.8 itemdb pscript fastuaparser
+    && pip3 --no-cache-dir install asgineer>=0.8 itemdb pscript fastuaparser brotli
 
 WORKDIR /root
 COPY . .
@@ -1,7 +1,7 @@
 import os
 
 from .. import __traefik_version__
-from ..utils import dockercall
+from ..utils import get_docker_client
 from ._auth import load_config
 
 
@@ -12,32 +12,38 @@ from ._auth import load_config
 
 def restart_router():
     """Restart the Traefik docker container. You can run this after
-    updating the config (~/_mypaas/traefik.toml or staticroutes.toml)
+    updating the config (~/_mypaas/traefik.toml or routes/staticroutes.toml)
     or to update Traefik after updating MyPaas. Your PAAS will be
     offline for a few seconds.
     """
 
     image_name = "traefik:" + __traefik_version__
 
+    docker = get_docker_client()
+
     print(f"Pulling Docker image: {image_name}")
-    dockercall("pull", image_name)
+    docker.pull_image(image_name)
 
     print("Stopping and removing current Traefik container (ignore errors)")
-    dockercall("stop", "traefik", fail_ok=True)
-    dockercall("rm", "traefik", fail_ok=True)
+    docker.stop_container("traefik", fail_ok=True)
+    docker.remove_container("traefik", fail_ok=True)
 
     print("Launching new Traefik container")
-    cmd = ["run", "-d", "--restart=always"]
+    cmd = ["--restart=always"]
     traefik_dir = os.path.expanduser("~/_mypaas")
     cmd.extend(["--network=host", "-p=80:80", "-p=443:443"])
     cmd.append("--volume=/var/run/docker.sock:/var/run/docker.sock")
     cmd.append(f"--volume={traefik_dir}/traefik.toml:/traefik.toml")
     cmd.append(f"--volume={traefik_dir}/acme.json:/acme.json")
-    cmd.append(f"--volume={traefik_dir}/staticroutes.toml:/staticroutes.toml")
+    # Mount a directory for the file provider, because a bind-mounted file
+    # does not see the atomic replacements of the drain routes files
+    os.makedirs(os.path.join(traefik_dir, "routes"), exist_ok=True)
+    cmd.append(f"--volume={traefik_dir}/routes:/routes")
     cmd.append(f"--env=MYPAAS_SERVICE=traefik")
     cmd.append(f"--env=MYPAAS_CONTAINER=traefik")
+    cmd.append("--label=mypaas.container=traefik")
     cmd.extend(["--name=traefik", image_name])
-    dockercall(*cmd)
+    docker.run_container(cmd)
 
 
 def init_router():
@@ -66,11 +72,14 @@ def init_router():
     with open(os.path.join(traefik_dir, "traefik.toml"), "wb") as f:
         f.write(text.encode())
 
-    # Create the file-provider's config
+    # Create the file-provider's config. The routes dir also contains the
+    # routes for draining containers during a deploy.
     print("Writing Traefik static routes")
+    routes_dir = os.path.join(traefik_dir, "routes")
+    os.makedirs(routes_dir, exist_ok=True)
     text = traefik_staticroutes.replace("PAAS_DOMAIN", config["init"]["domain"])
     text = text.replace("WEB_CREDENTIALS", config["init"]["web_credentials"])
-    with open(os.path.join(traefik_dir, "staticroutes.toml"), "wb") as f:
+    with open(os.path.join(routes_dir, "staticroutes.toml"), "wb") as f:
         f.write(text.encode())
 
 
@@ -100,9 +109,15 @@ traefik_config = """
   exposedByDefault = false
   useBindPortIP = false
 [providers.file]
-  filename = "/staticroutes.toml"
+  directory = "/routes"
   watch = true
 
+# Do not keep idle (keep-alive) connections to the containers, so that
+# the open connections of a container are the requests it is handling.
+# This is what MyPaas waits for when draining a container during a deploy.
+[serversTransport]
+  maxIdleConnsPerHost = -1
+
 # Enable dashboard
 [api]
   dashboard = true
@@ -1,9 +1,9 @@
 """
 The mypaas.stats subpackage represents a service to collect and view
 all sorts of stats of your PaaS. All services can push measurements
-over UDP.
+over UDP, or in batches via an HTTP POST from the internal network.
 
-Dependencies: fastuaparser, asgineer, pscript,
+Dependencies: fastuaparser, asgineer, pscript, brotli (optional)
 """
 
 # flake8: noqa
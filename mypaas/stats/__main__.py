@@ -14,18 +14,22 @@ except ImportError:
     from mypaas.stats import stats_handler
 
 
-# Create a stats collector
+# Create a stats collector. Monitors of groups that don't receive data are
+# evicted after MYPAAS_STATS_IDLE_TIMEOUT seconds.
 db_dir = os.path.expanduser("~/_stats")
-collector = StatsCollector(db_dir)
+idle_timeout = float(os.environ.get("MYPAAS_STATS_IDLE_TIMEOUT", "") or 3600)
+collector = StatsCollector(db_dir, idle_timeout)
 
-# Start a thread that receives stats via udp and puts it into the collector
-udp_stats_receiver = UdpStatsReceiver(collector)
+# Start a thread that receives stats via udp and puts it into the collector.
+# Set MYPAAS_STATS_CAPTURE to a filename to capture the raw datagrams.
+capture = os.environ.get("MYPAAS_STATS_CAPTURE", "")
+udp_stats_receiver = UdpStatsReceiver(collector, capture=capture)
 udp_stats_receiver.start()
 
 
 @asgineer.to_asgi
 async def main_handler(request):
-    return await stats_handler(request, collector)
+    return await stats_handler(request, collector, udp_stats_receiver)
 
 
 if __name__ == "__main__":
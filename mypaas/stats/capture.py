@@ -0,0 +1,91 @@
+"""
+Capturing of raw datagrams, so that production ingest load can be
+reproduced with the replay script.
+
+The capture file is a sequence of records, each consisting of a
+header (a float64 timestamp and a uint32 size, little endian),
+followed by the raw datagram bytes.
+"""
+
+import os
+import struct
+
+
+HEADER = struct.Struct("<dI")
+DEFAULT_MAX_BYTES = 64 * 2**20  # 64 MiB
+
+
+class DatagramWriter:
+    """Object that writes timestamped datagrams to a file, rotating the
+    file when it becomes larger than max_bytes. Up to backup_count
+    older files are kept, with suffixes ".1", ".2", etc. Each datagram
+    is flushed to the file right away, so that a live capture file is
+    complete, and nothing is lost on a crash.
+    """
+
+    def __init__(self, filename, max_bytes=DEFAULT_MAX_BYTES, backup_count=3):
+        self._filename = filename
+        self._max_bytes = int(max_bytes)
+        self._backup_count = int(backup_count)
+        dirname = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(dirname, exist_ok=True)
+        self._f = open(filename, "ab")
+
+    @property
+    def filename(self):
+        """The filename of the current capture file."""
+        return self._filename
+
+    def write(self, t, data):
+        """Write a datagram (bytes) that was received at time t."""
+        self._f.write(HEADER.pack(t, len(data)))
+        self._f.write(data)
+        self._f.flush()
+        if self._f.tell() >= self._max_bytes:
+            self._rotate()
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def _rotate(self):
+        self._f.close()
+        for i in range(self._backup_count - 1, 0, -1):
+            src = f"{self._filename}.{i}"
+            if os.path.isfile(src):
+                os.replace(src, f"{self._filename}.{i+1}")
+        if self._backup_count > 0:
+            os.replace(self._filename, self._filename + ".1")
+        else:
+            os.remove(self._filename)
+        self._f = open(self._filename, "ab")
+
+
+def get_capture_filenames(filename):
+    """Get the filenames of a capture, i.e. the existing rotated backups
+    (oldest first), followed by the given (current) capture file.
+    """
+    backups = []
+    i = 1
+    while os.path.isfile(f"{filename}.{i}"):
+        backups.insert(0, f"{filename}.{i}")
+        i += 1
+    return backups + [filename]
+
+
+def read_datagrams(filename):
+    """Generator that yields (timestamp, data) tuples from a capture file.
+    A truncated record at the end (e.g. from a crash) is ignored.
+    """
+    with open(filename, "rb") as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            t, n = HEADER.unpack(header)
+            data = f.read(n)
+            if len(data) < n:
+                break
+            yield t, data
@@ -2,11 +2,22 @@
 Python code that will be transpiled to JS to implement the client side.
 """
 
-from pscript.stubs import window, document, undefined, Math, Date  # JS
-from pscript.stubs import data_per_db, text_color  # are made available
+from pscript.stubs import window, document, undefined, Math, Date, JSON  # JS
+from pscript.stubs import Array, DataView, Float64Array, Uint8Array, Uint32Array  # JS
+from pscript.stubs import TextDecoder  # JS
+from pscript.stubs import EventSource, IntersectionObserver, Path2D  # JS
+from pscript.stubs import Worker, globalThis  # JS
+from pscript.stubs import keys_per_db, current_per_db, text_color  # are made available
 
 
 panels = []
+observer = None
+live_was_lost = False
+resize_timer = None
+draw_scheduled = False
+worker = None
+worker_callbacks = {}
+worker_count = 0
 
 
 # %% Button callbacks
@@ -88,7 +99,7 @@ def refresh(self, query_info=None, hash_info=None):
         )
 
     if url == window.location.href:
-        window.location.reload()
+        fetch_delta()  # only get what changed, instead of reloading
     else:
         window.location.href = url
     return undefined
@@ -105,7 +116,13 @@ def panel_sort_func(x):
 
 
 def on_init():
-    for dbname, data in data_per_db.items():
+    global observer
+    # Panels load their data when they scroll into view (if supported)
+    if window.IntersectionObserver:
+        observer = IntersectionObserver(on_intersection, {"rootMargin": "200px"})
+    start_worker()
+
+    for dbname, keys in keys_per_db.items():
         # Create panel container (and a title)
         title_el = document.createElement("div")
         container_el = document.createElement("div")
@@ -120,9 +137,11 @@ def on_init():
 
         # Collect panel types
         panel_kinds = {}
-        for i in range(len(data)):
-            aggr = data[i]
-            for key in aggr.keys():
+        for key in keys:
+            panel_kinds[key] = True
+        current = current_per_db.get(dbname, {})
+        for key in current.keys():
+            if "|" in key:
                 panel_kinds[key] = True
 
         # Sort the panel types - count, dcount, num, cat
@@ -166,12 +185,462 @@ def on_init():
             # Create panel
             panel = Cls(container_el, dbname, key, title, unit)
             panels.append(panel)
+            if observer:
+                observer.observe(panel.node)
+            else:
+                panel.load()
+
+    # Keep the current aggregations up-to-date if we show today
+    if window.daysago == 0 and window.EventSource:
+        groups = ",".join(keys_per_db.keys())
+        source = EventSource("/statstream?groups=" + window.encodeURIComponent(groups))
+        source.addEventListener("aggr", on_live_event)
+        # If the connection was lost, get what we missed when it's back
+        source.addEventListener("error", on_live_error)
+        source.addEventListener("open", on_live_open)
 
     on_hash_change()  # calls on_resize()
 
 
+# %% Web Worker
+
+
+def start_worker():
+    """Start a Web Worker to fetch, decode and prepare the data for the
+    panels, so the main thread only has to draw. The worker runs this same
+    script (see the bottom), so there is nothing extra to load.
+    """
+    global worker
+    if window.Worker:
+        worker = Worker("client.js")
+        worker.addEventListener("message", on_worker_result)
+
+
+def load_in_worker(url, key, callback):
+    global worker_count
+    worker_count += 1
+    worker_callbacks[worker_count] = callback
+    worker.postMessage({"id": worker_count, "url": url, "key": key})
+
+
+def on_worker_result(e):
+    msg = e.data
+    callback = worker_callbacks.pop(msg.id)
+    callback(msg.data)
+
+
+def on_worker_message(e):
+    """Handle a request in the worker: fetch the data, decode it, and
+    prepare it. The buffer of the typed arrays is transferred back.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    msg = e.data
+
+    def on_data(data):
+        transfer = []
+        if data.arrays:
+            data.prepared = prepare_data(data, msg.key)
+            if data.buffer:
+                transfer.push(data.buffer)
+        globalThis.postMessage({"id": msg.id, "data": data}, transfer)
+
+    def on_error(err):
+        globalThis.postMessage({"id": msg.id, "data": None})
+
+    globalThis.fetch(msg.url).then(parse_response).then(on_data).catch(on_error)
+
+
+def parse_response(r):
+    PSCRIPT_OVERLOAD = False  # noqa
+    if r.headers.get("content-type") == "application/octet-stream":
+        return r.arrayBuffer().then(decode_columns)
+    return r.json()
+
+
+# %% Live updates
+
+
+def copy_aggr(aggr):
+    return JSON.parse(JSON.stringify(aggr))
+
+
+def merge_aggr(aggr1, aggr2):
+    """Merge aggr2 into aggr1, like merge() in monitor.py."""
+    PSCRIPT_OVERLOAD = False  # noqa
+    aggr1.time_start = min(aggr1.time_start, aggr2.time_start)
+    aggr1.time_stop = max(aggr1.time_stop, aggr2.time_stop)
+    for key, val2 in aggr2.items():
+        if "|" not in key:
+            continue
+        type = key.split("|")[1]
+        if type == "count" or type == "dcount" or type == "mcount":
+            aggr1[key] = (aggr1[key] or 0) + val2
+        elif type == "cat":
+            d1 = aggr1[key]
+            if d1 is undefined:
+                aggr1[key] = d1 = {}
+            for k, c in val2.items():
+                d1[k] = (d1[k] or 0) + c
+        elif type == "num":
+            d1 = aggr1[key]
+            if d1 is undefined:
+                aggr1[key] = copy_aggr(val2)
+            elif val2.n > 0:
+                d1.min = min(d1.min, val2.min)
+                d1.max = max(d1.max, val2.max)
+                n = d1.n + val2.n
+                mean = (d1.mean * d1.n + val2.mean * val2.n) / n
+                delta = val2.mean - d1.mean
+                d1.magic = d1.magic + val2.magic + (delta * d1.n) * (delta * val2.n) / n
+                d1.n = n
+                d1.mean = mean
+    return aggr1
+
+
+def on_intersection(entries):
+    for entry in entries:
+        panel = entry.target.panel
+        panel.set_visible(entry.isIntersecting)
+        if entry.isIntersecting:
+            panel.load()
+
+
+def schedule_draw():
+    """Draw the (visible) panels that need it, in the next animation frame.
+    Multiple updates in the same frame thus result in a single draw.
+    """
+    global draw_scheduled
+    if not draw_scheduled:
+        draw_scheduled = True
+        window.requestAnimationFrame(_draw_dirty_panels)
+
+
+def _draw_dirty_panels():
+    global draw_scheduled
+    draw_scheduled = False
+    for panel in panels:
+        if panel.dirty and panel.visible:
+            panel.draw()
+
+
+def on_live_event(e):
+    msg = JSON.parse(e.data)
+    current_per_db[msg.group] = msg.aggr
+    for panel in panels:
+        if panel.dbname == msg.group and panel.data is not None:
+            panel.merge_live(msg.aggr)
+            panel.update()
+
+
+def on_live_error(e):
+    global live_was_lost
+    live_was_lost = True
+
+
+def on_live_open(e):
+    global live_was_lost
+    if live_was_lost:
+        live_was_lost = False
+        fetch_delta()
+
+
+def fetch_delta():
+    """Get the blocks that are new or changed since the last block of each
+    loaded panel, and merge them in. Panels with the same resolution share
+    a request, asking for the blocks since the oldest last block per group.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    since_per_resolution = {}
+    for panel in panels:
+        if panel.data is None or panel.loading:
+            continue
+        resolution = panel.data.resolution
+        if not resolution:
+            panel.apply_delta("", [])  # not a series, e.g. a summary
+            continue
+        n = len(panel.data.time_start)
+        time_key = get_bucket_key(panel.data, n - 1) if n > 0 else ""
+        since = since_per_resolution.setdefault(resolution, {})
+        if since.get(panel.dbname, time_key) >= time_key:
+            since[panel.dbname] = time_key
+    for resolution, since in since_per_resolution.items():
+        _fetch_delta(resolution, since)
+
+
+def _fetch_delta(resolution, since):
+    PSCRIPT_OVERLOAD = False  # noqa
+    resolution = int(resolution)  # object keys are strings
+    groups = since.keys()
+    url = "/api/delta?resolution=" + resolution
+    url += "&groups=" + window.encodeURIComponent(",".join(groups))
+    url += "&since=" + window.encodeURIComponent(",".join([since[g] for g in groups]))
+    url += "&ndays=" + window.ndays + "&daysago=" + window.daysago
+    if window.daysago == 0:
+        url += "&current=0"  # we merge the current aggr ourselves
+
+    def on_delta(result):
+        for panel in panels:
+            if panel.data is None or panel.data.resolution != resolution:
+                continue
+            aggrs = result[panel.dbname]
+            if since[panel.dbname] is not undefined and aggrs is not undefined:
+                panel.apply_delta(since[panel.dbname], aggrs)
+                panel.update()
+
+    window.fetch(url).then(lambda r: r.json()).then(on_delta)
+
+
+def on_live_aggr(panel, aggr):
+    """Merge the current (live) aggregation into the data (columns) of
+    a panel. The live block is either merged with the last block, or it
+    becomes a new block.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    data = panel.data
+    key = panel.key
+    if data is None or aggr[key] is undefined:
+        return
+    state = panel.live_state
+    if state is None:
+        state = panel.live_state = {"index": -1, "base": None, "key": ""}
+
+    # Only use the key of this panel
+    aggr = {
+        "time_key": aggr.time_key,
+        "time_start": aggr.time_start,
+        "time_stop": aggr.time_stop,
+        key: aggr[key],
+    }
+
+    # If the previous live block has ended, it's now part of the base
+    if state.index >= 0 and state.key != aggr.time_key:
+        state.base = get_block(data, key, state.index)
+
+    state.key = aggr.time_key
+
+    # Select the block to merge into, i.e. the block in the same bucket
+    n = len(data.time_start)
+    res = data.resolution
+    t = aggr.time_start
+    if state.index >= 0 and is_same_bucket(data.time_start[state.index], t, res):
+        pass
+    elif n > 0 and is_same_bucket(data.time_start[n - 1], t, res):
+        state.index = n - 1
+        state.base = get_block(data, key, n - 1)
+    else:
+        state.index = n
+        state.base = None
+        append_block(data)
+
+    # Merge and update the time range
+    if state.base is None:
+        block = copy_aggr(aggr)
+    else:
+        block = merge_aggr(copy_aggr(state.base), aggr)
+    set_block(data, key, state.index, block)
+    if data.t1 == 0:
+        data.t1 = aggr.time_start
+    data.t2 = max(data.t2, aggr.time_stop)
+
+
+def is_same_bucket(t1, t2, resolution):
+    """Get whether two times are in the same bucket, like get_bucket()
+    in collector.py. Resolutions larger than a day mean calendar months.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    if resolution > 86400:
+        d1, d2 = Date(t1 * 1000), Date(t2 * 1000)
+        return (
+            d1.getUTCFullYear() == d2.getUTCFullYear()
+            and d1.getUTCMonth() == d2.getUTCMonth()
+        )
+    return Math.floor(t1 / resolution) == Math.floor(t2 / resolution)
+
+
+def get_time_key(t):
+    """Get the time key (yyyy-mm-dd HH:MM:SS in UTC) for the given time,
+    like the time_key of an aggregation in monitor.py.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    iso = Date(t * 1000).toISOString()
+    return iso[:10] + " " + iso[11:19]
+
+
+def get_bucket_key(data, i):
+    """Get the time key of the start of the bucket of block i, like
+    get_bucket() in collector.py. The time_key of the block (as stored on
+    the server) is in the same bucket, and not smaller.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    t = data.time_start[i]
+    resolution = data.resolution
+    if resolution > 86400:
+        d = Date(t * 1000)
+        d.setUTCDate(1)
+        d.setUTCHours(0, 0, 0, 0)
+        return get_time_key(d.getTime() / 1000)
+    elif resolution > 0:
+        return get_time_key(Math.floor(t / resolution) * resolution)
+    return get_time_key(t)
+
+
+# %% Columnar data
+
+
+def get_fields(key):
+    """Get the names of the fields for the given key, like in columns.py."""
+    type = key.split("|")[1]
+    if type == "num":
+        return ["min", "max", "n", "mean", "magic"]
+    elif type == "cat":
+        return ["cat"]
+    else:
+        return ["count"]
+
+
+def decode_columns(buffer):
+    """Decode binary columns (see columns.py). The numeric fields become
+    typed arrays that map directly onto the received buffer.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    view = DataView(buffer)
+    nheader = view.getUint32(0, True)
+    header = TextDecoder().decode(Uint8Array(buffer, 4, nheader))
+    columns = JSON.parse(header)
+    offset = 4 + nheader
+    offset += (8 - offset % 8) % 8
+    for name in columns.arrays:
+        if columns.int_arrays.indexOf(name) >= 0:
+            columns[name] = Uint32Array(buffer, offset, columns.n)
+            offset += 4 * columns.n
+        else:
+            columns[name] = Float64Array(buffer, offset, columns.n)
+            offset += 8 * columns.n
+    columns.buffer = buffer
+    return columns
+
+
+def prepare_data(data, key):
+    """Prepare columnar data for drawing: get the range of the values,
+    and for dcount and mcount, the counts per day or month. This is done
+    in the worker when the data is loaded, and again (on the main thread)
+    when the data changes.
+    """
+    PSCRIPT_OVERLOAD = False  # noqa
+    key_parts = key.split("|")
+    type = key_parts[1]
+    if type == "num":
+        return {"minmax": get_num_range(data, key_parts[2] or ""), "grouped": None}
+    grouped = None
+    counts = data.count
+    if type == "dcount" or type == "mcount":
+        grouped = group_counts(data, 10 if type == "dcount" else 7)
+        counts = grouped.count
+    ma = -9_999_999
+    for i in range(len(counts)):
+        ma = max(ma, counts[i])
+    return {"minmax": [0, ma], "grouped": grouped}
+
+
+def get_num_range(data, unit):
+    PSCRIPT_OVERLOAD = False  # noqa
+    mi = +1e20
+    ma = -1e20
+    for i in range(len(data.n)):
+        if data.n[i] == 0:
+            continue
+        mi = min(mi, data.min[i])
+        ma = max(ma, data.max[i])
+    if ma >= mi:
+        mi = min(0.8 * ma, mi)  # Select a good min point
+        mi = 0
+    if unit == "%":
+        mi = 0
+        ma = max(ma, 100)  # percentages can be larger than 100
+    return [mi, ma]
+
+
+def group_counts(data, nchars):
+    """Group the counts per day (or month), also in columns."""
+    PSCRIPT_OVERLOAD = False  # noqa
+    grouped = {"time_start": [], "time_stop": [], "count": []}
+    prev_key = ""
+    for i in range(len(data.count)):
+        key = get_time_key(data.time_start[i])[:nchars]
+        if key != prev_key:
+            grouped.time_start.push(data.time_start[i])
+            grouped.time_stop.push(data.time_stop[i])
+            grouped.count.push(data.count[i])
+            prev_key = key
+        else:
+            grouped.count[-1] += data.count[i]
+            grouped.time_stop[-1] = data.time_stop[i]
+    return grouped
+
+
+def get_block(data, key, i):
+    """Get the aggregation dict at index i from columnar data."""
+    PSCRIPT_OVERLOAD = False  # noqa
+    block = {
+        "time_start": data.time_start[i],
+        "time_stop": data.time_stop[i],
+    }
+    fields = get_fields(key)
+    if len(fields) == 1:
+        value = data[fields[0]][i]
+        block[key] = copy_aggr(value) if fields[0] == "cat" else value
+    else:
+        block[key] = value = {}
+        for field in fields:
+            value[field] = data[field][i]
+    return block
+
+
+def set_block(data, key, i, block):
+    """Set the aggregation dict at index i in columnar data."""
+    PSCRIPT_OVERLOAD = False  # noqa
+    data.prepared = None
+    data.time_start[i] = block.time_start
+    data.time_stop[i] = block.time_stop
+    fields = get_fields(key)
+    if len(fields) == 1:
+        data[fields[0]][i] = block[key]
+    else:
+        for field in fields:
+            data[field][i] = block[key][field]
+
+
+def truncate_blocks(data, n):
+    """Remove all but the first n blocks from columnar data."""
+    PSCRIPT_OVERLOAD = False  # noqa
+    data.prepared = None
+    names = ["cat"].concat(data.arrays)
+    for name in names:
+        if data[name] is not undefined:
+            data[name] = data[name].slice(0, n)
+
+
+def append_block(data):
+    """Make room for one more block in columnar data."""
+    PSCRIPT_OVERLOAD = False  # noqa
+    names = data.arrays.concat(["cat"])
+    for name in names:
+        arr = data[name]
+        if arr is undefined:
+            continue
+        elif Array.isArray(arr):
+            arr.push(None)
+        else:
+            new_arr = Float64Array(len(arr) + 1)
+            new_arr.set(arr)
+            data[name] = new_arr
+
+
 def on_resize():
-    window.setTimeout(_on_resize, 1)
+    # Debounce, so we don't resize all panels for each resize event
+    global resize_timer
+    window.clearTimeout(resize_timer)
+    resize_timer = window.setTimeout(_on_resize, 100)
 
 
 def get_query_info():
@@ -224,27 +693,24 @@ def on_hash_change():
         containers[i].style.gridAutoRows = grid_auto_rows
         containers[i].style.gridTemplateColumns = grid_template_columns
 
+    # The ticks depend on the hash info too (utc)
+    for panel in panels:
+        if panel.canvas:
+            panel.invalidate_layout()
+
     on_resize()
 
 
 def _on_resize():
+    # First measure all panels, then resize them, to avoid layout thrashing
+    sizes = []
     for panel in panels:
         if panel.canvas:
-            # Get dimensions
             w = panel.node.clientWidth - 10
             h = panel.node.clientHeight - 35
-            pixel_ratio = get_pixel_ratio(panel.canvas.getContext("2d"))
-            # Set dimensions
-            panel.canvas.style.width = w + "px"
-            panel.canvas.style.height = h + "px"
-            panel.canvas.width = w * pixel_ratio
-            panel.canvas.height = h * pixel_ratio
-            # Set some info on the object
-            panel.pixel_ratio = pixel_ratio
-            panel.width = w
-            panel.height = h
-        if panel.draw:
-            panel.draw()
+            sizes.append((panel, w, h))
+    for panel, w, h in sizes:
+        panel.resize(w, h)
 
 
 def get_pixel_ratio(ctx):
@@ -284,14 +750,22 @@ _tick_units = _create_tick_units()
 
 
 class BasePanel:
+    _downsample = ""
+
     def __init__(self, container, dbname, key, title, unit):
         self.dbname = dbname
         self.key = key
         self.title = title
         self.unit = unit
+        self.data = None  # set when loaded
+        self.loading = False
+        self.live_state = None
+        self.visible = observer is None  # else set by on_intersection()
+        self.dirty = False
 
         self.node = document.createElement("div")
         self.node.classList.add("panel")
+        self.node.panel = self
         container.appendChild(self.node)
 
         self.titlenode = document.createElement("div")
@@ -299,8 +773,76 @@ class BasePanel:
         self.titlenode.innerText = title
         self.node.appendChild(self.titlenode)
 
-
-class InfoPanel(BasePanel):
+    def load(self):
+        """Load the data for this panel from the server (once)."""
+        if self.data is not None or self.loading:
+            return
+        self.loading = True
+        self.node.classList.add("loading")
+        url = self._get_url()
+        url += "&group=" + window.encodeURIComponent(self.dbname)
+        url += "&key=" + window.encodeURIComponent(self.key)
+        url += "&ndays=" + window.ndays + "&daysago=" + window.daysago
+        if window.daysago == 0:
+            url += "&current=0"  # we merge the current aggr ourselves
+        if worker:
+            load_in_worker(url, self.key, self._on_data)
+        else:
+            window.fetch(url).then(parse_response).then(self._on_data)
+
+    def _get_url(self):
+        url = "/api/data?max_points=" + max(10, int(self.node.clientWidth / 4))
+        url += "&format=binary"
+        if self._downsample:
+            url += "&downsample=" + self._downsample
+        return url
+
+    def _on_data(self, data):
+        self.loading = False
+        self.node.classList.remove("loading")
+        if not data:
+            return  # failed, we may try again later
+        self.data = data
+        aggr = current_per_db[self.dbname]
+        if aggr:
+            self.merge_live(aggr)
+        self.update()
+
+    def merge_live(self, aggr):
+        """Merge the current (live) aggregation into the data."""
+        on_live_aggr(self, aggr)
+
+    def apply_delta(self, since, aggrs):
+        """Replace the blocks from the one with time_key since onwards
+        with the given (new or changed) aggregations from /api/delta.
+        """
+        PSCRIPT_OVERLOAD = False  # noqa
+        data = self.data
+        key = self.key
+        i = len(data.time_start)
+        while i > 0 and get_bucket_key(data, i - 1) >= since:
+            i -= 1
+        truncate_blocks(data, i)
+        for aggr in aggrs:
+            if aggr[key] is not undefined:
+                append_block(data)
+                set_block(data, key, len(data.time_start) - 1, aggr)
+                data.t2 = max(data.t2, aggr.time_stop)
+        # The current aggregation is merged anew
+        self.live_state = None
+        aggr = current_per_db[self.dbname]
+        if aggr:
+            self.merge_live(aggr)
+
+    def set_visible(self, visible):
+        self.visible = visible
+
+    def update(self):
+        """Update the panel to show the (changed) data."""
+        pass
+
+
+class TablePanel(BasePanel):
     def __init__(self, *args):
         super().__init__(*args)
         self.content = document.createElement("div")
@@ -313,6 +855,17 @@ class InfoPanel(BasePanel):
 
         self._create()
 
+    def update(self):
+        self._create()
+
+    def _create(self):
+        pass
+
+
+class InfoPanel(TablePanel):
+    def load(self):
+        pass  # the info is included in the page
+
     def _create(self):
         PSCRIPT_OVERLOAD = False  # noqa
         if not window.info:
@@ -325,22 +878,47 @@ class InfoPanel(BasePanel):
         self.content.innerHTML = "\n".join(lines)
 
 
-class CategoricalPanel(InfoPanel):
+class CategoricalPanel(TablePanel):
+    def _get_url(self):
+        return "/api/cat?"  # the server sums the counts, we get the top-N
+
+    def merge_live(self, aggr):
+        # The live counts are shown on top of the summary. When a new block
+        # starts, the counts of the previous one are kept in the base.
+        PSCRIPT_OVERLOAD = False  # noqa
+        state = self.live_state
+        if state is None:
+            state = self.live_state = {"key": "", "base": {}, "cat": {}}
+        if state.key and state.key != aggr.time_key:
+            for k, v in state.cat.items():
+                state.base[k] = (state.base[k] or 0) + v
+        state.key = aggr.time_key
+        state.cat = aggr[self.key] or {}
+
+    def apply_delta(self, since, aggrs):
+        # A summary cannot be updated incrementally, so we reload it
+        self.data = None
+        self.live_state = None
+        self.load()
+
     def _create(self):
         PSCRIPT_OVERLOAD = False  # noqa
 
         key = self.key
+        data = self.data
+        if not data:
+            return
 
-        # First aggregate
-        data = data_per_db[self.dbname]
-        totalcount = 0
+        # Combine the summary with the live counts
+        totalcount = data.total
         rows = {}
-        for i in range(len(data)):
-            aggr = data[i]
-            meas = aggr.get(key, {})
-            for k, v in meas.items():
-                rows[k] = rows.get(k, 0) + v
-                totalcount += v
+        for k, v in data.top:
+            rows[k] = v
+        if self.live_state is not None:
+            for cat in (self.live_state.base, self.live_state.cat):
+                for k, v in cat.items():
+                    rows[k] = (rows[k] or 0) + v
+                    totalcount += v
 
         # Group so we can sort in a grouped fashion
         groups = {}
@@ -366,6 +944,12 @@ class CategoricalPanel(InfoPanel):
                 lines.append(
                     f"<tr> <td>{pct:0.0f}%</td> <td>{count}</td> <td>{key}</td> </tr>"
                 )
+        if data.other > 0:
+            pct = 100 * data.other / totalcount
+            key = f"<i>{data.nother} other values</i>"
+            lines.append(
+                f"<tr> <td>{pct:0.0f}%</td> <td>{data.other}</td> <td>{key}</td> </tr>"
+            )
         lines.append("</table>")
 
         self.content.innerHTML = "\n".join(lines)
@@ -378,6 +962,46 @@ class PlotPanel(BasePanel):
         super().__init__(*args)
         self.canvas = document.createElement("canvas")
         self.node.appendChild(self.canvas)
+        self.width = self.height = self.pixel_ratio = 0
+        # Cached stuff. The min/max is reset when the data changes. The layout
+        # (ticks) and paths are also reset when the size changes.
+        self._minmax = None
+        self._layout = None
+        self._paths = None
+
+    def update(self):
+        self._minmax = self._layout = self._paths = None
+        self.invalidate()
+
+    def invalidate(self):
+        """Mark the panel to be drawn (if and when it is visible)."""
+        self.dirty = True
+        if self.visible:
+            schedule_draw()
+
+    def invalidate_layout(self):
+        self._layout = None
+        self.invalidate()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        if visible and self.dirty:
+            schedule_draw()
+
+    def resize(self, w, h):
+        """Set the size of the canvas (in logical pixels)."""
+        pixel_ratio = get_pixel_ratio(self.canvas.getContext("2d"))
+        if w == self.width and h == self.height and pixel_ratio == self.pixel_ratio:
+            return
+        self.canvas.style.width = w + "px"
+        self.canvas.style.height = h + "px"
+        self.canvas.width = w * pixel_ratio
+        self.canvas.height = h * pixel_ratio
+        self.pixel_ratio = pixel_ratio
+        self.width = w
+        self.height = h
+        self._layout = self._paths = None
+        self.invalidate()
 
     def _draw_text(self, ctx, text, x, y, angle=0):
         PSCRIPT_OVERLOAD = False  # noqa
@@ -389,7 +1013,10 @@ class PlotPanel(BasePanel):
         ctx.restore()
 
     def _get_min_max(self):
-        return 0, 1
+        data = self.data
+        if not data.prepared:
+            data.prepared = prepare_data(data, self.key)
+        return data.prepared.minmax
 
     def _get_ticks(self, scale, mi, ma, min_tick_dist=40):
         PSCRIPT_OVERLOAD = False  # noqa
@@ -453,40 +1080,21 @@ class PlotPanel(BasePanel):
             ticks[realt] = s + unit
         return ticks
 
-    def draw(self):
+    def _get_layout(self, mi, ma):
+        """Get the drawing area, scales and ticks. These only depend on the
+        data and the size, so the result is cached.
+        """
         PSCRIPT_OVERLOAD = False  # noqa
 
-        ctx = self.canvas.getContext("2d")
-
-        # Prepare hidpi mode for canvas  (flush state just in case)
-        for i in range(4):
-            ctx.restore()
-        ctx.save()
-        ctx.scale(self.pixel_ratio, self.pixel_ratio)
-
-        # Flip y-axis
-        ctx.scale(1, -1)
-        ctx.translate(0, -self.height)
-
-        # Clear bg
-        ctx.clearRect(0, 0, self.width, self.height)
-
         # Determine drawing area
         x0 = 45
         y0 = 35
         width = self.width - x0 - 15
         height = self.height - y0 - 5
 
-        data = data_per_db[self.dbname]
-        if len(data) == 0:
-            return
-
         # Get bounding box
-        t1 = data[0].time_start
-        t2 = data[-1].time_stop
-        mi, ma = self._get_min_max()
-        if ma <= mi:
-            return
+        t1 = self.data.t1
+        t2 = self.data.t2
         hscale = width / (t2 - t1)
         vscale = height / (ma - mi)
 
@@ -586,6 +1194,64 @@ class PlotPanel(BasePanel):
         # Prepare y ticks
         yticks = self._get_ticks(vscale, mi, ma, 25)  # text -> value
 
+        return {
+            "x0": x0,
+            "y0": y0,
+            "width": width,
+            "height": height,
+            "t1": t1,
+            "t2": t2,
+            "mi": mi,
+            "ma": ma,
+            "hscale": hscale,
+            "vscale": vscale,
+            "utc": utc,
+            "xticks": xticks,
+            "extra_x_tick": extra_x_tick,
+            "yticks": yticks,
+        }
+
+    def draw(self):
+        PSCRIPT_OVERLOAD = False  # noqa
+
+        self.dirty = False
+        if not self.width:
+            return  # not yet sized
+
+        ctx = self.canvas.getContext("2d")
+
+        # Prepare hidpi mode for canvas  (flush state just in case)
+        for i in range(4):
+            ctx.restore()
+        ctx.save()
+        ctx.scale(self.pixel_ratio, self.pixel_ratio)
+
+        # Flip y-axis
+        ctx.scale(1, -1)
+        ctx.translate(0, -self.height)
+
+        # Clear bg
+        ctx.clearRect(0, 0, self.width, self.height)
+
+        data = self.data
+        if data is None or len(data.time_start) == 0:
+            return
+
+        # Get the (cached) range and layout
+        if self._minmax is None:
+            self._minmax = self._get_min_max()
+        mi, ma = self._minmax
+        if ma <= mi or data.t2 <= data.t1:
+            return
+        if self._layout is None:
+            self._layout = self._get_layout(mi, ma)
+        layout = self._layout
+        x0, y0 = layout.x0, layout.y0
+        width, height = layout.width, layout.height
+        t1, hscale, vscale = layout.t1, layout.hscale, layout.vscale
+        xticks, yticks = layout.xticks, layout.yticks
+        extra_x_tick = layout.extra_x_tick
+
         # Prepare drawing
         ctx.lineWidth = 1
 
@@ -641,14 +1307,16 @@ class PlotPanel(BasePanel):
         ctx.lineTo(x0, y0 + height)
         ctx.stroke()
 
-        # Draw content
-        self._draw_content(ctx, mi, ma, t1, t2, x0, y0, hscale, vscale)
+        # Draw content, using the (cached) paths
+        if self._paths is None:
+            self._paths = self._get_paths(layout)
+        self._draw_content(ctx, self._paths)
 
         # Draw local / UTC
         ctx.fillStyle = "rgba(128, 128, 128, 0.5)"
         ctx.textAlign = "right"
         ctx.textBaseline = "bottom"
-        self._draw_text(ctx, "UTC" if utc else "Local time", self.width, 0)
+        self._draw_text(ctx, "UTC" if layout.utc else "Local time", self.width, 0)
 
 
 class CountPanel(PlotPanel):
@@ -656,213 +1324,121 @@ class CountPanel(PlotPanel):
 
     clr = 50, 250, 50
 
-    def _get_min_max(self):
-        PSCRIPT_OVERLOAD = False  # noqa
-        key = self.key
-        mi = 0
-        ma = -9_999_999
-        data = data_per_db[self.dbname]
-        for i in range(len(data)):
-            aggr = data[i]
-            v = aggr[key]
-            if v is undefined:
-                continue
-            ma = max(ma, v)
-        return mi, ma
+    def _get_paths(self, layout):
+        return {"bars": self._get_bars_path(self.data, layout)}
 
-    def _draw_content(self, ctx, mi, ma, t1, t2, x0, y0, hscale, vscale):
+    def _draw_content(self, ctx, paths):
         PSCRIPT_OVERLOAD = False  # noqa
-        key = self.key
         clr = self.clr
         ctx.fillStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 0.8)"
-        data = data_per_db[self.dbname]
-        for i in range(len(data)):
-            aggr = data[i]
-            v = aggr[key]
-            if v is undefined:
-                continue
-            if aggr.time_start > t2:
+        ctx.fill(paths.bars)
+
+    def _get_bars_path(self, data, layout):
+        PSCRIPT_OVERLOAD = False  # noqa
+        x0, y0, t1, t2 = layout.x0, layout.y0, layout.t1, layout.t2
+        hscale, vscale = layout.hscale, layout.vscale
+        time_start, time_stop, counts = data.time_start, data.time_stop, data.count
+        path = Path2D()
+        for i in range(len(counts)):
+            if time_start[i] > t2:
                 continue
-            x = x0 + (aggr.time_start - t1) * hscale
-            w = (aggr.time_stop - aggr.time_start) * hscale
+            x = x0 + (time_start[i] - t1) * hscale
+            w = (time_stop[i] - time_start[i]) * hscale
             w = max(w - 1, 1)
-            ctx.fillRect(x, y0, w, v * vscale)
+            path.rect(x, y0, w, counts[i] * vscale)
+        return path
 
 
 class DailyCountPanel(CountPanel):
     clr = 220, 250, 0
 
-    def _get_min_max(self):
-        PSCRIPT_OVERLOAD = False  # noqa
-        key = self.key
-        mi = 0
-        ma = -9_999_999
-        self.daily = daily = []
-        prev_day = ""
-        data = data_per_db[self.dbname]
-        for i in range(len(data)):
-            aggr = data[i]
-            v = aggr[key]
-            if v is undefined:
-                continue
-            day = aggr.time_key[:10]
-            if day != prev_day:
-                if len(daily) > 0:
-                    ma = max(ma, daily[-1][key])
-                new_aggr = {"time_start": aggr.time_start, "time_stop": aggr.time_stop}
-                new_aggr[key] = aggr[key]
-                daily.append(new_aggr)
-                prev_day = day
-            else:
-                daily[-1][key] += v
-                daily[-1].time_stop = aggr.time_stop
-        if len(daily) > 0:
-            ma = max(ma, daily[-1][key])
-        return mi, ma
+    def _get_paths(self, layout):
+        paths = super()._get_paths(layout)
+        grouped = self.data.prepared.grouped  # prepared by _get_min_max()
+        paths.grouped = self._get_bars_path(grouped, layout)
+        return paths
 
-    def _draw_content(self, ctx, mi, ma, t1, t2, x0, y0, hscale, vscale):
+    def _draw_content(self, ctx, paths):
         PSCRIPT_OVERLOAD = False  # noqa
         # Draw daily
-        key = self.key
         clr = self.clr
         ctx.fillStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 0.4)"
-        for i in range(len(self.daily)):
-            aggr = self.daily[i]
-            v = aggr[key]
-            if aggr.time_start > t2:
-                continue
-            x = x0 + (aggr.time_start - t1) * hscale
-            w = (aggr.time_stop - aggr.time_start) * hscale
-            w = max(w - 1, 1)
-            ctx.fillRect(x, y0, w, v * vscale)
+        ctx.fill(paths.grouped)
         # Draw per unit
-        super()._draw_content(ctx, mi, ma, t1, t2, x0, y0, hscale, vscale)
+        super()._draw_content(ctx, paths)
 
 
-class MonthlyCountPanel(CountPanel):
+class MonthlyCountPanel(DailyCountPanel):
     clr = 250, 200, 0
 
-    def _get_min_max(self):
-        PSCRIPT_OVERLOAD = False  # noqa
-        key = self.key
-        mi = 0
-        ma = -9_999_999
-        self.monthly = monthly = []
-        prev_month = ""
-        data = data_per_db[self.dbname]
-        for i in range(len(data)):
-            aggr = data[i]
-            v = aggr[key]
-            if v is undefined:
-                continue
-            month = aggr.time_key[:7]
-            if month != prev_month:
-                if len(monthly) > 0:
-                    ma = max(ma, monthly[-1][key])
-                new_aggr = {"time_start": aggr.time_start, "time_stop": aggr.time_stop}
-                new_aggr[key] = aggr[key]
-                monthly.append(new_aggr)
-                prev_month = month
-            else:
-                monthly[-1][key] += v
-                monthly[-1].time_stop = aggr.time_stop
-        if len(monthly) > 0:
-            ma = max(ma, monthly[-1][key])
-        return mi, ma
-
-    def _draw_content(self, ctx, mi, ma, t1, t2, x0, y0, hscale, vscale):
-        PSCRIPT_OVERLOAD = False  # noqa
-        # Draw monthly
-        key = self.key
-        clr = self.clr
-        ctx.fillStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 0.4)"
-        for i in range(len(self.monthly)):
-            aggr = self.monthly[i]
-            v = aggr[key]
-            if aggr.time_start > t2:
-                continue
-            x = x0 + (aggr.time_start - t1) * hscale
-            w = (aggr.time_stop - aggr.time_start) * hscale
-            w = max(w - 1, 1)
-            ctx.fillRect(x, y0, w, v * vscale)
-        # Draw per unit
-        super()._draw_content(ctx, mi, ma, t1, t2, x0, y0, hscale, vscale)
-
 
 class NumericalPanel(PlotPanel):
     clr = 0, 220, 250
+    _downsample = "lttb"
 
     def __init__(self, *args):
         super().__init__(*args)
 
-    def _get_min_max(self):
-        PSCRIPT_OVERLOAD = False  # noqa
-        key = self.key
-        mi = +1e20
-        ma = -1e20
-        data = data_per_db[self.dbname]
-        for i in range(len(data)):
-            aggr = data[i]
-            meas = aggr[key]
-            if meas is undefined or meas.n == 0:
-                continue
-            mi = min(mi, meas.min)
-            ma = max(ma, meas.max)
-        if ma >= mi:
-            mi = min(0.8 * ma, mi)  # Select a good min point
-            mi = 0
-        if self.unit == "%":
-            mi = 0
-            ma = max(ma, 100)  # percentages can be larger than 100
-        return mi, ma
-
-    def _draw_content(self, ctx, mi, ma, t1, t2, x0, y0, hscale, vscale):
+    def _get_paths(self, layout):
         PSCRIPT_OVERLOAD = False  # noqa
-        key = self.key
-        clr = self.clr
-        ctx.fillStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 0.2)"
-        ctx.strokeStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 1.0)"
-        data = data_per_db[self.dbname]
-        mean_points = []
-        for i in range(len(data)):
-            aggr = data[i]
-            meas = aggr[key]
-            if meas is undefined or meas.n == 0:
+        x0, y0, t1, t2 = layout.x0, layout.y0, layout.t1, layout.t2
+        hscale, vscale, mi = layout.hscale, layout.vscale, layout.mi
+        data = self.data
+        minmax_path = Path2D()
+        std_path = Path2D()
+        mean_path = Path2D()
+        mean_started = False
+        for i in range(len(data.n)):
+            n = data.n[i]
+            if n == 0:
                 continue
-            if aggr.time_start > t2:
+            if data.time_start[i] > t2:
                 continue
 
-            x = x0 + (aggr.time_start - t1) * hscale
-            w = (aggr.time_stop - aggr.time_start) * hscale
+            x = x0 + (data.time_start[i] - t1) * hscale
+            w = (data.time_stop[i] - data.time_start[i]) * hscale
             w = max(w, 1)
 
-            # Draw rectangle for min max
-            y = y0 + (meas.min - mi) * vscale
-            h = (meas.max - meas.min) * vscale
-            ctx.fillRect(x, y, w, h)
-
-            # Draw rectangle for std
-            mean = meas.mean
-            std = (meas.magic / meas.n) ** 0.5  # Welford
-            st1 = max(meas.min, mean - std)
-            st2 = min(meas.max, mean + std)
+            # Rectangle for min max
+            vmin, vmax = data.min[i], data.max[i]
+            y = y0 + (vmin - mi) * vscale
+            h = (vmax - vmin) * vscale
+            minmax_path.rect(x, y, w, h)
+
+            # Rectangle for std
+            mean = data.mean[i]
+            std = (data.magic[i] / n) ** 0.5  # Welford
+            st1 = max(vmin, mean - std)
+            st2 = min(vmax, mean + std)
             y = y0 + (st1 - mi) * vscale
             h = (st2 - st1) * vscale
-            ctx.fillRect(x, y, w, h)
+            std_path.rect(x, y, w, h)
 
+            # Line for the mean
             y = y0 + (mean - mi) * vscale
-            mean_points.append((x + 0.3333 * w, y))
-            mean_points.append((x + 0.6666 * w, y))
-
-        # Draw mean
-        if len(mean_points) > 0:
-            ctx.beginPath()
-            ctx.moveTo(mean_points[0], mean_points[1])
-            for x, y in mean_points:
-                ctx.lineTo(x, y)
-            ctx.stroke()
+            if mean_started:
+                mean_path.lineTo(x + 0.3333 * w, y)
+            else:
+                mean_path.moveTo(x + 0.3333 * w, y)
+                mean_started = True
+            mean_path.lineTo(x + 0.6666 * w, y)
 
+        return {"minmax": minmax_path, "std": std_path, "mean": mean_path}
 
-window.addEventListener("load", on_init)
-window.addEventListener("resize", on_resize)
-window.addEventListener("hashchange", on_hash_change)
+    def _draw_content(self, ctx, paths):
+        PSCRIPT_OVERLOAD = False  # noqa
+        clr = self.clr
+        ctx.fillStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 0.2)"
+        ctx.strokeStyle = f"rgba({clr[0]}, {clr[1]}, {clr[2]}, 1.0)"
+        ctx.fill(paths.minmax)
+        ctx.fill(paths.std)
+        ctx.stroke(paths.mean)
+
+
+if globalThis.document is undefined:
+    # We're running in the Web Worker
+    globalThis.addEventListener("message", on_worker_message)
+else:
+    window.addEventListener("load", on_init)
+    window.addEventListener("resize", on_resize)
+    window.addEventListener("hashchange", on_hash_change)
@@ -33,6 +33,10 @@ ul.links {
     padding: 0 1em;
     list-style: none;
 }
+svg.sparkline {
+    vertical-align: middle;
+    background: rgba(128, 128, 128, 0.15);
+}
 ul.links > li > ul, ul.links > ul {
     list-style: none;
     padding-left: 1em;
@@ -89,6 +93,9 @@ ul.links > li > ul, ul.links > ul {
     padding: 0;
     overflow: hidden;
 }
+.panel.loading {
+    opacity: 0.5;
+}
 .panel .title {
     -moz-user-select: none;
     user-select: none;
@@ -0,0 +1,71 @@
+"""
+Loading of the JS for the client code. Transpiling client_code.py with
+PScript takes a while, so this is done once for each version of the
+source: the result is written to a file with the hash of the source in
+its name. Such a file is generated when the stats server is packaged
+(see restart_stats()), and otherwise it is cached in ~/_stats.
+"""
+
+import os
+import hashlib
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENT_CODE_FILENAME = os.path.join(THIS_DIR, "client_code.py")
+CACHE_DIR = os.path.expanduser("~/_stats/jscache")
+
+
+def get_source_hash():
+    """Get a hash of the source of the client code."""
+    with open(CLIENT_CODE_FILENAME, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def get_js_filename(dirname, source_hash):
+    """Get the filename of the JS for the given source hash."""
+    return os.path.join(dirname, f"client_{source_hash}.js")
+
+
+def transpile():
+    """Transpile the client code to JS. This is the slow part."""
+    import pscript
+
+    with open(CLIENT_CODE_FILENAME, "rb") as f:
+        return pscript.py2js(f.read().decode())
+
+
+def write_client_js(dirname, js=None):
+    """Write the JS for the client code to the given directory, and
+    return the filename. The file is written atomically, so that other
+    processes never read a partial file.
+    """
+    if js is None:
+        js = transpile()
+    filename = get_js_filename(dirname, get_source_hash())
+    os.makedirs(dirname, exist_ok=True)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(js.encode())
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+def load_client_js(cache_dir=None):
+    """Get the JS for the client code. The file generated during packaging
+    is used if it exists, then the file in the cache dir. Otherwise the
+    code is transpiled, and the result is written to the cache dir.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    source_hash = get_source_hash()
+    for dirname in (THIS_DIR, cache_dir):
+        try:
+            with open(get_js_filename(dirname, source_hash), "rb") as f:
+                return f.read().decode()
+        except OSError:
+            pass
+    js = transpile()
+    try:
+        write_client_js(cache_dir, js)
+    except OSError:  # pragma: no cover
+        pass  # e.g. a read-only file system; we'll just transpile again
+    return js
@@ -1,21 +1,82 @@
 import os
 import time
+import heapq
+import calendar
 import datetime
+import threading
 
-from .monitor import Monitor, merge
+from .monitor import Monitor, merge, copy_aggr, wait_for_pending_writes
+from .recent import RecentValues
+
+
+DEFAULT_IDLE_TIMEOUT = 3600  # 1 hour
+MAX_CACHED_ROLLUPS = 64
+DEFAULT_MAX_POINTS = 300
+DEFAULT_CAT_TOP = 50
+
+# The resolutions (bucket sizes in seconds) that data can be aggregated to.
+# The month is a special case; it is bucketed by calendar month.
+MONTH = 31 * 86400
+RESOLUTIONS = 600, 1800, 3600, 6 * 3600, 86400, MONTH
+
+
+def get_bucket(t, resolution):
+    """Get the start (epoch, UTC) of the bucket that t falls in."""
+    if resolution == MONTH:
+        tm = time.gmtime(t)
+        return calendar.timegm((tm.tm_year, tm.tm_mon, 1, 0, 0, 0))
+    return int(t // resolution) * resolution
+
+
+def _get_time_key(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+def get_day_range(ndays, daysago):
+    """Get the first and final day (UTC), and the corresponding time range."""
+    today = time.gmtime()  # UTC
+    today = datetime.date(today.tm_year, today.tm_mon, today.tm_mday)
+    one_day = datetime.timedelta(days=1)
+    final_day = today - one_day * daysago
+    first_day = today - one_day * (daysago + ndays - 1)
+
+    t1 = int(time.mktime(first_day.timetuple()))
+    t2 = int(time.mktime((final_day + one_day).timetuple()))
+
+    return first_day, final_day, t1, t2
+
+
+def get_resolution(t1, t2, max_points):
+    """Get the smallest resolution that produces at most max_points
+    buckets for the given time range.
+    """
+    for resolution in RESOLUTIONS:
+        if (t2 - t1) / resolution <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
 
 
 class StatsCollector:
     """Central object that collects data, distributing it into different
     monitor objects (which are each backed by an sqlite db).
+
+    Monitors of groups that have not received data for idle_timeout
+    seconds are flushed and evicted (they are re-created when needed).
     """
 
-    def __init__(self, db_dir):
+    def __init__(self, db_dir, idle_timeout=DEFAULT_IDLE_TIMEOUT):
         os.makedirs(db_dir, exist_ok=True)
         self._db_dir = db_dir
+        self._idle_timeout = float(idle_timeout)
+        self._lock = threading.Lock()  # for the monitors and their activity
         self._monitors = {}
+        self._last_active = {}  # group -> time of last put
+        self._next_eviction_check = time.time() + 10
         self._available_groups = set()
-        self._last_values = {}
+        self._groups_version = 0  # increases when a group is added
+        self._sorted_groups = -1, ()  # cache for get_groups()
+        self._recent = RecentValues()
+        self._rollups = {}  # (group, first_day, final_day, resolution) -> tuple
 
         for fname in os.listdir(self._db_dir):
             if fname.endswith(".db"):
@@ -24,115 +85,359 @@ class StatsCollector:
     def _get_db_name(self, group):
         return os.path.join(self._db_dir, group + ".db")
 
-    def _get_monitor(self, group):
-        try:
-            return self._monitors[group]
-        except KeyError:
-            monitor = Monitor(self._get_db_name(group))
-            self._monitors[group] = monitor
-            self._available_groups.add(group)
-            return monitor
+    def _get_monitor(self, group, t=None):
+        """Get the monitor for the given group, creating it if needed.
+        If t is given, the group is marked as active at that time. This
+        happens while holding the lock, so that the monitor cannot be
+        evicted (by another thread) before the data is put into it.
+        """
+        with self._lock:
+            monitor = self._monitors.get(group, None)
+            if monitor is None:
+                monitor = Monitor(self._get_db_name(group))
+                self._monitors[group] = monitor
+                self._last_active[group] = time.time()
+                if group not in self._available_groups:
+                    self._available_groups.add(group)
+                    self._groups_version += 1
+            if t is not None:
+                self._last_active[group] = t
+        if t is not None and t > self._next_eviction_check:
+            self._next_eviction_check = t + 10
+            self.evict_idle_monitors()
+        return monitor
+
+    def evict_idle_monitors(self):
+        """Flush and drop the monitors that have been idle for longer
+        than the idle timeout. Returns the list of evicted groups.
+        This is called automatically about every 10 seconds.
+        """
+        threshold = time.time() - self._idle_timeout
+        evicted = []
+        # The helper thread writes the final aggregations of the monitors, so
+        # that this does not block. A monitor that is re-created for the same
+        # group waits for that write before it loads its state.
+        with self._lock:
+            for group, t in list(self._last_active.items()):
+                if t < threshold:
+                    self._last_active.pop(group, None)
+                    monitor = self._monitors.pop(group, None)
+                    if monitor is not None:
+                        monitor.close()
+                    self._recent.discard_group(group)
+                    evicted.append(group)
+        return evicted
+
+    def close(self):
+        """Write the data of all monitors to disk, and drop them. The
+        collector should not be used afterwards.
+        """
+        with self._lock:
+            monitors, self._monitors = self._monitors, {}
+            self._last_active.clear()
+            wait_for_pending_writes()  # of evicted monitors
+            for monitor in monitors.values():
+                monitor.close(sync=True)
+
+    def get_memory_usage(self):
+        """Get a dict that maps group name to an estimate of the number
+        of bytes used for that group (for groups that are in memory).
+        """
+        usage = {}
+        for group, monitor in list(self._monitors.items()):
+            usage[group] = monitor.get_memory_usage()
+        for group in self._recent.get_groups():
+            usage[group] = usage.get(group, 0) + self._recent.get_memory_usage(group)
+        return usage
 
     def put(self, group, stats):
-        monitor = self._get_monitor(group)
         t = time.time()
+        monitor = self._get_monitor(group, t)
         with monitor:
             for key, value in stats.items():
-                self._last_values[group + ">" + key] = t, value
+                self._recent.put(group, key, value, t)
                 monitor.put(key, value)
 
+    def put_many(self, group, stats_list):
+        """Put a sequence of stats dicts into the groups monitor,
+        acquiring the monitor only once.
+        """
+        t = time.time()
+        monitor = self._get_monitor(group, t)
+        with monitor:
+            for stats in stats_list:
+                for key, value in stats.items():
+                    self._recent.put(group, key, value, t)
+                    monitor.put(key, value)
+
     def put_one(self, group, key, value):
         """Put a single value into the groups monitor, and return
         whether the value was accepted.
         """
-        monitor = self._get_monitor(group)
-        self._last_values[group + ">" + key] = time.time(), value
+        t = time.time()
+        monitor = self._get_monitor(group, t)
+        self._recent.put(group, key, value, t)
         with monitor:
             return monitor.put(key, value)
 
     def get_groups(self):
-        """Get a tuple of groups known to this collector."""
-        come_first = {"system", "stats", "traefik", "daemon"}
-        come_last = {"other"}
-        groups = self._available_groups.copy()
-        groups1 = groups.intersection(come_first)
-        groups3 = groups.intersection(come_last)
-        groups2 = groups.difference(come_first | come_last)
-        groups1 = tuple(sorted(groups1, key=lambda x: x.replace("sys", "_sys")))
-        return groups1 + tuple(sorted(groups2)) + tuple(sorted(groups3))
+        """Get a tuple of groups known to this collector. The result
+        is cached until a new group is added.
+        """
+        version, sorted_groups = self._sorted_groups
+        if version != self._groups_version:
+            version = self._groups_version
+            come_first = {"system", "stats", "traefik", "daemon"}
+            come_last = {"other"}
+            groups = self._available_groups.copy()
+            groups1 = groups.intersection(come_first)
+            groups3 = groups.intersection(come_last)
+            groups2 = groups.difference(come_first | come_last)
+            groups1 = tuple(sorted(groups1, key=lambda x: x.replace("sys", "_sys")))
+            sorted_groups = groups1 + tuple(sorted(groups2)) + tuple(sorted(groups3))
+            self._sorted_groups = version, sorted_groups
+        return sorted_groups
 
     def get_latest_value(self, group, key):
-        t, value = self._last_values.get(group + ">" + key, (0, None))
+        t, value = self._recent.get_latest(group, key)
         etime = 5 if key == "cpu|num|%" else 60
         if time.time() - t < etime:
             return value
         else:
             return None
 
-    def get_data(self, groups, ndays, daysago):
+    def get_recent_values(self, group, key):
+        """Get a list with the values of a numeric key over the past
+        minutes, at 1-second resolution (oldest first, None if unknown).
+        Returns None if there is no such (numeric) key.
+        """
+        return self._recent.get_series(group, key, time.time())
+
+    def get_version(self, group):
+        """Get a string that changes when aggregations are written to the
+        database of the given group. This does not query the database,
+        so it's cheap to use e.g. for etags.
+        """
+        try:
+            st = os.stat(self._get_db_name(group))
+        except OSError:
+            return "0"
+        return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+    def get_current_aggr(self, group):
+        """Get (a copy of) the current aggregation of the given group,
+        or None if the group's monitor is not active.
+        """
+        monitor = self._monitors.get(group, None)
+        if monitor is None:
+            return None
+        return monitor.get_current_aggr()
+
+    def get_current_version(self, group):
+        """Get a number that changes when the current aggregation of the
+        given group may have changed, or None if the group's monitor is
+        not active. This is cheaper than comparing aggregations.
+        """
+        monitor = self._monitors.get(group, None)
+        if monitor is None:
+            return None
+        return monitor.get_current_version()
+
+    def get_resolution(self, ndays, daysago, max_points=DEFAULT_MAX_POINTS):
+        """Get the resolution (in seconds) that get_data() uses for
+        the given range and max_points. A value of MONTH means that the
+        data is aggregated per calendar month.
+        """
+        _, _, t1, t2 = get_day_range(ndays, daysago)
+        return get_resolution(t1, t2, max_points)
+
+    def _get_rollup(self, group, first_day, final_day, resolution):
+        """Get the stored aggregations of a group, merged so that there is
+        one aggregation per bucket of the given resolution. The result is
+        cached until the monitor writes a new aggregation to the database.
+        """
+        monitor = self._get_monitor(group)
+        write_count = monitor.write_count
+        cache_key = group, first_day, final_day, resolution
+        cached = self._rollups.get(cache_key, None)
+        if cached is not None and cached[0] is monitor and cached[1] == write_count:
+            return cached[2]
+
+        # Merge aggr's that are in the same bucket. The time_start is always
+        # in the block that the aggr represents, so we can use it to bucket.
+        data = []
+        last_bucket = None
+        for aggr in monitor.get_aggregations(first_day, final_day, False):
+            bucket = get_bucket(aggr["time_start"], resolution)
+            if bucket == last_bucket:
+                merge(data[-1], aggr)
+            else:
+                last_bucket = bucket
+                aggr = aggr.copy()
+                aggr["time_key"] = _get_time_key(bucket)
+                data.append(aggr)
+        data = tuple(data)
+
+        self._rollups.pop(cache_key, None)
+        self._rollups[cache_key] = monitor, write_count, data
+        while len(self._rollups) > MAX_CACHED_ROLLUPS:
+            self._rollups.pop(next(iter(self._rollups)))
+        return data
+
+    def _merge_current_aggr(self, group, data, resolution):
+        """Merge the current aggregation into the given list of (rolled up)
+        aggregations, without modifying the aggregations in the list.
+        """
+        aggr = self._get_monitor(group).get_current_aggr()
+        bucket = get_bucket(aggr["time_start"], resolution)
+        key = _get_time_key(bucket)
+        if data and data[-1]["time_key"] == key:
+            data[-1] = copy_aggr(data[-1])
+            merge(data[-1], aggr)
+        else:
+            aggr["time_key"] = key
+            data.append(aggr)
+
+    def get_data(
+        self,
+        groups,
+        ndays,
+        daysago,
+        include_current=True,
+        max_points=DEFAULT_MAX_POINTS,
+    ):
         """Get aggegation data from ndays ago to daysago. The
         result is a dict, in which the keys are the categores, and each
         value is a list of the aggregations in the corresponding
         group. The aggegations are combined (aggegregated further)
-        if needed to keep the returned list to a reasonable size.
+        into buckets of 10 minutes up to a month, so that the list has
+        at most about max_points aggregations (see get_resolution()).
+        The current (live) aggregation is included, unless include_current
+        is False. The returned aggregations must not be modified.
 
         Note that this call performs sync queries to a database, so you
         might want to asyncify the calling of this method.
         """
         assert isinstance(groups, list)
 
-        # Get range of days to collect
+        # Get range of days to collect, and the resolution
+        first_day, final_day, t1, t2 = get_day_range(ndays, daysago)
+        resolution = get_resolution(t1, t2, max_points)
         today = time.gmtime()  # UTC
         today = datetime.date(today.tm_year, today.tm_mon, today.tm_mday)
-        one_day = datetime.timedelta(days=1)
-        final_day = today - one_day * daysago
-        first_day = today - one_day * (daysago + ndays - 1)
-
-        t1 = int(time.mktime(first_day.timetuple()))
-        t2 = int(time.mktime((final_day + one_day).timetuple()))
 
         # Collect all data
         data_per_group = {}
 
         for group in groups:
-            # Get 10 min aggregations from monitor
-            monitor = self._get_monitor(group)
-            data = monitor.get_aggregations(first_day, final_day)
-
-            # Determine level of aggregation: none, hour, day, month
-            nchars = 20  # 1-second res
-            if ndays <= 1:
-                nchars == 15  # 10-minute res
-            elif ndays <= 6:
-                nchars = 13  # 1-hour res
-            elif ndays <= 150:
-                nchars = 10  # 1-day res
-            else:
-                nchars = 7  # 1-month res
-
-            # Merge aggr's that have the same key.
-            data2 = [{"time_key": "x"}]
-            for aggr in data:
-                key = aggr["time_key"][:nchars]
-                if key == data2[-1]["time_key"]:
-                    merge(data2[-1], aggr)
-                else:
-                    aggr = aggr.copy()
-                    aggr["time_key"] = key
-                    data2.append(aggr)
+            # Get (cached) aggregations from the db, at the right resolution
+            data = list(self._get_rollup(group, first_day, final_day, resolution))
+
+            # Merge the current aggregation
+            if include_current and final_day == today:
+                self._merge_current_aggr(group, data, resolution)
 
             # Put a stub aggregation at the beginning and end so that all figures
             # have the same time range.
-            if len(data2) == 1:
-                data = []
-            else:
-                data = data2
+            if data:
                 x = {"time_key": "x"}
-                x["time_start"] = x["time_stop"] = min(t1, data[1]["time_start"])
-                data[0] = x.copy()
+                x["time_start"] = x["time_stop"] = min(t1, data[0]["time_start"])
+                data.insert(0, x.copy())
                 x["time_start"] = x["time_stop"] = max(t2, data[-1]["time_stop"])
                 data.append(x.copy())
 
             data_per_group[group] = data
 
         return data_per_group
+
+    def get_keys(self, group, ndays, daysago):
+        """Get a sorted list of the keys (e.g. "foo|count") that occur in
+        the data of the given group and time range.
+        """
+        keys = set()
+        for aggr in self.get_data([group], ndays, daysago)[group]:
+            keys.update(aggr.keys())
+        return sorted(key for key in keys if "|" in key)
+
+    def get_key_data(
+        self,
+        group,
+        key,
+        ndays,
+        daysago,
+        include_current=True,
+        max_points=DEFAULT_MAX_POINTS,
+    ):
+        """Like get_data(), but for a single group and key. The returned
+        list only contains the aggregations that have the key (plus the
+        stubs at the beginning and end), and each aggregation only has
+        the time-fields and the key.
+        """
+        data = self.get_data([group], ndays, daysago, include_current, max_points)
+        data = data[group]
+        if not data:
+            return []
+        result = [data[0]]
+        for aggr in data[1:-1]:
+            if key in aggr:
+                result.append(
+                    {
+                        "time_key": aggr["time_key"],
+                        "time_start": aggr["time_start"],
+                        "time_stop": aggr["time_stop"],
+                        key: aggr[key],
+                    }
+                )
+        result.append(data[-1])
+        return result
+
+    def get_cat_summary(
+        self, group, key, ndays, daysago, include_current=True, top=DEFAULT_CAT_TOP
+    ):
+        """Get a summary of a cat key over the given range: a dict with
+        the total count, the top (a list of [value, count] with the most
+        frequent values), and the count and number of values that are
+        not in the top ("other" and "nother"). The summary is computed
+        from the rollup at the default resolution, which is likely cached
+        because get_keys() uses it too.
+        """
+        data = self.get_data([group], ndays, daysago, include_current)[group]
+        summary = {"key": key, "t1": 0, "t2": 0, "total": 0, "top": []}
+        summary["other"] = summary["nother"] = 0
+        if not data:
+            return summary
+        summary["t1"] = data[0]["time_start"]
+        summary["t2"] = data[-1]["time_stop"]
+
+        totals = {}
+        for aggr in data[1:-1]:
+            for value, count in aggr.get(key, {}).items():
+                totals[value] = totals.get(value, 0) + count
+        top_items = heapq.nlargest(top, totals.items(), key=lambda x: x[1])
+        summary["total"] = total = sum(totals.values())
+        summary["top"] = [list(item) for item in top_items]
+        summary["other"] = total - sum(count for _, count in top_items)
+        summary["nother"] = len(totals) - len(top_items)
+        return summary
+
+    def get_delta(self, group, ndays, daysago, resolution, since, include_current=True):
+        """Get the aggregations of a group at the given resolution (as used
+        by get_data()) that are new or may have changed since the block
+        with time_key since: that block and any later blocks. There are no
+        stubs. The rollup is shared with get_data(), so this is cheap for
+        a client that keeps its data up-to-date.
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Invalid resolution {resolution!r}")
+        first_day, final_day, _, _ = get_day_range(ndays, daysago)
+        today = time.gmtime()  # UTC
+        today = datetime.date(today.tm_year, today.tm_mon, today.tm_mday)
+        rollup = self._get_rollup(group, first_day, final_day, resolution)
+        # The rollup is sorted, so we can search from the end
+        i = len(rollup)
+        while i > 0 and rollup[i - 1]["time_key"] >= since:
+            i -= 1
+        data = list(rollup[i:])
+        if include_current and final_day == today:
+            self._merge_current_aggr(group, data, resolution)
+        return data
@@ -0,0 +1,104 @@
+"""
+Columnar encoding of aggregation series, for a more compact transfer
+to the client, and so that the client can walk flat arrays.
+
+The columns are a dict with the key, the time range (t1 and t2, from
+the stubs at the start and end), and one list for each field. The
+start and stop times of the blocks are integer columns (the client
+derives time keys from these). The names of the arrays (the numeric
+fields, followed by the integer columns) are listed in "arrays", and
+those of the integer columns also in "int_arrays".
+
+The binary encoding consists of a uint32 header size, a JSON header
+with everything except the arrays, padding to a multiple of 8 bytes,
+and then each numeric field as a float64 array, followed by each
+integer column as a uint32 array. All numbers are little endian.
+"""
+
+import sys
+import json
+import struct
+from array import array
+
+
+NUM_FIELDS = "min", "max", "n", "mean", "magic"
+INT_ARRAYS = "time_start", "time_stop"
+
+
+def get_fields(key):
+    """Get the names of the fields for the given key."""
+    type = key.split("|")[1] if "|" in key else ""
+    if type == "num":
+        return NUM_FIELDS
+    elif type == "cat":
+        return ("cat",)
+    else:
+        return ("count",)
+
+
+def to_columns(data, key):
+    """Convert a list of aggregations (with a stub at the start and end,
+    as returned by StatsCollector.get_key_data()) to a columns dict.
+    """
+    fields = get_fields(key)
+    columns = {"key": key, "t1": 0, "t2": 0}
+    columns["arrays"] = [] if fields == ("cat",) else list(fields)
+    columns["arrays"].extend(INT_ARRAYS)
+    columns["int_arrays"] = list(INT_ARRAYS)
+    for name in INT_ARRAYS + fields:
+        columns[name] = []
+    if not data:
+        return columns
+
+    columns["t1"] = int(data[0]["time_start"])
+    columns["t2"] = int(data[-1]["time_stop"])
+    for aggr in data[1:-1]:
+        if key not in aggr:
+            continue
+        columns["time_start"].append(int(aggr["time_start"]))
+        columns["time_stop"].append(int(aggr["time_stop"]))
+        value = aggr[key]
+        if fields == NUM_FIELDS:
+            for field in fields:
+                columns[field].append(value[field])
+        else:
+            columns[fields[0]].append(value)
+    return columns
+
+
+def encode_binary(columns):
+    """Encode a columns dict to bytes. The numeric fields are stored as
+    float64 arrays, and the integer columns as uint32 arrays. Raises
+    ValueError for categorical data.
+    """
+    if "cat" in columns:
+        raise ValueError("Cannot binary-encode categorical data.")
+    header = {k: v for k, v in columns.items() if k not in columns["arrays"]}
+    header["n"] = len(columns["time_start"])
+    header = json.dumps(header).encode()
+    npad = -(4 + len(header)) % 8
+    parts = [struct.pack("<I", len(header)), header, b" " * npad]
+    for name in columns["arrays"]:
+        a = array("I" if name in columns["int_arrays"] else "d", columns[name])
+        if sys.byteorder != "little":  # pragma: no cover
+            a.byteswap()
+        parts.append(a.tobytes())
+    return b"".join(parts)
+
+
+def decode_binary(bb):
+    """Decode bytes produced by encode_binary() into a columns dict."""
+    (nheader,) = struct.unpack("<I", bb[:4])
+    offset = 4 + nheader
+    columns = json.loads(bb[4:offset].decode())
+    offset += -offset % 8
+    n = columns.pop("n")
+    for name in columns["arrays"]:
+        a = array("I" if name in columns["int_arrays"] else "d")
+        end = offset + a.itemsize * n
+        a.frombytes(bb[offset:end])
+        if sys.byteorder != "little":  # pragma: no cover
+            a.byteswap()
+        columns[name] = a.tolist()
+        offset = end
+    return columns
@@ -0,0 +1,97 @@
+"""
+Compression of http responses, using brotli (if available) or gzip,
+depending on what the client accepts.
+"""
+
+import gzip
+import json
+import functools
+
+from asgineer.utils import guess_content_type_from_body
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+MIN_COMPRESS_SIZE = 256
+
+
+def select_encoding(accept_encoding):
+    """Select the encoding to use, given the accept-encoding header.
+    Returns "br", "gzip" or "".
+    """
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        encoding, _, params = part.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0"):
+            accepted.add(encoding.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    elif "gzip" in accepted:
+        return "gzip"
+    return ""
+
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    else:
+        return gzip.compress(body, compresslevel=6)
+
+
+# The static assets are served many times, so their compressed bodies are
+# cached. The hash of a bytes object is cached too, so lookups are cheap.
+_compress_cached = functools.lru_cache(maxsize=16)(_compress)
+
+
+def normalize_if_none_match(request):
+    """The etags of responses are made weak by compress_response(), and
+    If-None-Match uses the weak comparison. So strip the "W/" prefix from
+    the request's if-none-match header, so that handlers can compare it
+    to the etags that they produce.
+    """
+    value = request.headers.get("if-none-match", "")
+    if value.startswith("W/"):
+        request.headers["if-none-match"] = value[2:]
+
+
+def compress_response(request, status, headers, body, cache=False):
+    """Compress the body of a (200) response, if the client accepts that
+    and it makes sense. Dicts/lists are encoded as JSON and str bodies
+    are encoded as UTF-8 first. Returns a new (status, headers, body).
+
+    Because the body depends on the accept-encoding header, the vary
+    header is set, and the etag is made weak (the variants with different
+    encodings share it). Set cache to True for static assets, to cache
+    their compressed bodies.
+    """
+    if status not in (200, 304):
+        return status, headers, body
+    headers = headers.copy()
+    headers["vary"] = "accept-encoding"
+    etag = headers.get("etag", "")
+    if etag.startswith('"'):
+        headers["etag"] = "W/" + etag
+    if status != 200 or "content-encoding" in headers:
+        return status, headers, body
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+        headers.setdefault("content-type", "application/json")
+    if isinstance(body, str):
+        headers.setdefault("content-type", guess_content_type_from_body(body))
+        body = body.encode()
+    if not isinstance(body, bytes):
+        return status, headers, body  # e.g. a stream
+
+    if len(body) >= MIN_COMPRESS_SIZE:
+        encoding = select_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            compress = _compress_cached if cache else _compress
+            compressed = compress(body, encoding)
+            if len(compressed) < 0.9 * len(body):
+                body = compressed
+                headers["content-encoding"] = encoding
+                headers.pop("content-length", None)
+    return status, headers, body
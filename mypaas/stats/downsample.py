@@ -0,0 +1,101 @@
+"""
+Downsampling of numeric series, so that long ranges can be shown with
+a bounded number of points, without losing the spikes.
+"""
+
+
+METHODS = "lttb", "minmax"
+
+
+def lttb(xs, ys, n):
+    """Select n points using the Largest-Triangle-Three-Buckets algorithm.
+    The first and last point are always selected. Returns a list of indices.
+    """
+    size = len(xs)
+    if n >= size:
+        return list(range(size))
+    elif n < 3:
+        return [0, size - 1][:n]
+
+    every = (size - 2) / (n - 2)
+    indices = [0]
+    a = 0
+    for i in range(n - 2):
+        # Get the average point of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, size)
+        avg_x = sum(xs[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(ys[avg_start:avg_end]) / (avg_end - avg_start)
+        # Select the point in this bucket that makes the largest triangle
+        max_area = -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs(
+                (xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a])
+            )
+            if area > max_area:
+                max_area, next_a = area, j
+        indices.append(next_a)
+        a = next_a
+    indices.append(size - 1)
+    return indices
+
+
+def minmax(mins, maxs, n):
+    """Select about n points by dividing the series in n/2 buckets, and
+    selecting the point with the lowest min and the point with the highest
+    max from each. The first and last point are always selected (so that
+    the last block still matches the live data). Returns a sorted list of
+    indices.
+    """
+    size = len(mins)
+    if n >= size:
+        return list(range(size))
+    nbuckets = max(1, n // 2)
+    indices = {0, size - 1}
+    for b in range(nbuckets):
+        i1, i2 = b * size // nbuckets, (b + 1) * size // nbuckets
+        if i2 > i1:
+            indices.add(min(range(i1, i2), key=lambda i: mins[i]))
+            indices.add(max(range(i1, i2), key=lambda i: maxs[i]))
+    return sorted(indices)
+
+
+def downsample_aggregations(data, key, n, method="lttb"):
+    """Downsample a list of aggregations for a num key (with a stub at
+    the start and end, as returned by StatsCollector.get_key_data()) to
+    about n aggregations. Each selected aggregation is extended to cover
+    the time up to the next selected one, and its min and max are those
+    of all the aggregations that it covers, so that spikes survive.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Invalid downsample method {method!r}")
+    blocks = data[1:-1]
+    if len(blocks) <= n or key.split("|")[1:2] != ["num"]:
+        return data
+
+    if method == "lttb":
+        xs = [aggr["time_start"] for aggr in blocks]
+        ys = [aggr[key]["mean"] for aggr in blocks]
+        indices = lttb(xs, ys, n)
+    else:
+        mins = [aggr[key]["min"] for aggr in blocks]
+        maxs = [aggr[key]["max"] for aggr in blocks]
+        indices = minmax(mins, maxs, n)
+
+    result = [data[0]]
+    for i, i1 in enumerate(indices):
+        i2 = indices[i + 1] if i + 1 < len(indices) else len(blocks)
+        covered = blocks[i1:i2]
+        aggr = blocks[i1]
+        value = aggr[key].copy()
+        value["min"] = min(b[key]["min"] for b in covered)
+        value["max"] = max(b[key]["max"] for b in covered)
+        new_aggr = {
+            "time_key": aggr["time_key"],
+            "time_start": aggr["time_start"],
+            "time_stop": covered[-1]["time_stop"],
+        }
+        new_aggr[key] = value
+        result.append(new_aggr)
+    result.append(data[-1])
+    return result
@@ -0,0 +1,165 @@
+"""
+Export of the current aggregations in the OpenMetrics text format, so
+that the stats can be scraped by Prometheus-compatible tooling.
+
+For each group that has an active monitor, the current block is
+exported. Counts become counters (which reset when a new block starts,
+as indicated by the _created sample), nums become summaries plus gauges
+for the min, max and last value. Categorical stats are not exported.
+Everything is produced from memory; the database is never touched.
+"""
+
+import re
+import math
+import logging
+
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PREFIX = "mypaas_"
+UNITS = {"iB": "bytes", "s": "seconds", "%": "percent"}
+TYPE_ORDER = "counter", "summary", "gauge"  # which type keeps a clashing name
+
+logger = logging.getLogger("mypaas_stats")
+
+
+def _metric_name(name):
+    name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return PREFIX + name
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt(value):
+    if math.isnan(value):
+        return "NaN"
+    elif math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    elif value == int(value) and abs(value) < 2**53:
+        return str(int(value))
+    return repr(float(value))
+
+
+def get_group_families(group, aggr, latest):
+    """Get a list of (name, type, unit, lines) tuples representing the
+    metric families for the given group, based on its current aggregation
+    and a dict with the latest value for each num key.
+    """
+    label = '{group="' + _escape(group) + '"}'
+    created = _fmt(aggr["time_start"])
+    families = []
+    for key in sorted(aggr):
+        parts = key.split("|")
+        if len(parts) < 2:
+            continue
+        name, type = parts[0], parts[1]
+        unit = UNITS.get(parts[2], "") if len(parts) > 2 else ""
+        value = aggr[key]
+        if type in ("count", "dcount", "mcount"):
+            fname = _metric_name(name if type == "count" else f"{name}_{type}")
+            lines = [
+                f"{fname}_total{label} {_fmt(value)}",
+                f"{fname}_created{label} {created}",
+            ]
+            families.append((fname, "counter", "", lines))
+        elif type == "num":
+            unit_suffix = f"_{unit}" if unit else ""
+            fname = _metric_name(name + unit_suffix)
+            lines = [
+                f"{fname}_count{label} {_fmt(value['n'])}",
+                f"{fname}_sum{label} {_fmt(value['mean'] * value['n'])}",
+                f"{fname}_created{label} {created}",
+            ]
+            families.append((fname, "summary", unit, lines))
+            # The unit must be the suffix of the name
+            gauges = {"min": value["min"], "max": value["max"]}
+            if latest.get(key, None) is not None:
+                gauges["last"] = latest[key]
+            for suffix, val in gauges.items():
+                gname = _metric_name(f"{name}_{suffix}{unit_suffix}")
+                lines = [f"{gname}{label} {_fmt(val)}"]
+                families.append((gname, "gauge", unit, lines))
+    return families
+
+
+class MetricsExporter:
+    """Object to produce the OpenMetrics text for a collector. The
+    families of each group are cached, and only re-generated when the
+    group's current aggregation (or latest values) has changed. This keeps
+    frequent scrapes with many groups cheap.
+    """
+
+    def __init__(self, collector):
+        self._collector = collector
+        self._cache = {}  # group -> (version, num_keys, latest, families)
+        self._clashes = set()  # names for which a clash has been logged
+
+    def _get_group_families(self, group):
+        version = self._collector.get_current_version(group)
+        cached = self._cache.get(group, None)
+        aggr = None
+        if cached is not None and cached[0] == version:
+            num_keys = cached[1]
+        else:
+            aggr = self._collector.get_current_aggr(group)
+            if aggr is None:
+                self._cache.pop(group, None)
+                return []
+            num_keys = [key for key in aggr if key.split("|")[1:2] == ["num"]]
+        latest = {}
+        for key in num_keys:
+            latest[key] = self._collector.get_latest_value(group, key)
+        if aggr is None:
+            if cached[2] == latest:
+                return cached[3]
+            aggr = self._collector.get_current_aggr(group)
+            if aggr is None:
+                self._cache.pop(group, None)
+                return []
+        families = get_group_families(group, aggr, latest)
+        self._cache[group] = version, num_keys, latest, families
+        return families
+
+    def get_text(self):
+        """Get the OpenMetrics text for all active groups."""
+        # Collect the lines per family, so that families are not interleaved
+        families = {}  # (name, type) -> (unit, lines)
+        types = {}  # name -> set of types
+        for group in self._collector.get_groups():
+            for name, type, unit, lines in self._get_group_families(group):
+                family = families.get((name, type), None)
+                if family is None:
+                    families[(name, type)] = unit, list(lines)
+                    types.setdefault(name, set()).add(type)
+                else:
+                    family[1].extend(lines)
+
+        parts = []
+        for (name, type), (unit, lines) in families.items():
+            if len(types[name]) > 1:
+                name, lines = self._resolve_clash(name, type, unit, types[name], lines)
+            parts.append(f"# TYPE {name} {type}")
+            if unit:
+                parts.append(f"# UNIT {name} {unit}")
+            parts.extend(lines)
+        parts.append("# EOF\n")
+        return "\n".join(parts)
+
+    def _resolve_clash(self, name, type, unit, types, lines):
+        """Resolve a name clash between families of different types. The
+        type that comes first in TYPE_ORDER keeps the name, the others get
+        the type as a suffix (before the unit).
+        """
+        if name not in self._clashes:
+            self._clashes.add(name)
+            logger.warning(f"Metric name clash for {name}: {sorted(types)}")
+        if type == min(types, key=TYPE_ORDER.index):
+            return name, lines
+        if unit:
+            new_name = f"{name.rpartition('_')[0]}_{type}_{unit}"
+        else:
+            new_name = f"{name}_{type}"
+        return new_name, [line.replace(name, new_name, 1) for line in lines]
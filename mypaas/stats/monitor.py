@@ -3,9 +3,11 @@ The Monitor class that performs the aggregation.
 """
 
 import os
+import sys
 import time
 import atexit
 import hashlib
+import itertools
 import weakref
 import logging
 import datetime
@@ -26,9 +28,29 @@ TABLE_NAME = "aggregations"
 
 
 _monitor_instances = weakref.WeakSet()
-_write_queue = Queue(10000)
+_version_counter = itertools.count(1)  # shared, so versions are unique
+_write_queue = Queue(10000)  # (monitor, aggr, closing) tuples
 _helper_thread = None
 
+# The aggregations of closed monitors are written by the helper thread.
+# Keep track of these, so that one can wait for them to be written.
+_pending_writes = {}  # filename -> count
+_pending_condition = threading.Condition()
+
+
+def wait_for_pending_writes(filename=None, timeout=5):
+    """Wait until the final aggregations of closed monitors have been
+    written to disk (for the given db filename, or for all of them).
+    """
+    with _pending_condition:
+        _pending_condition.wait_for(lambda: not _is_pending(filename), timeout)
+
+
+def _is_pending(filename):
+    if filename is None:
+        return bool(_pending_writes)
+    return filename in _pending_writes
+
 
 # When Python exits, flush the current record of all monitors
 @atexit.register
@@ -37,6 +59,15 @@ def _at_exit():  # pragma: no cover
         m.flush()
 
 
+def _sizeof(ob):
+    """Estimate the size of a (nested) aggregation dict in bytes."""
+    nbytes = sys.getsizeof(ob)
+    if isinstance(ob, dict):
+        for key, val in ob.items():
+            nbytes += sys.getsizeof(key) + _sizeof(val)
+    return nbytes
+
+
 def hashit(value):
     """Hash any value by applying md5 to the stringified value.
     Returns an integer.
@@ -106,6 +137,17 @@ def merge(aggr1, aggr2):
                 d1["n"], d1["mean"], d1["magic"] = n, mean, magic
 
 
+def copy_aggr(aggr):
+    """Copy an aggregation, including the nested dicts (for num and cat),
+    so that it can be merged into without affecting the original.
+    """
+    aggr = aggr.copy()
+    for key, val in aggr.items():
+        if isinstance(val, dict):
+            aggr[key] = val.copy()
+    return aggr
+
+
 class HelperThread(threading.Thread):
     """Thread that helps the store to periodically safe aggregations to disk."""
 
@@ -120,18 +162,26 @@ class HelperThread(threading.Thread):
 
         while True:
             try:
-                m, aggr = _write_queue.get(True, 0.1)
-                m._write_aggr(aggr)
+                m, aggr, closing = _write_queue.get(True, 0.1)
             except Empty:
                 pass
-            except Exception:
-                time.seep(0.1)
+            else:
+                try:
+                    m._write_aggr(aggr)
+                except Exception:
+                    time.sleep(0.1)
+                if closing:
+                    with _pending_condition:
+                        _pending_writes[m.filename] -= 1
+                        if not _pending_writes[m.filename]:
+                            _pending_writes.pop(m.filename)
+                        _pending_condition.notify_all()
 
             t = time.time()
 
             if t > time1:
                 time1 = t + 1
-                for m in _monitor_instances:
+                for m in list(_monitor_instances):
                     try:
                         m._do_each_1_seconds()
                     except Exception:
@@ -139,7 +189,7 @@ class HelperThread(threading.Thread):
 
             if t > time10:
                 time10 = t + 10
-                for m in _monitor_instances:
+                for m in list(_monitor_instances):
                     try:
                         m._do_each_10_seconds()
                     except Exception:
@@ -175,29 +225,14 @@ class Monitor:
         # Init current aggregation
         self._current_aggr = self._create_new_aggr()
         self._current_time_stop = self._current_aggr["time_stop"]
-        # Keep track of ids for daily counters
+        self._current_version = next(_version_counter)
+        # Keep track of ids for daily counters. These are restored from
+        # the db when a dcount or mcount is first used.
         self._daily_ids = {}  # key -> set of ids, gets cleared each day
         self._monthly_ids = {}
-        if os.path.isfile(self._filename):
-            db = ItemDB(self._filename)
-            try:
-                db.ensure_table("info", "!key")
-                daily_ids_info = db.select_one("info", "key == 'daily_ids'")
-                day_key = self._current_aggr["time_key"][:10]
-                if daily_ids_info and daily_ids_info["time_key"][:10] == day_key:
-                    for key in daily_ids_info:
-                        if key not in ("key", "time_key"):
-                            self._daily_ids[key] = set(daily_ids_info[key])
-                monthly_ids_info = db.select_one("info", "key == 'monthly_ids'")
-                month_key = self._current_aggr["time_key"][:7]
-                if monthly_ids_info and monthly_ids_info["time_key"][:7] == month_key:
-                    for key in monthly_ids_info:
-                        if key not in ("key", "time_key"):
-                            self._monthly_ids[key] = set(monthly_ids_info[key])
-            except Exception as err:
-                logger.error(
-                    f"Failed to restore daily_ids and monthly_ids from db: {err}"
-                )
+        self._ids_loaded = False
+        # Number of aggregations written, so readers can tell when to re-query
+        self._write_count = 0
         # Setup our helper thread
         _monitor_instances.add(self)
         global _helper_thread
@@ -205,6 +240,36 @@ class Monitor:
             _helper_thread = HelperThread()
             _helper_thread.start()
 
+    def _load_ids(self):
+        """Restore the daily and monthly ids from the db (if they are
+        of the current day/month). Called when a dcount or mcount is first
+        used, so monitors that don't use these don't pay for it.
+        """
+        self._ids_loaded = True
+        # A monitor for this db may just have been closed (evicted)
+        wait_for_pending_writes(self._filename)
+        if not os.path.isfile(self._filename):
+            return
+        db = ItemDB(self._filename)
+        try:
+            db.ensure_table("info", "!key")
+            daily_ids_info = db.select_one("info", "key == 'daily_ids'")
+            day_key = self._current_aggr["time_key"][:10]
+            if daily_ids_info and daily_ids_info["time_key"][:10] == day_key:
+                for key in daily_ids_info:
+                    if key not in ("key", "time_key"):
+                        ids = self._daily_ids.setdefault(key, set())
+                        ids.update(daily_ids_info[key])
+            monthly_ids_info = db.select_one("info", "key == 'monthly_ids'")
+            month_key = self._current_aggr["time_key"][:7]
+            if monthly_ids_info and monthly_ids_info["time_key"][:7] == month_key:
+                for key in monthly_ids_info:
+                    if key not in ("key", "time_key"):
+                        ids = self._monthly_ids.setdefault(key, set())
+                        ids.update(monthly_ids_info[key])
+        except Exception as err:
+            logger.error(f"Failed to restore daily_ids and monthly_ids from db: {err}")
+
     def _is_locked_in_this_thread(self):
         tlocal = self._tlocal
         try:
@@ -222,6 +287,7 @@ class Monitor:
         return self
 
     def __exit__(self, type, value, traceback):
+        self._current_version = next(_version_counter)
         self._lock_current_aggr.release()
         self._tlocal.locked = None
 
@@ -232,11 +298,42 @@ class Monitor:
         """
         self._write_aggr(self._next_aggr())
 
+    def close(self, sync=False):
+        """Hand the current aggregation to the helper thread to write
+        it to disk, and stop taking part in the helper thread's periodic
+        tasks. Used to evict monitors that are idle. If sync is True,
+        the aggregation is written in the calling thread instead.
+        """
+        _monitor_instances.discard(self)
+        if sync:
+            self._write_aggr(self._next_aggr())
+        else:
+            with _pending_condition:
+                count = _pending_writes.get(self._filename, 0)
+                _pending_writes[self._filename] = count + 1
+            _write_queue.put((self, self._next_aggr(), True))
+
+    def get_memory_usage(self):
+        """Get an estimate of the number of bytes used by this monitor."""
+        nbytes = sys.getsizeof(self) + _sizeof(self.get_current_aggr())
+        for ids_dict in (self._daily_ids, self._monthly_ids):
+            for ids in ids_dict.values():
+                nbytes += sys.getsizeof(ids) + 32 * len(ids)  # ints are ~32 B
+        return nbytes
+
     @property
     def filename(self):
         """The filename of the database that this Monitor writes to."""
         return self._filename
 
+    @property
+    def write_count(self):
+        """The number of aggregations that this Monitor has written to
+        the database. When this changes, get_aggregations() may return
+        different results.
+        """
+        return self._write_count
+
     def _do_each_1_seconds(self):
         """Gets called by the helper thread about each second.
         Only do stuff that takes a very short time here!
@@ -274,6 +371,7 @@ class Monitor:
             cur_aggr = self._current_aggr
             self._current_aggr = new_aggr
             self._current_time_stop = new_aggr["time_stop"]
+            self._current_version = next(_version_counter)
         # Actual stop time can be earlier
         cur_aggr["time_stop"] = min(cur_aggr["time_stop"], int(time.time()))
         # Return, the helper thread stores it to disk
@@ -286,7 +384,7 @@ class Monitor:
         if time.time() > self._current_time_stop:
             # Swap out the old aggr and have the helper thread store it
             old_aggr = self._next_aggr()
-            _write_queue.put((self, old_aggr))
+            _write_queue.put((self, old_aggr, False))
             # Is this a new day?
             old_day = old_aggr["time_key"][:10]
             new_day = self._current_aggr["time_key"][:10]
@@ -317,6 +415,10 @@ class Monitor:
                     merge(x, aggr)
                     aggr = x
                 db.put(TABLE_NAME, aggr)
+            self._write_count += 1
+            # If the ids have not been loaded, there is nothing to update
+            if not self._ids_loaded:
+                return
             # Prepare daily ids info
             daily_ids_info = {}
             for key in self._daily_ids.keys():
@@ -380,6 +482,8 @@ class Monitor:
                 return True
             elif type == "dcount":
                 if value is not None:
+                    if not self._ids_loaded:
+                        self._load_ids()
                     value = hashit(value)
                     ids = self._daily_ids.setdefault(key, set())
                     if value not in ids:
@@ -388,6 +492,8 @@ class Monitor:
                         return True
             elif type == "mcount":
                 if value is not None:
+                    if not self._ids_loaded:
+                        self._load_ids()
                     value = hashit(value)
                     ids = self._monthly_ids.setdefault(key, set())
                     if value not in ids:
@@ -431,11 +537,19 @@ class Monitor:
     def get_current_aggr(self):
         """Get (a copy of) the current aggregation record."""
         with self._lock_current_aggr:
-            return self._current_aggr.copy()
+            return copy_aggr(self._current_aggr)
+
+    def get_current_version(self):
+        """Get a number that changes when the current aggregation may have
+        changed (i.e. after each put context, and when a new aggregation
+        is started). Numbers are unique across monitors.
+        """
+        return self._current_version
 
-    def get_aggregations(self, first_day, last_day):
+    def get_aggregations(self, first_day, last_day, include_current=True):
         """Get aggregations between two given days (inclusive).
-        If the last day is today, also include the current aggregation.
+        If the last day is today, also include the current aggregation
+        (unless include_current is False).
         """
         assert isinstance(first_day, datetime.date)
         assert isinstance(last_day, datetime.date)
@@ -456,7 +570,7 @@ class Monitor:
         except KeyError:
             pass  # Invalid table name
 
-        if last_day == today:
+        if last_day == today and include_current:
             data.append(self.get_current_aggr())
 
         return data
@@ -1,4 +1,5 @@
 import json
+import time
 import socket
 import hashlib
 import threading
@@ -6,29 +7,52 @@ import threading
 from fastuaparser import parse_ua
 
 from .monitor import logger
+from .capture import DatagramWriter
+
+# Datagrams can contain the stats of many groups (e.g. from the daemon),
+# so make sure that we can receive the largest datagrams, and that bursts
+# of them fit in the socket's buffer.
+MAX_DATAGRAM_SIZE = 65536
+RECEIVE_BUFFER_SIZE = 2**20
 
 
 class UdpStatsReceiver(threading.Thread):
     """Thread that receives stats from UDP, send by other processes.
     Accepts (most of) statsd format, and a wee bit influxDB because that's
-    what Traefik sends us.
+    what Traefik sends us. A datagram can also be a JSON list of stats
+    dicts (each with a group), which is processed in one batch.
 
-    Processes the data and puts it into the collector.
+    Processes the data and puts it into the collector. If capture is
+    given (a filename), all raw datagrams are also written to a (rotating)
+    capture file, which can be used with the replay script.
     """
 
-    def __init__(self, collector, port=8125):
+    def __init__(self, collector, port=8125, capture=None):
         super().__init__()
         self._collector = collector
         self._port = port
         self.setDaemon(True)  # don't let this thread prevent shutdown
         self._stop = False
+        self._capture = None
+        if capture:
+            self._capture = DatagramWriter(capture)
 
     def run(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError:  # pragma: no cover
+            pass
         s.bind(("0.0.0.0", self._port))
 
         while not self._stop:
-            data, addr = s.recvfrom(4096)
+            data, addr = s.recvfrom(MAX_DATAGRAM_SIZE)
+            if self._capture is not None:
+                try:
+                    self._capture.write(time.time(), data)
+                except Exception as err:
+                    logger.error("Failed to capture datagram: " + str(err))
+                    self._capture = None
             try:
                 self.process_data(data.decode(errors="ignore"))
             except Exception:
@@ -36,6 +60,53 @@ class UdpStatsReceiver(threading.Thread):
 
     def process_data(self, text):
         """Parse incoming data and put it into the collector."""
+        if text.startswith("["):
+            return self._process_data_list(text)
+        group, stats = self._parse_data(text)
+        self._collector.put(group, stats)
+
+    def _process_data_list(self, text):
+        """Process a JSON list of stats dicts, using one batched put per group."""
+        batches = {}
+        for stats in json.loads(text):
+            if isinstance(stats, dict):
+                group = stats.pop("group", "") or "other"
+                batches.setdefault(group, []).append(stats)
+        self._put_batches(batches)
+
+    def process_batch(self, lines):
+        """Parse a sequence of lines, each in any of the formats that
+        ``process_data()`` understands, and put the result into the
+        collector using one batched put per group. Lines that cannot
+        be parsed are skipped. Returns the number of accepted lines.
+        """
+        batches = {}
+        count = 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                group, stats = self._parse_data(line)
+            except Exception:
+                continue
+            batches.setdefault(group, []).append(stats)
+            count += 1
+        self._put_batches(batches)
+        return count
+
+    def _put_batches(self, batches):
+        """Put a dict of group -> stats_list into the collector. An error
+        (e.g. a malformed key) is logged, and does not affect other groups.
+        """
+        for group, stats_list in batches.items():
+            try:
+                self._collector.put_many(group, stats_list)
+            except Exception as err:
+                logger.error(f"Failed to put stats for group {group!r}: {err}")
+
+    def _parse_data(self, text):
+        """Parse incoming data into a (group, stats) tuple."""
         if text.startswith("traefik"):
             group = "traefik"
             stats = self._process_data_traefik(text)
@@ -50,8 +121,7 @@ class UdpStatsReceiver(threading.Thread):
         else:
             group = "other"
             stats = self._process_data_statsd(text)
-
-        self._collector.put(group, stats)
+        return group, stats
 
     def _process_data_traefik(self, text):
         """Parsers a tiny and Traefik-specific set of influxDB."""
@@ -0,0 +1,110 @@
+"""
+In-memory store for the most recent values, without touching the database.
+"""
+
+import sys
+import math
+from array import array
+
+
+DEFAULT_NSECONDS = 300  # 5 minutes at 1-second resolution
+
+
+class _Entry:
+    __slots__ = ("t", "value", "values", "seconds")
+
+    def __init__(self):
+        self.t = 0
+        self.value = None
+        self.values = None
+        self.seconds = None
+
+
+class RecentValues:
+    """Object that keeps track of the latest value for each (group, key).
+    For numeric keys, it also keeps a ring buffer with the values of the
+    last nseconds, at 1-second resolution, stored in compact arrays.
+
+    Keys are (group, key) tuples of interned strings, so that putting
+    a value does not need any string concatenation.
+    """
+
+    def __init__(self, nseconds=DEFAULT_NSECONDS):
+        self._n = int(nseconds)
+        self._entries = {}
+
+    @property
+    def nseconds(self):
+        """The number of seconds that the ring buffers span."""
+        return self._n
+
+    def _new_entry(self, group, key):
+        k = sys.intern(group), sys.intern(key)
+        entry = _Entry()
+        if key.split("|")[1:2] == ["num"]:
+            entry.values = array("d", [math.nan]) * self._n
+            entry.seconds = array("q", [0]) * self._n
+        self._entries[k] = entry
+        return entry
+
+    def put(self, group, key, value, t):
+        """Put a value for the given group and key, at time t."""
+        entry = self._entries.get((group, key), None)
+        if entry is None:
+            entry = self._new_entry(group, key)
+        entry.t = t
+        entry.value = value
+        if entry.values is not None:
+            sec = int(t)
+            i = sec % self._n
+            try:
+                entry.values[i] = value
+            except TypeError:
+                return
+            entry.seconds[i] = sec
+
+    def get_latest(self, group, key):
+        """Get a (t, value) tuple for the latest value. Returns (0, None)
+        if no value is known.
+        """
+        entry = self._entries.get((group, key), None)
+        if entry is None:
+            return 0, None
+        return entry.t, entry.value
+
+    def get_series(self, group, key, now):
+        """Get a list of the values of the last nseconds before (and
+        including) now, oldest first. Seconds for which no value is
+        known are None. Returns None if the key has no ring buffer.
+        """
+        entry = self._entries.get((group, key), None)
+        if entry is None or entry.values is None:
+            return None
+        n = self._n
+        now = int(now)
+        values, seconds = entry.values, entry.seconds
+        series = []
+        for sec in range(now - n + 1, now + 1):
+            i = sec % n
+            series.append(values[i] if seconds[i] == sec else None)
+        return series
+
+    def get_groups(self):
+        """Get a set of the groups that have values in this store."""
+        return set(group for group, _ in list(self._entries.keys()))
+
+    def discard_group(self, group):
+        """Remove all values for the given group."""
+        for k in [k for k in list(self._entries.keys()) if k[0] == group]:
+            self._entries.pop(k, None)
+
+    def get_memory_usage(self, group):
+        """Get an estimate of the number of bytes used for the given group."""
+        nbytes = 0
+        for (g, _), entry in list(self._entries.items()):
+            if g == group:
+                nbytes += sys.getsizeof(entry) + sys.getsizeof(entry.value)
+                if entry.values is not None:
+                    nbytes += sys.getsizeof(entry.values)
+                    nbytes += sys.getsizeof(entry.seconds)
+        return nbytes
@@ -0,0 +1,198 @@
+"""
+Script to replay a capture file of raw datagrams (see the capture
+option of the UdpStatsReceiver), to reproduce production ingest load.
+
+Usage: python -m mypaas.stats.replay FILENAME [--speed=1|10|max] [--udp=HOST:PORT]
+
+The rotated backups of the capture file (FILENAME.1, FILENAME.2, etc.)
+are replayed too, oldest first.
+
+By default the datagrams are fed into process_data() of a receiver
+with a collector in a temporary directory. The sustained throughput and
+CPU time per packet are reported, as well as whether the aggregations
+match the data that was put in. With --udp the datagrams are sent
+to the given address instead.
+"""
+
+import sys
+import time
+import socket
+import tempfile
+import itertools
+
+from .capture import get_capture_filenames, read_datagrams
+from .monitor import _write_queue
+from .collector import StatsCollector
+from .receiver import UdpStatsReceiver
+
+
+class CountingCollector:
+    """Proxy for a StatsCollector that keeps track of what was put in,
+    so we can check the correctness of the aggregation.
+    """
+
+    def __init__(self, collector):
+        self._collector = collector
+        self.expected = {}  # (group, key) -> count/n
+
+    def _count(self, group, key, value):
+        type = key.split("|")[1] if "|" in key else ""
+        if type == "count":
+            n = 1 if value is None else int(value)
+        elif type == "num":
+            n = 1
+        else:
+            return
+        k = group, key
+        self.expected[k] = self.expected.get(k, 0) + n
+
+    def put(self, group, stats):
+        for key, value in stats.items():
+            self._count(group, key, value)
+        self._collector.put(group, stats)
+
+    def put_many(self, group, stats_list):
+        for stats in stats_list:
+            for key, value in stats.items():
+                self._count(group, key, value)
+        self._collector.put_many(group, stats_list)
+
+    def put_one(self, group, key, value):
+        self._count(group, key, value)
+        return self._collector.put_one(group, key, value)
+
+
+def get_aggregated_counts(collector, groups, ndays):
+    """Get the total count/n for each (group, key) from the collector."""
+    # Give the helper thread the chance to write finished aggregations
+    while not _write_queue.empty():
+        time.sleep(0.01)
+    time.sleep(0.1)
+    counts = {}
+    for group, data in collector.get_data(list(groups), ndays, 0).items():
+        for aggr in data:
+            for key, val in aggr.items():
+                type = key.split("|")[1] if "|" in key else ""
+                if type == "count":
+                    n = val
+                elif type == "num":
+                    n = val["n"]
+                else:
+                    continue
+                counts[(group, key)] = counts.get((group, key), 0) + n
+    return counts
+
+
+def iter_paced(datagrams, speed):
+    """Yield datagrams, sleeping to honor the original timing divided
+    by speed. A speed of zero means as fast as possible.
+    """
+    t_ref = t_start = None
+    for t, data in datagrams:
+        if speed > 0:
+            if t_ref is None:
+                t_ref, t_start = t, time.perf_counter()
+            delay = (t - t_ref) / speed - (time.perf_counter() - t_start)
+            if delay > 0:
+                time.sleep(delay)
+        yield data
+
+
+def replay(filename, speed=0, udp=None):
+    """Replay the capture file (and its backups) and return a dict with results."""
+    datagrams = itertools.chain.from_iterable(
+        read_datagrams(fname) for fname in get_capture_filenames(filename)
+    )
+    if udp:
+        return _replay_udp(datagrams, speed, udp)
+    with tempfile.TemporaryDirectory(prefix="mypaas_replay_") as db_dir:
+        collector = StatsCollector(db_dir)
+        try:
+            return _replay_local(datagrams, speed, collector)
+        finally:
+            collector.close()
+
+
+def _replay_udp(datagrams, speed, udp):
+    host, _, port = udp.rpartition(":")
+    address = host or "localhost", int(port)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        return _process_all(datagrams, speed, lambda data: s.sendto(data, address))
+    finally:
+        s.close()
+
+
+def _replay_local(datagrams, speed, collector):
+    counting_collector = CountingCollector(collector)
+    receiver = UdpStatsReceiver(counting_collector)
+    process = lambda data: receiver.process_data(  # noqa: E731
+        data.decode(errors="ignore")
+    )
+    result = _process_all(datagrams, speed, process)
+
+    expected = counting_collector.expected
+    groups = set(group for group, _ in expected)
+    ndays = int(result["seconds"] / 86400) + 2
+    actual = get_aggregated_counts(collector, groups, ndays)
+    mismatches = {k: (v, actual.get(k, 0)) for k, v in expected.items()}
+    mismatches = {k: v for k, v in mismatches.items() if v[0] != v[1]}
+    result["mismatches"] = mismatches
+    return result
+
+
+def _process_all(datagrams, speed, process):
+    n = nerrors = 0
+    t0, c0 = time.perf_counter(), time.process_time()
+    for data in iter_paced(datagrams, speed):
+        n += 1
+        try:
+            process(data)
+        except Exception:
+            nerrors += 1
+    t1, c1 = time.perf_counter(), time.process_time()
+
+    return {
+        "packets": n,
+        "errors": nerrors,
+        "seconds": t1 - t0,
+        "packets_per_second": n / max(t1 - t0, 1e-9),
+        "cpu_us_per_packet": 1e6 * (c1 - c0) / max(n, 1),
+    }
+
+
+def main(argv):
+    speed = 1
+    udp = None
+    filenames = []
+    for arg in argv:
+        if arg.startswith("--speed="):
+            val = arg.split("=", 1)[1]
+            speed = 0 if val == "max" else float(val)
+        elif arg.startswith("--udp="):
+            udp = arg.split("=", 1)[1]
+        elif arg.startswith("-"):
+            sys.exit(__doc__.strip())
+        else:
+            filenames.append(arg)
+    if len(filenames) != 1:
+        sys.exit(__doc__.strip())
+
+    speed_str = f"{speed:g}x" if speed else "max"
+    print(f"Replaying {filenames[0]} at {speed_str} speed ...")
+    result = replay(filenames[0], speed, udp)
+    print(f"  packets: {result['packets']} ({result['errors']} errors)")
+    print(f"  duration: {result['seconds']:0.2f} s")
+    print(f"  throughput: {result['packets_per_second']:0.0f} packets per second")
+    print(f"  cpu: {result['cpu_us_per_packet']:0.1f} us per packet")
+    if "mismatches" in result:
+        if result["mismatches"]:
+            print("  aggregation: MISMATCH")
+            for (group, key), (v1, v2) in result["mismatches"].items():
+                print(f"    {group} {key}: put {v1}, aggregated {v2}")
+        else:
+            print("  aggregation: ok")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
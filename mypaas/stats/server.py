@@ -6,34 +6,78 @@ MyPaas sitemap:
     /           -> dashboard home, showing server stats, and links
     /dashboard  -> the Traefik dashboard (hosted by Traefik)
     /stats      -> stat pages, select groups and range via query params
+    /ingest     -> POST newline-delimited stats (internal network only)
+    /sparklines -> recent cpu and mem of each group, from memory
+    /memory     -> estimated memory usage of the collector, per group
+    /statstream -> server side events with live stats
+    /api/data   -> json aggregations for one group and key, see query params
+    /api/cat    -> json summary (top-N) of a cat key for one group
+    /api/delta  -> json aggregations that changed since the client's last block
+    /metrics    -> the current aggregations in OpenMetrics format
     /daemon     -> very basic daemon info page (hosted by mypaasd)
 
 """
 
-import os
 import json
 import time
+import asyncio
+import hashlib
+import weakref
 import platform
+import ipaddress
 
 import psutil
-import pscript
 import asgineer
 
 from .client_style import CSS
+from .clientjs import load_client_js
+from .monitor import logger
+from .compression import compress_response, normalize_if_none_match
+from .metrics import MetricsExporter, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .columns import to_columns, encode_binary
+from .collector import DEFAULT_MAX_POINTS, DEFAULT_CAT_TOP, RESOLUTIONS
+from .collector import get_day_range
+from .downsample import METHODS as DOWNSAMPLE_METHODS, downsample_aggregations
 
 
 START_TIME = time.time()
-THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-with open(os.path.join(THIS_DIR, "client_code.py"), "rb") as f:
-    JS = pscript.py2js(f.read().decode())
+MAX_INGEST_LINE_SIZE = 2**20
+DOWNSAMPLE_FACTOR = 4  # query this many times more points when downsampling
+JS = load_client_js()  # transpiled once per version of the client code
 
 
+# The assets are compressed in stats_handler (also with brotli), not here
 static_assets = {"style.css": CSS, "client.js": JS}
-asset_handler = asgineer.utils.make_asset_handler(static_assets)
+asset_handler = asgineer.utils.make_asset_handler(
+    static_assets, min_compress_size=float("inf")
+)
 
+# A hash of the client code, so that cached responses are invalidated on updates
+APP_HASH = hashlib.sha256((JS + CSS).encode()).hexdigest()[:16]
 
-async def stats_handler(request, collector):
-    """The main http handler to serve stats data."""
+# Wait this long after midnight before a day is considered historic,
+# so that its last aggregation has been written.
+HISTORIC_MARGIN = 1200
+
+
+async def stats_handler(request, collector, receiver=None):
+    """The main http handler to serve stats data. If a receiver is
+    given, stats can also be pushed via a POST to /ingest. Responses
+    are compressed if the client accepts that.
+    """
+    normalize_if_none_match(request)
+    response = await _stats_handler(request, collector, receiver)
+    if response is None:
+        return None  # the response was streamed
+    is_asset = request.path.split("/")[-1].lower() in static_assets
+    return compress_response(request, *response, cache=is_asset)
+
+
+async def _stats_handler(request, collector, receiver):
+    if request.path == "/ingest" and receiver is not None:
+        if request.method != "POST":
+            return 405, {}, "invalid method"
+        return await ingest(request, receiver)
 
     if request.method != "GET":
         return 405, {}, "invalid method"
@@ -70,6 +114,7 @@ async def stats_handler(request, collector):
                 link = f"<a href='/stats?groups={group}'>{group}</a>"
                 link += f"&nbsp;&nbsp;&nbsp;&nbsp;<span id='{group}-cpu'></span>"
                 link += f"&nbsp;&nbsp;&nbsp;&nbsp;<span id='{group}-mem'></span>"
+                link += f"&nbsp;&nbsp;&nbsp;&nbsp;<span id='{group}-spark'></span>"
                 links.append("<li>" + link + "</li>")
             if len(groups) > 1:
                 links.append("</ul>")
@@ -83,95 +128,492 @@ async def stats_handler(request, collector):
     if request.path == "/stats":
         groups = request.querydict.get("groups", "")
         groups = [group.strip() for group in groups.split(",") if group.strip()]
-        ndays = request.querydict.get("ndays", "")
-        daysago = request.querydict.get("daysago", "")
-        if groups:
-            return get_webpage(
-                collector, ndays, daysago, groups, title="MyPaas Monitor"
-            )
-        else:
+        ndays, daysago = _normalize_ndays_and_daysago(
+            request.querydict.get("ndays", ""), request.querydict.get("daysago", "")
+        )
+        if not groups:
             return 302, {"Location": "/"}, b""
+        # Historic pages only depend on the url (and the day)
+        headers = get_historic_cache_headers(ndays, daysago, "stats", groups)
+        if request.headers.get("if-none-match", None) == headers.get("etag", ""):
+            return 304, headers, b""
+        html = get_webpage(collector, ndays, daysago, groups, title="MyPaas Monitor")
+        return 200, headers, html
 
     elif request.path == "/quickstats":
-        quickstats = {"system-uptime": _uptime()}
-
-        # Add system measurements
-        for name, group, key in [
-            ("system-cpu", "system", "cpu|num|%"),
-            ("system-mem", "system", "mem|num|iB"),
-            ("system-disk", "system", "disk|num|iB"),
-            ("system-connections", "traefik", "open connections|num"),
-            ("system-rtime", "traefik", "duration|num|s"),
-        ]:
-            v = collector.get_latest_value(group, key)
-            if v is not None:
-                if key.endswith("|iB"):
-                    v = (
-                        f"{v/2**30:0.3f} GiB"
-                        if "disk" in key
-                        else f"{v/2**20:0.1f} MiB"
-                    )
-                elif key.endswith("|%"):
-                    v = f"{v:0.1f} %"
-                elif key.endswith("|s"):
-                    v = f"{1000*v:0.1f} ms"
-                else:
-                    v = str(v)
-            quickstats[name] = v
-
-        # Add measurements for each group
-        for group in collector.get_groups():
-            quickstats[group + "-cpu"] = quickstats[group + "-mem"] = ""
-            cpu = collector.get_latest_value(group, "cpu|num|%")
-            mem = collector.get_latest_value(group, "mem|num|iB")
-            if cpu is not None:
-                quickstats[group + "-cpu"] = f"{cpu:0.1f} %"
-                if mem is not None:
-                    quickstats[group + "-mem"] = f"{mem/2**20:0.1f} MiB"
-
-        return 200, {}, quickstats
-
-    # elif request.path == "/statstream":
-    #     # print("starting stat stream")
-    #     raise NotImplementedError("Asigneer does not properly close streams.")
-    #     # return 200, {"content-type": "text/plain"}, stat_streamer()
+        publisher = get_stats_publisher(collector)
+        etag, body = publisher.get_snapshot()
+        headers = {"etag": etag, "cache-control": "no-cache"}
+        if request.headers.get("if-none-match", "") == etag:
+            return 304, headers, b""
+        headers["content-type"] = "application/json"
+        return 200, headers, body
+
+    elif request.path == "/sparklines":
+        return 200, {}, get_sparklines(collector)
+
+    elif request.path == "/memory":
+        usage = collector.get_memory_usage()
+        usage = {group: usage[group] for group in sorted(usage)}
+        return 200, {}, {"total": sum(usage.values()), "groups": usage}
+
+    elif request.path == "/metrics":
+        text = get_metrics_exporter(collector).get_text()
+        return 200, {"content-type": METRICS_CONTENT_TYPE}, text
+
+    elif request.path == "/api/data":
+        return get_api_data(collector, request.querydict, request.headers)
+
+    elif request.path == "/api/cat":
+        return get_api_cat(collector, request.querydict, request.headers)
+
+    elif request.path == "/api/delta":
+        return get_api_delta(collector, request.querydict)
+
+    elif request.path == "/statstream":
+        groups = request.querydict.get("groups", "")
+        groups = [group.strip() for group in groups.split(",") if group.strip()]
+        return await stream_stats(request, collector, groups)
 
     else:
         fname = request.path.split("/")[-1]
         return await asset_handler(request, fname)
 
 
-# async def stat_streamer():
-#     # eek, asgineer does not seem to stop this when the connection is closed by the client
-#     while True:
-#         await asyncio.sleep(1.0)
-#         t = asyncio.Task.current_task()
-#         print("sending at ", time.time(), id(t))
-#         yield f"hi {time.time()}"
+async def ingest(request, receiver):
+    """Handle a POST with newline-delimited stats. Each line can be in
+    any format that the receiver understands. The body is parsed while
+    it streams in, and applied to the collector in batches. Only
+    requests from the local/docker network are accepted; requests
+    that come in via the router (which sets x-forwarded-for) are not.
+    """
+    if not is_internal_request(request):
+        return 403, {}, "ingest is only available from the internal network"
+
+    count = 0
+    pending = b""
+    async for chunk in request.iter_body():
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop(-1)
+        if len(pending) > MAX_INGEST_LINE_SIZE:
+            return 413, {}, "line too long"
+        if lines:
+            count += receiver.process_batch(
+                line.decode(errors="ignore") for line in lines
+            )
+    if pending:
+        count += receiver.process_batch([pending.decode(errors="ignore")])
+
+    return 200, {}, {"accepted": count}
+
+
+def is_internal_request(request):
+    """Get whether the request comes directly from a loopback or
+    private address (e.g. another container on the docker network).
+    """
+    if "x-forwarded-for" in request.headers or "x-real-ip" in request.headers:
+        return False
+    client = request.scope.get("client", None) or ("", 0)
+    try:
+        ip = ipaddress.ip_address(client[0])
+    except ValueError:
+        return False
+    return ip.is_loopback or ip.is_private
 
 
 def get_webpage(collector, ndays, daysago, groups, title=None, extra_info=None):
-    """Generate a webpage with aggegation data from ndays1 ago to
+    """Generate a webpage to show aggegation data from ndays1 ago to
     ndays2 ago (the order does not matter). Returns an complete html
-    document as a string.
+    document as a string. The page only includes the keys of each group;
+    the panels load their data via /api/data when they scroll into view.
 
     Note that this call performs sync queries to a database, so you
     might want to asyncify the calling of this method.
     """
-    # Query data, dump to json, and sanitize
+    # Query keys, dump to json, and sanitize. If we show today, the current
+    # aggregations are passed separately, so the client can update them live.
     ndays, daysago = _normalize_ndays_and_daysago(ndays, daysago)
-    # todo: we could asyncify this call. But only admins watch this page so ...
-    data = json.dumps(collector.get_data(groups, ndays, daysago))
-    data = data.replace("<", "&lt;").replace(">", "&gt;")
+    live = daysago == 0
+    known_groups = collector.get_groups()
+    keys = {}
+    current = {}
+    for group in groups:
+        keys[group] = []
+        if group in known_groups:
+            keys[group] = collector.get_keys(group, ndays, daysago)
+        if live:
+            aggr = collector.get_current_aggr(group)
+            if aggr is not None:
+                current[group] = aggr
+    keys = json.dumps(keys).replace("<", "&lt;").replace(">", "&gt;")
+    current = json.dumps(current).replace("<", "&lt;").replace(">", "&gt;")
     info = {}  # adding info here will make it display as the first panel
     # Build page
     html = STATSVIEW_HTML_TEMPLATE.replace("{TITLE}", title or "Monitor")
     html = html.replace("{NDAYS}", str(ndays)).replace("{DAYSAGO}", str(daysago))
     html = html.replace("{INFO}", json.dumps(info))
-    html = html.replace("{DATA_PER_DB}", data)
+    html = html.replace("{KEYS_PER_DB}", keys)
+    html = html.replace("{CURRENT_PER_DB}", current)
     return html
 
 
+def get_api_data(collector, querydict, request_headers=None):
+    """Get a response with the aggregations for a single group and key.
+    Query params: group, key, ndays, daysago, max_points (the resolution
+    is chosen to stay below this), downsample ("lttb" or "minmax" to
+    query num data at a finer resolution and then downsample it to
+    max_points, see downsample.py), current (set to 0 to leave out the
+    current aggregation), and format ("columns" or "binary" for the
+    columnar encoding, see columns.py).
+
+    Historic data is cacheable until the day changes. Live data without
+    the current aggregation gets an etag that changes when data is
+    written for the group.
+    """
+    group = querydict.get("group", "")
+    key = querydict.get("key", "")
+    if not group or "|" not in key:
+        return 400, {}, "need group and key"
+    ndays, daysago = _normalize_ndays_and_daysago(
+        querydict.get("ndays", ""), querydict.get("daysago", "")
+    )
+    max_points = querydict.get("max_points", "")
+    try:
+        max_points = max(1, int(max_points)) if max_points else DEFAULT_MAX_POINTS
+    except ValueError:
+        return 400, {}, f"invalid max_points {max_points!r}"
+    downsample = querydict.get("downsample", "")
+    if downsample and downsample not in DOWNSAMPLE_METHODS:
+        return 400, {}, f"invalid downsample method {downsample!r}"
+    query_points = max_points
+    if downsample and key.split("|")[1:2] == ["num"]:
+        query_points = DOWNSAMPLE_FACTOR * max_points
+    include_current = querydict.get("current", "") != "0"
+    format = querydict.get("format", "")
+
+    # Check whether the client has this data already
+    params = group, key, query_points, max_points, downsample, format
+    headers = get_api_cache_headers(
+        collector, group, ndays, daysago, include_current, "data", *params
+    )
+    etag = headers.get("etag", "")
+    if request_headers and request_headers.get("if-none-match", None) == etag:
+        return 304, headers, b""
+
+    if group not in collector.get_groups():
+        return 404, {}, f"unknown group {group!r}"
+    data = collector.get_key_data(
+        group, key, ndays, daysago, include_current, query_points
+    )
+    if query_points != max_points:
+        data = downsample_aggregations(data, key, max_points, downsample)
+    if format in ("columns", "binary"):
+        data = to_columns(data, key)
+        data["resolution"] = collector.get_resolution(ndays, daysago, query_points)
+        if format == "binary" and "cat" not in data:
+            headers["content-type"] = "application/octet-stream"
+            return 200, headers, encode_binary(data)
+    headers["content-type"] = "application/json"
+    return 200, headers, json.dumps(data)
+
+
+def get_api_cat(collector, querydict, request_headers=None):
+    """Get a response with a summary of a cat key for a single group:
+    the totals over the range, with the top-N values and an "other"
+    bucket (see StatsCollector.get_cat_summary()). Query params: group,
+    key, ndays, daysago, top, and current (set to 0 to leave out the
+    current aggregation). Cached like get_api_data().
+    """
+    group = querydict.get("group", "")
+    key = querydict.get("key", "")
+    if not group or key.split("|")[1:2] != ["cat"]:
+        return 400, {}, "need group and cat key"
+    ndays, daysago = _normalize_ndays_and_daysago(
+        querydict.get("ndays", ""), querydict.get("daysago", "")
+    )
+    top = querydict.get("top", "")
+    try:
+        top = max(1, int(top)) if top else DEFAULT_CAT_TOP
+    except ValueError:
+        return 400, {}, f"invalid top {top!r}"
+    include_current = querydict.get("current", "") != "0"
+
+    headers = get_api_cache_headers(
+        collector, group, ndays, daysago, include_current, "cat", group, key, top
+    )
+    etag = headers.get("etag", "")
+    if request_headers and request_headers.get("if-none-match", None) == etag:
+        return 304, headers, b""
+
+    if group not in collector.get_groups():
+        return 404, {}, f"unknown group {group!r}"
+    summary = collector.get_cat_summary(
+        group, key, ndays, daysago, include_current, top
+    )
+    return 200, headers, summary
+
+
+def get_api_delta(collector, querydict):
+    """Get a response with the aggregations that are new or changed since
+    the last block that the client has, so it can update its data without
+    reloading. Query params: groups, since (the time_key of the client's
+    last block for each group, comma separated), resolution (that of the
+    client's data), ndays, daysago, and current (set to 0 to leave out the
+    current aggregation). The result maps group names to a list of
+    aggregations (see StatsCollector.get_delta()).
+    """
+    groups = querydict.get("groups", "").split(",")
+    since = querydict.get("since", "").split(",")
+    if not groups[0] or len(groups) != len(since):
+        return 400, {}, "need groups and a since for each group"
+    ndays, daysago = _normalize_ndays_and_daysago(
+        querydict.get("ndays", ""), querydict.get("daysago", "")
+    )
+    resolution = querydict.get("resolution", "")
+    resolution = int(resolution) if resolution.isnumeric() else 0
+    if resolution not in RESOLUTIONS:
+        return 400, {}, f"invalid resolution {resolution}"
+    include_current = querydict.get("current", "") != "0"
+
+    known_groups = collector.get_groups()
+    result = {}
+    for group, time_key in zip(groups, since):
+        if group in known_groups:
+            result[group] = collector.get_delta(
+                group, ndays, daysago, resolution, time_key, include_current
+            )
+    return 200, {"cache-control": "no-cache"}, result
+
+
+def get_api_cache_headers(collector, group, ndays, daysago, include_current, *params):
+    """Get the caching headers for an api response. Historic data is
+    cacheable until the day changes. Live data without the current
+    aggregation gets an etag that changes when data is written for
+    the group. Live data with the current aggregation is not cached.
+    """
+    headers = get_historic_cache_headers(ndays, daysago, *params)
+    if not headers and not include_current:
+        version = collector.get_version(group)
+        headers = get_live_cache_headers(ndays, daysago, version, *params)
+    return headers
+
+
+def _get_etag(*params):
+    key = json.dumps([APP_HASH, *params], default=str)
+    return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+
+def get_historic_cache_headers(ndays, daysago, *params):
+    """Get the caching headers for a response that depends on the given
+    range and params. If the range is fully in the past, the response
+    does not change, so it gets a strong etag (from the day range and
+    params), and can be cached as immutable until the day changes (and
+    with it the meaning of daysago). Returns an empty dict otherwise.
+    """
+    seconds_today = time.time() % 86400  # UTC
+    if daysago == 0 or seconds_today < HISTORIC_MARGIN:
+        return {}
+    first_day, final_day, _, _ = get_day_range(ndays, daysago)
+    max_age = int(86400 - seconds_today)
+    return {
+        "etag": _get_etag(first_day, final_day, *params),
+        "cache-control": f"public, max-age={max_age}, immutable",
+    }
+
+
+def get_live_cache_headers(ndays, daysago, *params):
+    """Get the caching headers for a response that includes today. The
+    params must include something that changes when the data changes.
+    """
+    first_day, final_day, _, _ = get_day_range(ndays, daysago)
+    return {
+        "etag": _get_etag(first_day, final_day, *params),
+        "cache-control": "no-cache",
+    }
+
+
+def get_quickstats(collector):
+    """Get a dict with (formatted) stats for the dashboard home page."""
+    quickstats = {"system-uptime": _uptime()}
+
+    # Add system measurements
+    for name, group, key in [
+        ("system-cpu", "system", "cpu|num|%"),
+        ("system-mem", "system", "mem|num|iB"),
+        ("system-disk", "system", "disk|num|iB"),
+        ("system-connections", "traefik", "open connections|num"),
+        ("system-rtime", "traefik", "duration|num|s"),
+    ]:
+        v = collector.get_latest_value(group, key)
+        if v is not None:
+            if key.endswith("|iB"):
+                v = f"{v/2**30:0.3f} GiB" if "disk" in key else f"{v/2**20:0.1f} MiB"
+            elif key.endswith("|%"):
+                v = f"{v:0.1f} %"
+            elif key.endswith("|s"):
+                v = f"{1000*v:0.1f} ms"
+            else:
+                v = str(v)
+        quickstats[name] = v
+
+    # Add measurements for each group
+    for group in collector.get_groups():
+        quickstats[group + "-cpu"] = quickstats[group + "-mem"] = ""
+        cpu = collector.get_latest_value(group, "cpu|num|%")
+        mem = collector.get_latest_value(group, "mem|num|iB")
+        if cpu is not None:
+            quickstats[group + "-cpu"] = f"{cpu:0.1f} %"
+            if mem is not None:
+                quickstats[group + "-mem"] = f"{mem/2**20:0.1f} MiB"
+
+    return quickstats
+
+
+class StatsPublisher:
+    """Object that publishes live stats. It keeps a pre-encoded snapshot
+    of the quickstats, and of the current aggregation of the groups that
+    stream subscribers are interested in. While there is demand, a
+    background task updates these once per second and wakes up all
+    subscribers, so that any number of clients can be served cheaply.
+    """
+
+    def __init__(self, collector):
+        self._collector = collector
+        self._task = None
+        self._last_demand = 0
+        self._snapshot_time = 0
+        self._etag = ""
+        self._body = b""
+        self._subscribers = asgineer.RequestSet()
+        self._group_subscriptions = {}  # group -> number of subscribers
+        self._group_messages = {}  # group -> pre-encoded SSE message
+
+    def _ensure_running(self):
+        self._last_demand = time.time()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def get_snapshot(self):
+        """Get the (etag, body) of the most recent quickstats snapshot."""
+        self._ensure_running()
+        if time.time() - self._snapshot_time > 1.5:
+            self._update()  # first time, or the task stalled
+        return self._etag, self._body
+
+    def subscribe(self, request, groups):
+        """Subscribe the request to receive updates for the given groups."""
+        self._subscribers.add(request)
+        for group in groups:
+            count = self._group_subscriptions.get(group, 0)
+            self._group_subscriptions[group] = count + 1
+        self._ensure_running()
+        self._update()
+
+    def unsubscribe(self, request, groups):
+        """Undo subscribe()."""
+        self._subscribers.discard(request)
+        for group in groups:
+            count = self._group_subscriptions.get(group, 0) - 1
+            if count > 0:
+                self._group_subscriptions[group] = count
+            else:
+                self._group_subscriptions.pop(group, None)
+                self._group_messages.pop(group, None)
+
+    def get_messages(self, groups):
+        """Get the SSE messages (bytes) for the most recent update."""
+        messages = [b"event: quickstats\ndata: " + self._body + b"\n\n"]
+        for group in groups:
+            messages.append(self._group_messages.get(group, b""))
+        return b"".join(messages)
+
+    def _update(self):
+        body = json.dumps(get_quickstats(self._collector)).encode()
+        self._snapshot_time = time.time()
+        self._etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        self._body = body
+        for group in list(self._group_subscriptions):
+            aggr = self._collector.get_current_aggr(group)
+            if aggr is not None:
+                data = json.dumps({"group": group, "aggr": aggr}).encode()
+                self._group_messages[group] = b"event: aggr\ndata: " + data + b"\n\n"
+
+    async def _run(self):
+        # Stop when there are no subscribers and nobody asked for a
+        # snapshot for a while.
+        while len(self._subscribers) or time.time() - self._last_demand < 10:
+            try:
+                self._update()
+            except Exception as err:  # pragma: no cover
+                logger.error("Failed to update live stats: " + str(err))
+            for request in list(self._subscribers):
+                await request.wakeup()
+            await asyncio.sleep(1)
+
+
+_stats_publishers = weakref.WeakKeyDictionary()
+
+
+def get_stats_publisher(collector):
+    """Get the StatsPublisher for the given collector."""
+    try:
+        return _stats_publishers[collector]
+    except KeyError:
+        publisher = StatsPublisher(collector)
+        _stats_publishers[collector] = publisher
+        return publisher
+
+
+_metrics_exporters = weakref.WeakKeyDictionary()
+
+
+def get_metrics_exporter(collector):
+    """Get the MetricsExporter for the given collector."""
+    try:
+        return _metrics_exporters[collector]
+    except KeyError:
+        exporter = MetricsExporter(collector)
+        _metrics_exporters[collector] = exporter
+        return exporter
+
+
+async def stream_stats(request, collector, groups):
+    """Stream live stats using server side events (SSE). Each second,
+    the quickstats and the current aggregation of the given groups are
+    sent. Stops when the client disconnects.
+    """
+    publisher = get_stats_publisher(collector)
+    headers = {"content-type": "text/event-stream", "cache-control": "no-cache"}
+    await request.accept(200, headers)
+    publisher.subscribe(request, groups)
+    try:
+        while True:
+            await request.send(publisher.get_messages(groups))
+            await request.sleep_while_connected(10)
+    except IOError:  # incl. asgineer.DisconnectedError
+        pass
+    finally:
+        publisher.unsubscribe(request, groups)
+
+
+def get_sparklines(collector):
+    """Get the recent cpu and memory values of each group, from the
+    in-memory ring buffers of the collector (no database access).
+    """
+    sparklines = {}
+    for group in collector.get_groups():
+        cpu = collector.get_recent_values(group, "cpu|num|%")
+        mem = collector.get_recent_values(group, "mem|num|iB")
+        if cpu is None and mem is None:
+            continue
+        d = sparklines[group] = {}
+        if cpu is not None:
+            d["cpu"] = [None if v is None else round(v, 1) for v in cpu]
+        if mem is not None:
+            d["mem"] = [None if v is None else round(v / 2**20, 1) for v in mem]
+    return sparklines
+
+
 def get_system_info():
     info = {
         "server name": str(platform.node()),
@@ -234,23 +676,63 @@ MAIN_HTML_TEMPLATE = """
 <body>
 
 <script>
+var show_quickstats = function (data) {
+    for (key in data) {
+        var el = document.getElementById(key);
+        if (el) { el.innerHTML = data[key]; }
+        if (key.startsWith('system-')) {
+            el = document.getElementById("_" + key);
+            if (el) { el.innerHTML = data[key]; }
+        }
+    }
+};
 var statgetter = function () {
     fetch('/quickstats')
+        .then(function(response) {
+            return response.json();
+        }).then(show_quickstats);
+    setTimeout(statgetter, 1000);
+};
+if (window.EventSource) {
+    var source = new EventSource('/statstream');
+    source.addEventListener('quickstats', function (e) {
+        show_quickstats(JSON.parse(e.data));
+    });
+} else {
+    setTimeout(statgetter, 10);
+}
+
+var sparkline = function (values, max, color) {
+    var points = [];
+    for (var i = 0; i < values.length; i++) {
+        if (values[i] === null) { continue; }
+        var y = 15 - 14 * Math.min(1, values[i] / max);
+        points.push((100 * i / (values.length - 1)).toFixed(1) + "," + y.toFixed(1));
+    }
+    return "<polyline fill='none' stroke='" + color + "' points='" + points.join(" ") + "' />";
+};
+var sparkgetter = function () {
+    fetch('/sparklines')
         .then(function(response) {
             return response.json();
         }).then(function(data) {
-            for (key in data) {
-                var el = document.getElementById(key);
-                if (el) { el.innerHTML = data[key]; }
-                if (key.startsWith('system-')) {
-                    el = document.getElementById("_" + key);
-                    if (el) { el.innerHTML = data[key]; }
+            for (group in data) {
+                var el = document.getElementById(group + "-spark");
+                if (!el) { continue; }
+                var svg = "<svg width='100' height='16' class='sparkline'>";
+                if (data[group].mem) {
+                    var mem = data[group].mem.filter(function (v) { return v !== null; });
+                    svg += sparkline(data[group].mem, Math.max.apply(null, mem.concat([1])), "#fa5");
+                }
+                if (data[group].cpu) {
+                    svg += sparkline(data[group].cpu, 100, "#5af");
                 }
+                el.innerHTML = svg + "</svg>";
             }
         });
-    setTimeout(statgetter, 1000);
+    setTimeout(sparkgetter, 5000);
 };
-setTimeout(statgetter, 10);
+setTimeout(sparkgetter, 10);
 </script>
 
 <h1>MyPaas dashboard</h1>
@@ -297,7 +779,8 @@ STATSVIEW_HTML_TEMPLATE = """
 <script>
 var text_color = "#BBB";
 var info = {INFO};
-var data_per_db = {DATA_PER_DB};
+var keys_per_db = {KEYS_PER_DB};
+var current_per_db = {CURRENT_PER_DB};
 var ndays = {NDAYS};
 var daysago = {DAYSAGO};
 </script>
@@ -0,0 +1,449 @@
+"""
+A client for the Docker Engine API, talking directly to the Docker daemon
+over its Unix socket. This avoids starting a docker subprocess for each
+call, and makes it possible to subscribe to Docker events. Connections
+are kept alive and reused.
+"""
+
+import io
+import os
+import re
+import json
+import socket
+import tarfile
+import threading
+import http.client
+from urllib.parse import urlencode, quote
+
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+MAX_IDLE_CONNECTIONS = 4
+
+
+def get_docker_socket():
+    """Get the path of the Docker socket, taking DOCKER_HOST into account."""
+    host = os.getenv("DOCKER_HOST", "")
+    if host.startswith("unix://"):
+        return host.split("://", 1)[1]
+    return DOCKER_SOCKET
+
+
+_default_client = None
+
+
+def get_docker_client():
+    """Get the shared DockerClient, so that its connections are reused."""
+    global _default_client
+    socket_path = get_docker_socket()
+    if _default_client is None or _default_client.socket_path != socket_path:
+        _default_client = DockerClient(socket_path)
+    return _default_client
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a Unix socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._socket_path)
+        self.sock = sock
+
+
+class DockerClient:
+    """Client for the Docker Engine API. Errors are raised as RuntimeError,
+    like dockercall() does. Methods that have a fail_ok argument return
+    None instead of raising when Docker reports an error.
+
+    This object can be used from multiple threads. Each request uses an
+    idle connection if there is one; streaming requests (like events and
+    builds) use their own connection.
+    """
+
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=60):
+        self.socket_path = socket_path
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle_connections = []
+
+    def _get_url(self, path, query):
+        if query:
+            return path + "?" + urlencode(query)
+        return path
+
+    def _check_response(self, response, data, fail_ok=False):
+        if response.status < 400:
+            return True
+        elif fail_ok:
+            return False
+        try:
+            message = json.loads(data.decode())["message"]
+        except Exception:
+            message = data.decode(errors="ignore").strip()
+        raise RuntimeError(f"Docker API error {response.status}: {message}")
+
+    def _request(self, method, url, body, headers):
+        # Try an idle connection first. If Docker has closed it in the mean
+        # time, the request fails before it reaches Docker, so we can retry.
+        while True:
+            with self._lock:
+                conn = self._idle_connections.pop() if self._idle_connections else None
+            reused = conn is not None
+            if conn is None:
+                conn = _UnixHTTPConnection(self.socket_path, self._timeout)
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            with self._lock:
+                n_idle = len(self._idle_connections)
+                if response.will_close or n_idle >= MAX_IDLE_CONNECTIONS:
+                    conn.close()
+                else:
+                    self._idle_connections.append(conn)
+            return response, data
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            connections, self._idle_connections = self._idle_connections, []
+        for conn in connections:
+            conn.close()
+
+    def request(self, method, path, query=None, body=None, fail_ok=False):
+        """Do a request and return the decoded JSON response (None if the
+        response is empty, or if it failed and fail_ok is True).
+        """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["content-type"] = "application/json"
+        url = self._get_url(path, query)
+        response, data = self._request(method, url, body, headers)
+        if not self._check_response(response, data, fail_ok):
+            return None
+        return json.loads(data.decode()) if data.strip() else None
+
+    def stream(self, method, path, query=None, body=None, headers=None):
+        """Generator that yields the JSON objects produced by a streaming
+        endpoint (one per line), e.g. /events. Blocks until objects become
+        available, and ends when the Docker daemon closes the connection.
+        """
+        conn = _UnixHTTPConnection(self.socket_path, None)
+        try:
+            conn.request(method, self._get_url(path, query), body, headers or {})
+            response = conn.getresponse()
+            if response.status >= 400:
+                self._check_response(response, response.read())
+            for line in iter(response.readline, b""):
+                if line.strip():
+                    yield json.loads(line.decode())
+        finally:
+            conn.close()
+
+    # %% Containers
+
+    def list_containers(self, all=False):
+        """Get a list of dicts (as produced by Docker) for the containers."""
+        return self.request("GET", "/containers/json", {"all": int(bool(all))})
+
+    def inspect_container(self, id):
+        """Get the dict with details of the container with the given id/name."""
+        return self.request("GET", f"/containers/{quote(id)}/json")
+
+    def create_container(self, name, config):
+        """Create a container and return its id."""
+        query = {"name": name} if name else None
+        return self.request("POST", "/containers/create", query, config)["Id"]
+
+    def run_container(self, args):
+        """Create and start a container, given the arguments for 'docker run'.
+        Returns the id of the container.
+        """
+        name, config = parse_run_args(args)
+        id = self.create_container(name, config)
+        self.start_container(id)
+        return id
+
+    def start_container(self, id, fail_ok=False):
+        """Start the container with the given id/name."""
+        path = f"/containers/{quote(id)}/start"
+        return self.request("POST", path, fail_ok=fail_ok)
+
+    def stop_container(self, id, fail_ok=False):
+        """Stop the container with the given id/name."""
+        path = f"/containers/{quote(id)}/stop"
+        return self.request("POST", path, fail_ok=fail_ok)
+
+    def rename_container(self, id, name, fail_ok=False):
+        """Rename the container with the given id/name."""
+        path = f"/containers/{quote(id)}/rename"
+        return self.request("POST", path, {"name": name}, fail_ok=fail_ok)
+
+    def remove_container(self, id, force=False, fail_ok=False):
+        """Remove the container with the given id/name."""
+        path = f"/containers/{quote(id)}"
+        query = {"force": "true"} if force else None
+        return self.request("DELETE", path, query, fail_ok=fail_ok)
+
+    def prune_containers(self):
+        """Remove all stopped containers."""
+        return self.request("POST", "/containers/prune")
+
+    # %% Images and networks
+
+    def build_image(self, context_dir, tag, pull=False, log=None):
+        """Build an image from the given directory (which must contain a
+        Dockerfile). If log is given, it is called with each line of the
+        build output, as it comes in.
+        """
+        for line in self.iter_build_image(context_dir, tag, pull):
+            if log is not None:
+                log(line)
+
+    def iter_build_image(self, context_dir, tag, pull=False):
+        """Generator that builds an image (like build_image()), yielding
+        the lines of the build output as they come in.
+        """
+        query = {"t": tag, "rm": "1"}
+        if pull:
+            query["pull"] = "1"
+        context = make_build_context(context_dir)
+        headers = {"content-type": "application/x-tar"}
+        lines = []
+        for ob in self.stream("POST", "/build", query, context, headers):
+            if ob.get("error"):
+                tail = "\n".join(lines[-20:])
+                raise RuntimeError(f"{tail}\nDocker build failed: {ob['error']}")
+            for line in ob.get("stream", "").splitlines():
+                if line.strip():
+                    lines.append(line.rstrip())
+                    yield line.rstrip()
+
+    def pull_image(self, image):
+        """Pull the given image (name:tag) from the registry."""
+        name, _, tag = image.partition(":")
+        query = {"fromImage": name, "tag": tag or "latest"}
+        for ob in self.stream("POST", "/images/create", query):
+            if ob.get("error"):
+                raise RuntimeError(f"Docker pull failed: {ob['error']}")
+
+    def prune_images(self):
+        """Remove dangling images."""
+        return self.request("POST", "/images/prune")
+
+    def create_network(self, name, fail_ok=False):
+        """Create a network with the given name."""
+        body = {"Name": name, "CheckDuplicate": True}
+        return self.request("POST", "/networks/create", body=body, fail_ok=fail_ok)
+
+    # %% Events
+
+    def events(self, since=None, filters=None):
+        """Generator that yields Docker events."""
+        query = {}
+        if since is not None:
+            query["since"] = str(since)
+        if filters:
+            query["filters"] = json.dumps(filters)
+        return self.stream("GET", "/events", query)
+
+
+def parse_memory(value):
+    """Convert a memory size like "512m" or "2g" into a number of bytes."""
+    m = re.match(r"^([0-9.]+)\s*([kmgt]?)i?b?$", value.strip().lower())
+    if not m:
+        raise ValueError(f"Invalid memory size: {value!r}")
+    return int(float(m.group(1)) * 1024 ** " kmgt".index(m.group(2) or " "))
+
+
+def parse_run_args(args):
+    """Convert the arguments for 'docker run' (as used by MyPaas) into a
+    (name, config) tuple for the create-container API call.
+    """
+    name = ""
+    config = {"Labels": {}, "Env": [], "ExposedPorts": {}}
+    host_config = config["HostConfig"] = {"Binds": [], "PortBindings": {}}
+    image_and_cmd = []
+    for arg in args:
+        if image_and_cmd or not arg.startswith("-"):
+            image_and_cmd.append(arg)
+            continue
+        key, sep, value = arg.partition("=")
+        if key in ("-d", "--detach"):
+            continue
+        elif not sep:
+            raise ValueError(f"Docker run argument must be --key=value: {arg}")
+        elif key == "--name":
+            name = value
+        elif key in ("--label", "-l"):
+            k, _, v = value.partition("=")
+            config["Labels"][k] = v
+        elif key in ("--env", "-e"):
+            config["Env"].append(value)
+        elif key in ("--volume", "-v"):
+            host_config["Binds"].append(value)
+        elif key in ("--publish", "-p"):
+            spec, _, protocol = value.partition("/")
+            parts = spec.split(":")
+            port = f"{parts[-1]}/{protocol or 'tcp'}"
+            binding = {
+                "HostIp": parts[-3] if len(parts) > 2 else "",
+                "HostPort": parts[-2] if len(parts) > 1 else "",
+            }
+            config["ExposedPorts"][port] = {}
+            host_config["PortBindings"].setdefault(port, []).append(binding)
+        elif key == "--network":
+            host_config["NetworkMode"] = value
+        elif key == "--restart":
+            policy, _, count = value.partition(":")
+            host_config["RestartPolicy"] = {"Name": policy}
+            if count:
+                host_config["RestartPolicy"]["MaximumRetryCount"] = int(count)
+        elif key == "--cpus":
+            host_config["NanoCpus"] = int(float(value) * 1e9)
+        elif key in ("--memory", "-m"):
+            host_config["Memory"] = parse_memory(value)
+        else:
+            raise ValueError(f"Unsupported docker run argument: {arg}")
+    if not image_and_cmd:
+        raise ValueError("Docker run arguments do not include an image.")
+    config["Image"] = image_and_cmd[0]
+    if len(image_and_cmd) > 1:
+        config["Cmd"] = image_and_cmd[1:]
+    return name, config
+
+
+def _compile_dockerignore_pattern(pattern):
+    """Compile a .dockerignore pattern to a regular expression, the way
+    Docker does: "*" and "?" do not match a slash (so they match within
+    a path segment), "**" matches any number of directories (including
+    zero), "[...]" is a character class, and "\\" escapes the next
+    character. Raises ValueError for an invalid pattern.
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*" and pattern.startswith("*", i):
+            i += 1
+            if pattern.startswith("/", i):
+                i += 1
+            regex += ".*" if i == len(pattern) else "(.*/)?"
+        elif c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "\\":
+            if i == len(pattern):
+                raise ValueError(f"Invalid .dockerignore pattern {pattern!r}")
+            regex += re.escape(pattern[i])
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 1 if pattern.startswith("^", i) else i)
+            if end < 0 or end == i or pattern[i:end] == "^":
+                raise ValueError(f"Invalid .dockerignore pattern {pattern!r}")
+            regex += "[" + pattern[i:end] + "]"
+            i = end + 1
+        else:
+            regex += re.escape(c)
+    try:
+        return re.compile(regex)
+    except re.error:
+        raise ValueError(f"Invalid .dockerignore pattern {pattern!r}")
+
+
+def _read_dockerignore(context_dir):
+    """Get a list of (pattern, regex, exclusion) tuples from the
+    .dockerignore file in the given directory.
+    """
+    try:
+        with open(os.path.join(context_dir, ".dockerignore"), "rb") as f:
+            text = f.read().decode()
+    except OSError:
+        return []
+    patterns = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exclusion = line.startswith("!")
+        if exclusion:
+            line = line[1:].strip()
+            if not line:
+                raise ValueError("Invalid .dockerignore pattern '!'")
+        pattern = os.path.normpath(line).lstrip("/")
+        if pattern:
+            regex = _compile_dockerignore_pattern(pattern)
+            patterns.append((pattern, regex, exclusion))
+    return patterns
+
+
+def _is_ignored(relpath, patterns):
+    """Get whether the given path is ignored. A pattern also matches the
+    paths inside a matching directory, and the last matching pattern wins.
+    """
+    parents = []
+    parent = os.path.dirname(relpath)
+    while parent:
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+    ignored = False
+    for pattern, regex, exclusion in patterns:
+        if exclusion != ignored:
+            continue  # this pattern cannot change the outcome
+        if regex.fullmatch(relpath) or any(regex.fullmatch(p) for p in parents):
+            ignored = not exclusion
+    return ignored
+
+
+def make_build_context(context_dir):
+    """Create a tar archive (as bytes) of the given directory, to send as
+    the build context. Files that match a pattern in .dockerignore are left
+    out, following Docker's rules (including "**" and exceptions via "!").
+    Raises ValueError if .dockerignore contains an invalid pattern.
+    """
+    patterns = _read_dockerignore(context_dir)
+    exceptions = [pattern for pattern, _, exclusion in patterns if exclusion]
+
+    def is_ignored(relpath):
+        if relpath in ("Dockerfile", ".dockerignore"):
+            return False
+        return _is_ignored(relpath, patterns)
+
+    def may_contain_exceptions(relpath):
+        # Like Docker, only walk an ignored directory if an exception
+        # pattern starts with its path
+        return any((p + "/").startswith(relpath + "/") for p in exceptions)
+
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w") as tar:
+        for dirpath, dirnames, filenames in os.walk(context_dir):
+            reldir = os.path.relpath(dirpath, context_dir)
+            for dirname in sorted(dirnames):
+                relpath = os.path.normpath(os.path.join(reldir, dirname))
+                if is_ignored(relpath):
+                    if not may_contain_exceptions(relpath):
+                        dirnames.remove(dirname)
+                else:
+                    path = os.path.join(dirpath, dirname)
+                    tar.add(path, arcname=relpath, recursive=False)
+            for fname in sorted(filenames):
+                relpath = os.path.normpath(os.path.join(reldir, fname))
+                if not is_ignored(relpath):
+                    path = os.path.join(dirpath, fname)
+                    tar.add(path, arcname=relpath, recursive=False)
+    return f.getvalue()
@@ -1,16 +1,35 @@
+import os
+import json
 import time
+import asyncio
+import tempfile
+
+import psutil
 
 import mypaas.daemon
 
 
 class SpecialSystemStatsProducer(mypaas.daemon.SystemStatsProducer):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.data = []
+        self.container_names = {}
 
     def _send(self, stat):
         self.data.append(stat)
 
+    def _get_container_names(self, ids):
+        if self.container_names is None:
+            return None  # as if Docker failed
+        return {id: name for id, name in self.container_names.items() if id in ids}
+
+
+def write_files(dirname, files):
+    os.makedirs(dirname, exist_ok=True)
+    for fname, text in files.items():
+        with open(os.path.join(dirname, fname), "wb") as f:
+            f.write(text.encode())
+
 
 def test_system_producer():
     producer = SpecialSystemStatsProducer()
@@ -27,5 +46,252 @@ def test_system_producer():
     assert 0 <= data[0]["cpu|num|%"] <= 100
 
 
+def test_system_producer_flush():
+    class BatchingSystemStatsProducer(mypaas.daemon.SystemStatsProducer):
+        def __init__(self):
+            super().__init__()
+            self.datagrams = []
+
+        def _send_datagram(self, data):
+            self.datagrams.append(data)
+
+    producer = BatchingSystemStatsProducer()
+    producer._flush()
+    assert producer.datagrams == []
+
+    # All stats of a tick go into one datagram
+    for i in range(100):
+        producer._send({"group": f"foo{i}.1", "cpu|num|%": 1.5})
+    producer._flush()
+    assert len(producer.datagrams) == 1
+    stats = json.loads(producer.datagrams[0].decode())
+    assert len(stats) == 100
+    assert stats[0] == {"group": "foo0.1", "cpu|num|%": 1.5}
+
+    # Unless it would become too large
+    producer.datagrams = []
+    for i in range(3000):
+        producer._send({"group": f"foo{i}.1", "cpu|num|%": 1.5})
+    producer._flush()
+    assert len(producer.datagrams) > 1
+    stats = []
+    for data in producer.datagrams:
+        assert len(data) <= mypaas.daemon._statsgen.MAX_DATAGRAM_SIZE
+        stats.extend(json.loads(data.decode()))
+    assert len(stats) == 3000
+
+
+def test_system_producer_cgroups():
+    root = tempfile.mkdtemp()
+    write_files(root, {"cgroup.controllers": "cpu io memory pids"})
+    id1, id2, id3 = "a" * 64, "b" * 64, "c" * 64
+    path1 = os.path.join(root, "system.slice", f"docker-{id1}.scope")
+    path2 = os.path.join(root, "system.slice", f"docker-{id2}.scope")
+    path3 = os.path.join(root, "docker", id3)
+
+    def write_cgroup(path, usage, throttled, cpu_max, rbytes, wbytes):
+        write_files(
+            path,
+            {
+                "cpu.stat": f"usage_usec {usage}\nthrottled_usec {throttled}\n",
+                "cpu.max": f"{cpu_max} 100000\n",
+                "memory.current": "3000\n",
+                "memory.stat": "anon 1000\ninactive_file 1000\n",
+                "io.stat": f"8:0 rbytes={rbytes} wbytes={wbytes} rios=1 wios=1\n",
+                "cgroup.procs": f"{os.getpid()}\n",
+            },
+        )
+
+    write_cgroup(path1, 0, 0, "max", 0, 0)
+    write_cgroup(path2, 0, 0, "50000", 0, 0)
+    write_cgroup(path3, 0, 0, "max", 0, 0)
+
+    producer = SpecialSystemStatsProducer(cgroup_root=root)
+    assert producer._use_cgroups
+    # When Docker cannot be queried, the names are not cached
+    producer.container_names = None
+    producer._collect_services()
+    assert producer._service_cgroups == {}
+    # Two containers of the same service (e.g. during a roll), and one other
+    producer.container_names = {id1: "foo.1", id2: "foo.1", id3: "bar"}
+    producer._collect_services()
+    assert sorted(producer._service_cgroups) == ["bar", "foo.1"]
+    assert len(producer._service_cgroups["foo.1"]) == 2
+
+    # First measurement has no cpu yet
+    producer._measure_stats_of_services()
+    producer._measure_io_of_services()
+    stats = {stat["group"]: stat for stat in producer.data}
+    assert stats["foo.1"] == {"group": "foo.1", "mem|num|iB": 4000}
+    assert stats["bar"] == {"group": "bar", "mem|num|iB": 2000}
+
+    # Use 0.1 s of cpu time in each container, over about 0.2 s
+    time.sleep(0.2)
+    write_cgroup(path1, 100000, 0, "max", 1000, 10)
+    write_cgroup(path2, 100000, 50000, "50000", 1000, 10)
+    write_cgroup(path3, 100000, 0, "max", 0, 0)
+    producer.data = []
+    producer._measure_stats_of_services()
+    producer._measure_io_of_services()
+    stats = {}
+    for stat in producer.data:
+        stats.setdefault(stat["group"], {}).update(stat)
+    assert 80 < stats["foo.1"]["cpu|num|%"] <= 100
+    assert 40 < stats["bar"]["cpu|num|%"] <= 50
+    assert 20 < stats["foo.1"]["throttled|num|%"] <= 25
+    assert "throttled|num|%" not in stats["bar"]
+    assert stats["foo.1"]["io_read|count|iB"] == 2000
+    assert stats["foo.1"]["io_write|count|iB"] == 20
+    assert stats["bar"]["io_read|count|iB"] == 0
+
+    # Startups are detected from the processes in the cgroup (this one)
+    create_time = psutil.Process().create_time()
+    assert producer._get_create_times() == {"foo.1": create_time, "bar": create_time}
+
+    # When a container is gone, it is no longer measured
+    os.rename(path3, path3 + "x")
+    producer._collect_services()
+    assert sorted(producer._service_cgroups) == ["foo.1"]
+
+
+class StubDockerClient:
+    def __init__(self, containers):
+        self.containers = containers  # id -> dict as produced by inspect
+        self.event_list = []
+        self.ninspects = 0
+
+    def list_containers(self, all=False):
+        return [{"Id": id} for id in self.containers]
+
+    def inspect_container(self, id):
+        self.ninspects += 1
+        if id not in self.containers:
+            raise RuntimeError("No such container")
+        return self.containers[id]
+
+    def events(self, since=None, filters=None):
+        return iter(self.event_list)
+
+
+def make_container(id, name, running=True, labels=None, env=None):
+    return {
+        "Id": id,
+        "Name": "/" + name,
+        "Config": {"Labels": labels or {}, "Env": env or []},
+        "State": {
+            "Status": "running" if running else "exited",
+            "Running": running,
+            "Pid": 42 if running else 0,
+            "StartedAt": "2020-03-04T05:06:07.123456789Z",
+        },
+    }
+
+
+def test_container_registry():
+    root = tempfile.mkdtemp()
+    id1, id2, id3 = "a" * 64, "b" * 64, "c" * 64
+    os.makedirs(os.path.join(root, "system.slice", f"docker-{id1}.scope"))
+    client = StubDockerClient(
+        {
+            id1: make_container(id1, "foo.1", labels={"mypaas.container": "foo.1"}),
+            id2: make_container(id2, "bar", env=["MYPAAS_CONTAINER=bar"]),
+            id3: make_container(id3, "old", running=False),
+        }
+    )
+    registry = mypaas.daemon.ContainerRegistry(client, cgroup_root=root)
+    assert not registry.is_synced()
+
+    registry._sync_all()
+    assert registry.is_synced()
+    infos = {info["name"]: info for info in registry.get_containers()}
+    assert sorted(infos) == ["bar", "foo.1"]
+    assert len(registry.get_containers(running=False)) == 3
+    assert infos["foo.1"]["mypaas_container"] == "foo.1"
+    assert infos["bar"]["mypaas_container"] == "bar"
+    assert infos["foo.1"]["pid"] == 42
+    assert infos["foo.1"]["cgroup"].endswith(f"docker-{id1}.scope")
+    assert infos["bar"]["cgroup"] is None
+
+    # The registry is updated via events, ignoring e.g. exec events
+    client.containers[id3] = make_container(id3, "old")
+    del client.containers[id2]
+    client.event_list = [
+        {"Type": "container", "Action": "exec_start: sh", "Actor": {"ID": id1}},
+        {"Type": "container", "Action": "start", "Actor": {"ID": id3}},
+        {"Type": "container", "Action": "destroy", "Actor": {"ID": id2}},
+    ]
+    ninspects = client.ninspects
+    registry._follow_events()
+    assert client.ninspects == ninspects + 2 + 1  # sync all + one event
+    infos = {info["name"]: info for info in registry.get_containers()}
+    assert sorted(infos) == ["foo.1", "old"]
+
+    # The stats producer uses the registry
+    write_files(root, {"cgroup.controllers": "cpu io memory pids"})
+    producer = SpecialSystemStatsProducer(cgroup_root=root, registry=registry)
+    producer._collect_services()
+    assert list(producer._service_cgroups) == ["foo.1"]
+
+
+def test_deploy_queue():
+    from mypaas.daemon import _api
+
+    log = []
+
+    def fake_deploy_generator(deploy_dir):
+        name = os.path.basename(deploy_dir)
+        log.append(("start", name))
+        for i in range(3):
+            time.sleep(0.2)  # blocking, like a docker build
+            yield f"step {i}"
+        log.append(("end", name))
+
+    async def push(service_name, name):
+        deploy_dir = os.path.join(tempfile.mkdtemp(), name)
+        os.mkdir(deploy_dir)
+        lines = []
+        gen = _api.queued_deploy_generator(service_name, "fp", deploy_dir)
+        async for line in gen:
+            lines.append(line)
+        assert not os.path.isdir(deploy_dir)
+        return "".join(lines)
+
+    ticks = []
+
+    async def tick():
+        for i in range(20):
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    async def main():
+        return await asyncio.gather(
+            push("foo", "foo1"), push("foo", "foo2"), push("bar", "bar1"), tick()
+        )
+
+    ori_deploy_generator = _api.get_deploy_generator
+    _api.get_deploy_generator = fake_deploy_generator
+    try:
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(main())
+        loop.close()
+    finally:
+        _api.get_deploy_generator = ori_deploy_generator
+
+    # Deploys of the same service are done one after the other
+    assert log.index(("end", "foo1")) < log.index(("start", "foo2"))
+    assert "Position in queue: 1" in results[1]
+    assert "step 2" in results[1]
+    # Deploys of other services are not held up
+    assert log.index(("start", "bar1")) < log.index(("end", "foo1"))
+    assert "queue" not in results[0] and "queue" not in results[2]
+    assert not _api.deploy_queues
+    # The event loop is not blocked by the deploys
+    assert max(t2 - t1 for t1, t2 in zip(ticks[:-1], ticks[1:])) < 0.1
+
+
 if __name__ == "__main__":
     test_system_producer()
+    test_system_producer_flush()
+    test_system_producer_cgroups()
+    test_container_registry()
+    test_deploy_queue()
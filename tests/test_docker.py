@@ -0,0 +1,685 @@
+"""
+Tests for the Docker Engine API client, and for deploying with it, using
+a fake Docker daemon that runs on a Unix socket.
+"""
+
+import io
+import os
+import json
+import time
+import tarfile
+import contextlib
+import tempfile
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+from testutils import run_tests
+from mypaas.utils import DockerClient
+from mypaas.utils._docker import parse_run_args, make_build_context
+import mypaas.server._deploy
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """Handles requests like the Docker Engine API, for the subset that
+    MyPaas uses. The state is kept on the server object.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.nconnections += 1
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def send_json(self, status, ob):
+        body = json.dumps(ob).encode() if ob is not None else b""
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, obs):
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+        for ob in obs:
+            line = json.dumps(ob).encode() + b"\r\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        n = int(self.headers.get("content-length", "0"))
+        body = self.rfile.read(n) if n else b""
+        server = self.server
+        with server.lock:
+            server.requests.append((method, url.path))
+            try:
+                result = self.get_response(method, parts, query, body)
+            except KeyError as err:
+                result = 404, {"message": f"No such container: {err}"}
+        if result[0] == "stream":
+            self.send_stream(result[1])
+        else:
+            self.send_json(*result)
+        if server.drop_connections:
+            self.close_connection = True  # without telling the client
+
+    def get_response(self, method, parts, query, body):
+        server = self.server
+        containers = server.containers
+        if parts[0] == "containers" and len(parts) == 2:
+            if parts[1] == "json":
+                all = query.get("all", "0") == "1"
+                return 200, [
+                    {"Id": id, "Names": ["/" + c["name"]], "Labels": c["labels"]}
+                    for id, c in containers.items()
+                    if c["running"] or all
+                ]
+            elif parts[1] == "create":
+                config = json.loads(body.decode())
+                name = query.get("name", "")
+                if any(c["name"] == name for c in containers.values()):
+                    return 409, {"message": f"Conflict: {name} is in use"}
+                id = server.add_container(name, config["Labels"], False)
+                containers[id]["config"] = config
+                return 201, {"Id": id}
+            elif parts[1] == "prune":
+                for id in [id for id, c in containers.items() if not c["running"]]:
+                    containers.pop(id)
+                return 200, {"ContainersDeleted": []}
+            elif method == "DELETE":
+                id = server.get_id(parts[1])
+                if containers[id]["running"] and query.get("force") != "true":
+                    return 409, {"message": "You cannot remove a running container"}
+                containers.pop(id)
+                return 204, None
+        elif parts[0] == "containers" and len(parts) == 3:
+            id = server.get_id(parts[1])
+            c = containers[id]
+            if parts[2] == "json":
+                state = {
+                    "Running": c["running"],
+                    "Restarting": False,
+                    "StartedAt": "2020-03-04T05:06:07.123456789Z",
+                }
+                if server.health:
+                    state["Health"] = {"Status": server.health}
+                ip = "10.0.0.%i" % (list(containers).index(id) + 2)
+                networks = {"mypaas-net": {"IPAddress": ip if c["running"] else ""}}
+                return 200, {
+                    "Id": id,
+                    "Name": "/" + c["name"],
+                    "State": state,
+                    "NetworkSettings": {"Networks": networks},
+                }
+            elif parts[2] == "start":
+                c["running"] = True
+                server.log_running()
+                return 204, None
+            elif parts[2] == "stop":
+                c["running"] = False
+                server.log_running()
+                return 204, None
+            elif parts[2] == "rename":
+                c["name"] = query["name"]
+                return 204, None
+        elif parts[0] == "build":
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                server.build_contexts.append(sorted(tar.getnames()))
+            return "stream", [
+                {"stream": "Step 1/2 : FROM python\n"},
+                {"stream": " ---> 123456789abc\n"},
+                {"stream": f"Successfully tagged {query['t']}:latest\n"},
+            ]
+        elif parts[0] == "images" and parts[1] == "create":
+            return "stream", [{"status": "Pulling"}, {"status": "Done"}]
+        elif parts[0] == "images" and parts[1] == "prune":
+            return 200, {"ImagesDeleted": []}
+        elif parts[0] == "networks" and parts[1] == "create":
+            return 201, {"Id": "n" * 64}
+        return 404, {"message": "page not found"}
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A fake Docker daemon, for testing and benchmarking."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, FakeDockerHandler)
+        self.lock = threading.Lock()
+        self.containers = {}  # id -> dict
+        self.requests = []
+        self.build_contexts = []
+        self.nconnections = 0
+        self.drop_connections = False
+        self.health = "healthy"  # the Docker health status of started containers
+        self.running_log = []  # number of running containers after each change
+
+    def add_container(self, name, labels=None, running=True):
+        id = os.urandom(32).hex()
+        self.containers[id] = {"name": name, "labels": labels or {}, "running": running}
+        return id
+
+    def get_id(self, id_or_name):
+        for id, c in self.containers.items():
+            if id_or_name in (id, c["name"]):
+                return id
+        raise KeyError(id_or_name)
+
+    def log_running(self):
+        self.running_log.append(sum(c["running"] for c in self.containers.values()))
+
+    def get_names(self):
+        return sorted(c["name"] for c in self.containers.values() if c["running"])
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def get_socket_path():
+    return os.path.join(tempfile.mkdtemp(), "docker.sock")
+
+
+@contextlib.contextmanager
+def fake_docker():
+    """Context manager that runs a FakeDockerServer, with DOCKER_HOST
+    pointing to it. Yields the server.
+    """
+    socket_path = get_socket_path()
+    ori_docker_host = os.environ.get("DOCKER_HOST", None)
+    os.environ["DOCKER_HOST"] = "unix://" + socket_path
+    try:
+        with FakeDockerServer(socket_path) as server:
+            yield server
+    finally:
+        if ori_docker_host is None:
+            os.environ.pop("DOCKER_HOST")
+        else:
+            os.environ["DOCKER_HOST"] = ori_docker_host
+
+
+def test_parse_run_args():
+    name, config = parse_run_args(
+        [
+            "-d",
+            "--restart=always",
+            "--cpus=1.5",
+            "--memory=512m",
+            "--network=mypaas-net",
+            "--publish=8080:80",
+            "-p=127.0.0.1:53:53/udp",
+            "--label=traefik.http.routers.foo.rule=Host(`foo.com`)",
+            "--env=FOO=bar",
+            "--volume=/data:/data",
+            "--name=foo.1",
+            "foo",
+        ]
+    )
+    assert name == "foo.1"
+    assert config["Image"] == "foo"
+    assert "Cmd" not in config
+    assert config["Labels"] == {"traefik.http.routers.foo.rule": "Host(`foo.com`)"}
+    assert config["Env"] == ["FOO=bar"]
+    assert config["ExposedPorts"] == {"80/tcp": {}, "53/udp": {}}
+    host_config = config["HostConfig"]
+    assert host_config["RestartPolicy"] == {"Name": "always"}
+    assert host_config["NanoCpus"] == 1500000000
+    assert host_config["Memory"] == 512 * 2**20
+    assert host_config["NetworkMode"] == "mypaas-net"
+    assert host_config["Binds"] == ["/data:/data"]
+    assert host_config["PortBindings"] == {
+        "80/tcp": [{"HostIp": "", "HostPort": "8080"}],
+        "53/udp": [{"HostIp": "127.0.0.1", "HostPort": "53"}],
+    }
+
+    for args in (["--foo=bar", "foo"], ["--name"], ["--name=foo"]):
+        try:
+            parse_run_args(args)
+        except ValueError:
+            pass
+        else:
+            assert False, f"Expected ValueError for {args}"
+
+
+def test_build_context():
+    dirname = tempfile.mkdtemp()
+    os.makedirs(os.path.join(dirname, "src"))
+    os.makedirs(os.path.join(dirname, "node_modules"))
+    for fname in ("Dockerfile", "src/main.py", "node_modules/x.js", "foo.log"):
+        with open(os.path.join(dirname, fname), "wb") as f:
+            f.write(b"x")
+    with open(os.path.join(dirname, ".dockerignore"), "wb") as f:
+        f.write(b"# comment\nnode_modules\n*.log\n")
+
+    with tarfile.open(fileobj=io.BytesIO(make_build_context(dirname))) as tar:
+        names = sorted(tar.getnames())
+    assert names == [".dockerignore", "Dockerfile", "src", "src/main.py"]
+
+    # Nested globs and exceptions, the last matching pattern wins
+    dirname = tempfile.mkdtemp()
+    fnames = [
+        "Dockerfile",
+        "a.tmp",
+        "foo.log",
+        "src/main.py",
+        "src/a.tmp",
+        "src/a/keep.log",
+        "src/a/b/test_x.py",
+        "build/out.bin",
+        "build/keep/y.txt",
+    ]
+    for fname in fnames:
+        os.makedirs(os.path.dirname(os.path.join(dirname, fname)), exist_ok=True)
+        with open(os.path.join(dirname, fname), "wb") as f:
+            f.write(b"x")
+    with open(os.path.join(dirname, ".dockerignore"), "wb") as f:
+        f.write(b"**/*.log\n!src/**/keep.log\n**/test_*.py\n")
+        f.write(b"build\n!/build/keep\n*/*.tmp\n")
+    with tarfile.open(fileobj=io.BytesIO(make_build_context(dirname))) as tar:
+        names = sorted(tar.getnames())
+    assert names == [
+        ".dockerignore",
+        "Dockerfile",
+        "a.tmp",
+        "build/keep",
+        "build/keep/y.txt",
+        "src",
+        "src/a",
+        "src/a/b",
+        "src/a/keep.log",
+        "src/main.py",
+    ]
+
+    # Invalid patterns are an error
+    for pattern in ("foo[", "foo\\", "[]", "!"):
+        with open(os.path.join(dirname, ".dockerignore"), "wb") as f:
+            f.write(pattern.encode())
+        try:
+            make_build_context(dirname)
+        except ValueError:
+            pass
+        else:
+            assert False, f"Expected ValueError for {pattern!r}"
+
+
+def test_docker_client():
+    socket_path = get_socket_path()
+    with FakeDockerServer(socket_path) as server:
+        client = DockerClient(socket_path)
+        id = server.add_container("foo")
+
+        # Requests reuse the connection
+        for i in range(5):
+            assert client.list_containers()[0]["Id"] == id
+        assert server.nconnections == 1
+
+        # Errors
+        try:
+            client.stop_container("bar")
+        except RuntimeError as err:
+            assert "404" in str(err) and "bar" in str(err)
+        else:
+            assert False, "Expected RuntimeError"
+        assert client.stop_container("bar", fail_ok=True) is None
+
+        # Run, rename, stop, remove
+        new_id = client.run_container(["--label=x=y", "--name=bar", "img"])
+        assert server.containers[new_id]["config"]["Labels"] == {"x": "y"}
+        assert server.get_names() == ["bar", "foo"]
+        client.rename_container("bar", "spam")
+        client.stop_container(id)
+        assert server.get_names() == ["spam"]
+        client.remove_container("spam", force=True)
+        client.prune_containers()
+        assert server.containers == {}
+
+        # The connection is re-established if Docker closed it
+        server.drop_connections = True
+        server.add_container("foo")
+        nconnections = server.nconnections
+        assert len(client.list_containers()) == 1
+        assert len(client.list_containers()) == 1
+        assert server.nconnections > nconnections
+        server.drop_connections = False
+
+        # Streaming build output
+        dirname = tempfile.mkdtemp()
+        with open(os.path.join(dirname, "Dockerfile"), "wb") as f:
+            f.write(b"FROM python\n")
+        lines = []
+        client.build_image(dirname, "foo", log=lines.append)
+        assert lines[0] == "Step 1/2 : FROM python"
+        assert lines[-1] == "Successfully tagged foo:latest"
+        assert server.build_contexts == [["Dockerfile"]]
+
+        client.pull_image("traefik:v2.1")
+        client.close()
+
+
+def make_deploy_dir(service_name, scale, *options):
+    deploy_dir = tempfile.mkdtemp()
+    with open(os.path.join(deploy_dir, "Dockerfile"), "wb") as f:
+        f.write(f"# mypaas.service={service_name}\n".encode())
+        f.write(b"# mypaas.url=https://foo.example.com\n")
+        f.write(f"# mypaas.scale={scale}\n".encode())
+        for option in options:
+            f.write(f"# mypaas.{option}\n".encode())
+        f.write(b"FROM python\n")
+    return deploy_dir
+
+
+def run_deploy(deploy_dir):
+    # Deploy without the pauses that give the containers time to boot
+    ori_sleep = mypaas.server._deploy.time.sleep
+    mypaas.server._deploy.time.sleep = lambda t: None
+    try:
+        return list(mypaas.server._deploy.get_deploy_generator(deploy_dir))
+    finally:
+        mypaas.server._deploy.time.sleep = ori_sleep
+
+
+def test_deploy():
+    with fake_docker() as server:
+        server.add_container("other")
+        server.add_container("foo.1")
+        server.add_container("foo.2")
+
+        steps = run_deploy(make_deploy_dir("foo", 3))
+        assert steps[-1] == "done deploying foo"
+        assert server.get_names() == ["foo.1", "foo.2", "foo.3", "other"]
+        # The build output is part of the steps
+        i = steps.index("building image")
+        assert steps[i + 1] == "    Step 1/2 : FROM python"
+        id = server.get_id("foo.3")
+        config = server.containers[id]["config"]
+        assert config["Image"] == "foo"
+        assert "MYPAAS_CONTAINER=foo.3" in config["Env"]
+        assert config["Labels"]["mypaas.container"] == "foo.3"
+        assert config["HostConfig"]["NetworkMode"] == "mypaas-net"
+
+        # Images are pruned, but not when another deploy is in progress.
+        # Containers are never pruned, each deploy removes its own.
+        prunes = [path for method, path in server.requests if "prune" in path]
+        assert len(prunes) == 1 and prunes[0].endswith("/images/prune")
+        assert "pruned images" in steps
+        mypaas.server._deploy._deploys_in_progress += 1
+        try:
+            steps = run_deploy(make_deploy_dir("foo", 3))
+        finally:
+            mypaas.server._deploy._deploys_in_progress -= 1
+        assert "not pruning images, 1 other deploy(s) in progress" in steps
+        prunes = [path for method, path in server.requests if "prune" in path]
+        assert len(prunes) == 1
+        assert mypaas.server._deploy._deploys_in_progress == 0
+
+
+def test_deploy_roll():
+    with fake_docker() as server:
+        for i in range(3):
+            server.add_container(f"foo.{i + 1}")
+
+        # With the default maxsurge=1, maxunavailable=0, old containers are
+        # only stopped after a new one is ready, and one at a time.
+        steps = run_deploy(make_deploy_dir("foo", 3))
+        assert steps[-1] == "done deploying foo"
+        assert min(server.running_log) == 3
+        assert max(server.running_log) == 4
+        assert server.get_names() == ["foo.1", "foo.2", "foo.3"]
+
+        # With a larger surge, all new containers are started first
+        server.running_log = []
+        run_deploy(make_deploy_dir("foo", 3, "maxsurge=3"))
+        assert min(server.running_log) == 3
+        assert max(server.running_log) == 6
+
+        # With maxunavailable, the old containers are stopped first
+        server.running_log = []
+        run_deploy(make_deploy_dir("foo", 3, "maxsurge=0", "maxunavailable=3"))
+        assert min(server.running_log) == 0
+        assert max(server.running_log) == 3
+
+        # Must be able to make progress
+        try:
+            run_deploy(make_deploy_dir("foo", 3, "maxsurge=0"))
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected ValueError"
+
+        # When a new container is not healthy, the old ones are restored
+        server.health = "unhealthy"
+        ids = set(server.containers)
+        try:
+            run_deploy(make_deploy_dir("foo", 3))
+        except RuntimeError as err:
+            assert "failed to start" in str(err)
+        else:
+            assert False, "Expected RuntimeError"
+        assert set(server.containers) == ids
+        assert server.get_names() == ["foo.1", "foo.2", "foo.3"]
+
+        # When the new containers do not become ready in time, too
+        server.health = "starting"
+        try:
+            run_deploy(make_deploy_dir("foo", 2, "deploytimeout=10ms"))
+        except RuntimeError as err:
+            assert "Deploy timeout" in str(err)
+        else:
+            assert False, "Expected RuntimeError"
+        assert set(server.containers) == ids
+        assert server.get_names() == ["foo.1", "foo.2", "foo.3"]
+
+
+def test_drain():
+    import socket
+    import mypaas.server._drain
+    from mypaas.server._drain import set_drain_routes, get_drain_routes
+    from mypaas.server._drain import count_connections, clear_stale_drain_routes
+
+    routes_dir = tempfile.mkdtemp()
+    ori_routes_dir = mypaas.server._drain.ROUTES_DIR
+    mypaas.server._drain.ROUTES_DIR = routes_dir
+    original = "[http.routers.foo]\n  rule = 'Host(`foo.com`)'\n"
+    with open(os.path.join(routes_dir, "staticroutes.toml"), "wb") as f:
+        f.write(original.encode())
+
+    labels = {
+        "traefik.http.routers.foo-router.rule": "Host(`foo.com`)",
+        "traefik.http.routers.foo-router.entrypoints": "web-secure",
+        "traefik.http.routers.foo-router.tls.certresolver": "default",
+    }
+    toml = get_drain_routes("foo-service", labels, ["http://10.0.0.3:80"])
+    assert "[http.routers.foo-router-drain]" in toml
+    assert 'rule = "Host(`foo.com`)"' in toml
+    assert 'entrypoints = ["web-secure"]' in toml
+    assert 'certresolver = "default"' in toml
+    assert 'url = "http://10.0.0.3:80"' in toml
+    # No servers means that Traefik responds with 503
+    assert "url" not in get_drain_routes("foo-service", labels, [])
+
+    try:
+        # Set, replace and clear the routes, each service has its own file
+        set_drain_routes("foo-service", toml)
+        set_drain_routes("bar-service", "# bar\n")
+        set_drain_routes("foo-service", toml.replace("10.0.0.3", "10.0.0.4"))
+        assert sorted(os.listdir(routes_dir)) == [
+            "drain-bar-service.toml",
+            "drain-foo-service.toml",
+            "staticroutes.toml",
+        ]
+        with open(os.path.join(routes_dir, "drain-foo-service.toml"), "rb") as f:
+            text = f.read().decode()
+        assert text.count("foo-router-drain]") == 1 and "10.0.0.4" in text
+        set_drain_routes("foo-service", "")
+        assert "drain-foo-service.toml" not in os.listdir(routes_dir)
+        # Stale drain routes are removed, e.g. when the daemon starts
+        clear_stale_drain_routes()
+        assert os.listdir(routes_dir) == ["staticroutes.toml"]
+
+        # Deploy with draining, in the three ways
+        with fake_docker() as server:
+            server.add_container("foo", {"traefik.enable": "true"})
+            steps = run_deploy(make_deploy_dir("foo", 0, "drain=10s"))
+            assert "drained foo in 0.0s" in steps
+            server.containers.clear()  # bar uses the same url
+            for i in range(2):
+                server.add_container(f"bar.{i + 1}")
+            for scale in ("2 safe", "2"):
+                steps = run_deploy(make_deploy_dir("bar", scale, "drain=10s"))
+                assert steps[-1] == "done deploying bar"
+                assert len([s for s in steps if s.startswith("drained")]) == (
+                    1 if "safe" in scale else 2
+                )
+                assert server.get_names() == ["bar.1", "bar.2"]
+            # A deploy removes stale drain routes of its service
+            set_drain_routes("bar-service", "# stale\n")
+            run_deploy(make_deploy_dir("bar", 2))
+        assert os.listdir(routes_dir) == ["staticroutes.toml"]
+        with open(os.path.join(routes_dir, "staticroutes.toml"), "rb") as f:
+            assert f.read().decode() == original
+    finally:
+        mypaas.server._drain.ROUTES_DIR = ori_routes_dir
+
+    # Count connections via /proc
+    server_sock = socket.socket()
+    server_sock.bind(("127.0.0.1", 0))
+    server_sock.listen(4)
+    port = server_sock.getsockname()[1]
+    clients = [socket.create_connection(("127.0.0.1", port)) for i in range(3)]
+    conns = [server_sock.accept()[0] for i in range(3)]
+    try:
+        assert count_connections(os.getpid(), port) == 3
+        # Connections with a pending request are counted too
+        clients[0].sendall(b"x")
+        assert count_connections(os.getpid(), port) == 3
+        # Closed connections are not
+        for sock in (clients[1], conns[1]):
+            sock.close()
+        time.sleep(0.05)
+        assert count_connections(os.getpid(), port) == 2
+        assert count_connections(0, port) == 0  # no such process
+    finally:
+        for sock in clients + conns + [server_sock]:
+            sock.close()
+
+
+def test_build_limit():
+    from mypaas.server._deploy import build_image
+
+    lock = threading.Lock()
+    builds = {"current": 0, "max": 0}
+
+    class SlowDockerClient:
+        def iter_build_image(self, deploy_dir, image_name, pull=False):
+            with lock:
+                builds["current"] += 1
+                builds["max"] = max(builds["max"], builds["current"])
+            time.sleep(0.1)
+            yield "Successfully built"
+            with lock:
+                builds["current"] -= 1
+
+    steps = []
+
+    def build(i):
+        for step in build_image(SlowDockerClient(), "", f"foo{i}", False, 2):
+            steps.append(step)
+
+    threads = [threading.Thread(target=build, args=(i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert builds["max"] == 2
+    assert steps.count("building image") == 5
+    assert any(step.startswith("waiting for one of 2 builds") for step in steps)
+
+
+def test_get_service_name():
+    from mypaas.server import get_service_name
+
+    assert get_service_name(make_deploy_dir("foo", 1)) == "foo"
+    assert get_service_name(make_deploy_dir("foo bar", 1)) == "foo-bar"
+    deploy_dir = tempfile.mkdtemp()
+    with open(os.path.join(deploy_dir, "Dockerfile"), "wb") as f:
+        f.write(b"# mypaas.scale=1\nFROM python\nRUN echo mypaas.service=foo\n")
+    assert get_service_name(deploy_dir) == ""
+
+
+def test_check_url():
+    import http.server
+    from mypaas.server._deploy import check_url, parse_duration
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            ok = self.path in ("/status", "/status?full=1")
+            self.send_response(200 if ok else 500)
+            self.send_header("content-length", "0")
+            self.end_headers()
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        assert check_url(url + "/status", 2)
+        assert check_url(url + "/status?full=1", 2)
+        assert not check_url(url + "/status?full=0", 2)
+        assert not check_url(url + "/other", 2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not check_url(url + "/status", 2)  # not running
+
+    assert parse_duration("500ms") == 0.5
+    assert parse_duration("10s") == 10
+    assert parse_duration("5m") == 300
+    assert parse_duration("1h") == 3600
+    assert parse_duration("42") == 42
+
+
+def test_deploy_speed():
+    # Benchmark the overhead of orchestrating a deploy (without the pauses)
+    with fake_docker() as server:
+        deploy_dir = make_deploy_dir("foo", 8)
+        n = 10
+        t0 = time.perf_counter()
+        for i in range(n):
+            run_deploy(deploy_dir)
+        t1 = time.perf_counter()
+        assert len(server.get_names()) == 8
+    nrequests = len(server.requests) / n
+    print(
+        f"Deploy with scale 8: {nrequests:0.0f} Docker API requests "
+        f"in {(t1 - t0) * 1000 / n:0.1f} ms, over {server.nconnections} connections."
+    )
+
+
+if __name__ == "__main__":
+    run_tests(globals())
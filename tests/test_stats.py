@@ -1,17 +1,33 @@
 import os
 import gc
+import sys
 import time
+import gzip
 import json
 import random
+import shutil
+import struct
+import asyncio
 import tempfile
+import subprocess
 import statistics as st
 
 from testutils import run_tests
 import asgineer.testutils
 
+import mypaas.stats.server
+import mypaas.stats.replay
 import mypaas.stats.collector
 from mypaas.stats import Monitor
 from mypaas.stats.collector import StatsCollector
+from mypaas.stats.recent import RecentValues
+from mypaas.stats.capture import DatagramWriter, read_datagrams
+from mypaas.stats.capture import get_capture_filenames
+from mypaas.stats.columns import to_columns, encode_binary, decode_binary
+from mypaas.stats.downsample import lttb, minmax, downsample_aggregations
+from mypaas.stats import compression, clientjs
+from mypaas.stats.metrics import MetricsExporter
+from mypaas.stats.compression import select_encoding, compress_response
 from mypaas.stats.monitor import _monitor_instances, std_from_welford
 
 from pytest import raises
@@ -103,6 +119,31 @@ def test_monitor_no_writes_when_empty():
     assert os.path.isfile(filename)
 
 
+def test_monitor_lazy_ids():
+    clean_db()
+
+    m = Monitor(filename)
+    assert not m._ids_loaded
+    with m:
+        m.put("foo|count")
+    assert not m._ids_loaded
+    with m:
+        assert m.put("visits|dcount", 42)
+        assert m.put("visits|mcount", 42)
+    assert m._ids_loaded
+    m.flush()
+
+    # A new monitor only loads the ids when it needs them
+    m = Monitor(filename)
+    assert not m._ids_loaded
+    assert m.get_memory_usage() > 0
+    with m:
+        assert not m.put("visits|dcount", 42)
+        assert not m.put("visits|mcount", 42)
+        assert m.put("visits|dcount", 43)
+    assert m._ids_loaded
+
+
 def test_monitor_welford():
     """Test that numeric measuremens indeed produce correct mean and std.
     The monitor uses the Welford algorithm, we thus test whether we
@@ -301,6 +342,113 @@ def test_udp_receiver():
     assert data[4] == ("spam", {"foo|num": 3, "bar|count": 2})
 
 
+def test_receiver_batch():
+    class StubCollector:
+        def __init__(self):
+            self.data = []
+
+        def put_many(self, group, stats_list):
+            self.data.append((group, stats_list))
+
+    collector = StubCollector()
+    receiver = mypaas.stats.UdpStatsReceiver(collector)
+
+    lines = [
+        '{"group": "spam", "foo|num": 3}',
+        "traefik.service.requests.total count=32 ",
+        "",
+        "foo:2|c",
+        "{invalid json",
+        '{"group": "spam", "bar|count": 2}',
+    ]
+    assert receiver.process_batch(lines) == 4
+
+    data = dict(collector.data)
+    assert len(collector.data) == 3
+    assert data["spam"] == [{"foo|num": 3}, {"bar|count": 2}]
+    assert data["traefik"] == [{"requests|count": 32}]
+    assert data["other"] == [{"foo|count": 2}]
+
+    # A malformed key does not affect the other groups in the batch
+    clean_db()
+    collector = StatsCollector(db_dir)
+    receiver = mypaas.stats.UdpStatsReceiver(collector)
+    lines = ['{"group": "aaa", "foo": 3}', '{"group": "bbb", "bar|count": 2}']
+    assert receiver.process_batch(lines) == 2
+    assert collector.get_current_aggr("bbb")["bar|count"] == 2
+
+
+def test_receiver_data_list():
+    class StubCollector:
+        def __init__(self):
+            self.data = []
+
+        def put_many(self, group, stats_list):
+            self.data.append((group, stats_list))
+
+    collector = StubCollector()
+    receiver = mypaas.stats.UdpStatsReceiver(collector)
+
+    receiver.process_data(
+        '[{"group": "system", "cpu|num|%": 3}, {"group": "foo.1", "mem|num|iB": 4},'
+        ' {"group": "system", "disk|num|iB": 5}, {"mem|num|iB": 6}, 7]'
+    )
+    data = dict(collector.data)
+    assert len(collector.data) == 3
+    assert data["system"] == [{"cpu|num|%": 3}, {"disk|num|iB": 5}]
+    assert data["foo.1"] == [{"mem|num|iB": 4}]
+    assert data["other"] == [{"mem|num|iB": 6}]
+
+    # A malformed key does not affect the other groups in the datagram
+    clean_db()
+    collector = StatsCollector(db_dir)
+    receiver = mypaas.stats.UdpStatsReceiver(collector)
+    receiver.process_data(
+        '[{"group": "aaa", "foo": 3}, {"group": "bbb", "x|count": 2}]'
+    )
+    assert collector.get_current_aggr("bbb")["x|count"] == 2
+
+
+def test_ingest():
+    clean_db()
+
+    collector = StatsCollector(db_dir)
+    receiver = mypaas.stats.UdpStatsReceiver(collector)
+
+    class StubRequest:
+        def __init__(self, chunks, client="127.0.0.1", headers=None):
+            self.scope = {"client": (client, 50000)}
+            self.headers = headers or {}
+            self._chunks = chunks
+
+        async def iter_body(self):
+            for chunk in self._chunks:
+                yield chunk
+
+    def ingest(*args, **kwargs):
+        co = mypaas.stats.server.ingest(StubRequest(*args, **kwargs), receiver)
+        return asyncio.new_event_loop().run_until_complete(co)
+
+    # Lines can be split over chunks
+    chunks = [b'{"group": "aa", "foo|co', b'unt": 2}\n{"group": "aa", "foo|count": 3}']
+    status, _, body = ingest(chunks)
+    assert status == 200 and body == {"accepted": 2}
+    assert collector._monitors["aa"].get_current_aggr()["foo|count"] == 5
+
+    # Only from the internal network
+    assert ingest(chunks, client="8.8.8.8")[0] == 403
+    assert ingest(chunks, headers={"x-forwarded-for": "1.2.3.4"})[0] == 403
+    assert ingest(chunks, client="10.0.0.4")[0] == 200
+
+    # Via the main handler; the mock server's client is not a valid ip
+    async def main_handler(request):
+        return await mypaas.stats.stats_handler(request, collector, receiver)
+
+    with asgineer.testutils.MockTestServer(main_handler) as server:
+        assert server.request("POST", "/ingest", b"foo:1|c").status == 403
+        assert server.request("GET", "/ingest").status == 405
+
+
 def test_receiver_process_speed():
     # Some notes:
     # * We don't actually count the overhead of UDP, though that should be small.
@@ -340,6 +488,92 @@ def test_receiver_process_speed():
         assert stats_per_second > 10000
 
 
+def test_receiver_daemon_speed():
+    # Compare processing the daemon's measurements of 100 containers
+    # as one datagram per container vs one datagram per tick.
+
+    clean_db()
+
+    is_pytest = "PYTEST_CURRENT_TEST" in os.environ
+    collector = StatsCollector(db_dir)
+    receiver = mypaas.stats.UdpStatsReceiver(collector)
+
+    ncontainers = 100
+    n = 10 if is_pytest else 100
+    stats = [
+        {"group": f"service{i}.1", "cpu|num|%": 1.5, "mem|num|iB": 123456789}
+        for i in range(ncontainers)
+    ]
+    datagrams = [json.dumps(stat) for stat in stats]
+    datagram = json.dumps(stats)
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        for data in datagrams:
+            receiver.process_data(data)
+    t1 = time.perf_counter()
+    for i in range(n):
+        receiver.process_data(datagram)
+    t2 = time.perf_counter()
+
+    assert collector.get_current_aggr("service0.1")["mem|num|iB"]["n"] == 2 * n
+    print(
+        f"{ncontainers} containers: {(t1 - t0) * 1000000 / n:0.0f}us per tick"
+        f" unbatched, {(t2 - t1) * 1000000 / n:0.0f}us per tick batched."
+    )
+
+
+def test_capture_and_replay():
+    clean_db()
+
+    capture_filename = os.path.join(db_dir, "capture.bin")
+    writer = DatagramWriter(capture_filename, max_bytes=1000, backup_count=2)
+
+    t = time.time()
+    for i in range(40):
+        writer.write(t + i * 0.001, b'{"group": "aa", "foo|count": 2, "bar|num": 3}')
+    writer.write(t + 1, b"traefik.service.requests.total count=32 ")
+    writer.write(t + 1, b"{not json")
+    writer.close()
+
+    # The file was rotated, and only two backups are kept
+    assert os.path.isfile(capture_filename + ".1")
+    assert os.path.isfile(capture_filename + ".2")
+    assert not os.path.isfile(capture_filename + ".3")
+
+    records = list(read_datagrams(capture_filename))
+    assert records[-1][1] == b"{not json"
+    assert records[-2] == (t + 1, b"traefik.service.requests.total count=32 ")
+
+    # A truncated record is ignored
+    with open(capture_filename, "ab") as f:
+        f.write(b"\x00\x01\x02")
+    assert list(read_datagrams(capture_filename)) == records
+
+    # The backups are replayed too, oldest first
+    filenames = get_capture_filenames(capture_filename)
+    assert filenames == [capture_filename + ".2", capture_filename + ".1"] + [
+        capture_filename
+    ]
+    all_records = [r for fname in filenames for r in read_datagrams(fname)]
+    assert len(all_records) == 42
+    assert [r[0] for r in all_records] == sorted(r[0] for r in all_records)
+
+    # The datagrams are in the file as soon as they are written
+    writer = DatagramWriter(capture_filename + "_live")
+    writer.write(t, b"foo:1|c")
+    assert list(read_datagrams(capture_filename + "_live")) == [(t, b"foo:1|c")]
+    writer.close()
+
+    tempdirs = set(os.listdir(tempfile.gettempdir()))
+    result = mypaas.stats.replay.replay(capture_filename, speed=0)
+    assert result["packets"] == len(all_records)
+    assert result["errors"] == 1  # the invalid json
+    assert result["mismatches"] == {}
+    # The temporary database is removed
+    assert set(os.listdir(tempfile.gettempdir())) == tempdirs
+
+
 # %% Collector
 
 
@@ -366,6 +600,13 @@ def test_collector():
     # "system" comes first, then alphabetically
     assert collector.get_groups() == ("system", "aa", "bb", "zz")
 
+    # The result is cached until a group is added
+    assert collector.get_groups() is collector.get_groups()
+    collector.put("other", {"foo|num": 3})
+    assert collector.get_groups() == ("system", "aa", "bb", "zz", "other")
+    collector.put("daemon", {"foo|num": 3})
+    assert collector.get_groups()[:2] == ("system", "daemon")
+
     # Stop it
     for m in _monitor_instances:
         m.flush()
@@ -375,7 +616,107 @@ def test_collector():
 
     # The files are still there, and the collector picks them up
     collector = StatsCollector(db_dir)
-    assert collector.get_groups() == ("system", "aa", "bb", "zz")
+    assert collector.get_groups() == ("system", "daemon", "aa", "bb", "zz", "other")
+
+
+def test_collector_evicts_idle_monitors():
+    clean_db()
+
+    collector = StatsCollector(db_dir, idle_timeout=0.2)
+    collector.put("aa", {"foo|count": 2, "cpu|num|%": 3})
+    collector.put("bb", {"foo|count": 1})
+    assert collector.evict_idle_monitors() == []
+
+    usage = collector.get_memory_usage()
+    assert set(usage.keys()) == {"aa", "bb"}
+    assert all(nbytes > 0 for nbytes in usage.values())
+
+    time.sleep(0.3)
+    collector.put("bb", {"foo|count": 1})
+    assert collector.evict_idle_monitors() == ["aa"]
+    assert set(collector._monitors.keys()) == {"bb"}
+    assert set(collector.get_memory_usage().keys()) == {"bb"}
+
+    # The group is still known, and its data was written to disk
+    assert "aa" in collector.get_groups()
+    time.sleep(0.2)  # Give helper thread time to process
+    units = collector.get_data(["aa"], 1, 0)["aa"]
+    assert sum(unit.get("foo|count", 0) for unit in units) == 2
+
+    # Eviction hands the write to the helper thread. A monitor that is
+    # re-created right away restores the daily ids after that write.
+    collector.put("cc", {"visits|dcount": "id1"})
+    collector._last_active["cc"] = 0
+    assert "cc" in collector.evict_idle_monitors()
+    collector.put("cc", {"visits|dcount": "id1"})
+    collector.close()
+    units = collector.get_data(["cc"], 1, 0)["cc"]
+    assert sum(unit.get("visits|dcount", 0) for unit in units) == 1
+
+
+def test_collector_evicts_concurrently():
+    import threading
+
+    clean_db()
+
+    # Put data in one thread (with pauses so that the monitor is evicted
+    # and re-created), while another thread evicts
+    collector = StatsCollector(db_dir, idle_timeout=0.1)
+    stop = False
+    nputs = 0
+
+    def evict():
+        while not stop:
+            collector.evict_idle_monitors()
+            time.sleep(0.001)
+
+    t = threading.Thread(target=evict)
+    t.start()
+    try:
+        for burst in range(4):
+            for i in range(200):
+                collector.put("aa", {"foo|count": 1})
+                nputs += 1
+            time.sleep(0.15)
+    finally:
+        stop = True
+        t.join()
+    collector.close()
+
+    units = collector.get_data(["aa"], 1, 0)["aa"]
+    assert sum(unit.get("foo|count", 0) for unit in units) == nputs
+
+
+def test_recent_values():
+    recent = RecentValues(10)
+
+    assert recent.get_latest("aa", "foo|num") == (0, None)
+    assert recent.get_series("aa", "foo|num", 1000) is None
+
+    recent.put("aa", "foo|num", 3, 1000.2)
+    recent.put("aa", "foo|num", 4, 1000.7)  # same second, overwrites
+    recent.put("aa", "foo|num", 5, 1002.1)
+    recent.put("aa", "bar|cat", "x", 1002.1)
+
+    assert recent.get_latest("aa", "foo|num") == (1002.1, 5)
+    assert recent.get_latest("aa", "bar|cat") == (1002.1, "x")
+    assert recent.get_series("aa", "bar|cat", 1002) is None
+
+    series = recent.get_series("aa", "foo|num", 1002)
+    assert len(series) == 10
+    assert series[-3:] == [4, None, 5]
+    assert series[:-3] == [None] * 7
+
+    # Old values drop out of the ring buffer
+    series = recent.get_series("aa", "foo|num", 1011)
+    assert series == [5] + [None] * 9
+    assert recent.get_series("aa", "foo|num", 1012) == [None] * 10
+
+    # Keys are interned tuples
+    recent.put("a" + "a", "spam" + "|num", 1, 1000)
+    keys = [k for k in recent._entries if k[1] == "spam|num"]
+    assert keys[0][0] is sys.intern("aa")
+    assert keys[0][1] is sys.intern("spam|num")
 
 
 def test_collector_aggr():
@@ -423,7 +764,7 @@ def test_collector_aggr():
     assert foo_num == 2
 
     # And if we look at this on a higher scale, the bins should merge
-    units = collector.get_data(["aa"], 14, 0)["aa"]
+    units = collector.get_data(["aa"], 14, 0, max_points=14)["aa"]
     foo_sum = sum(unit.get("foo|count", 0) for unit in units)
     foo_max = max(unit.get("foo|count", 0) for unit in units)
     foo_num = sum("foo|count" in unit for unit in units)
@@ -432,9 +773,480 @@ def test_collector_aggr():
     assert foo_num == 1
 
 
+def test_collector_resolution():
+    get_bucket = mypaas.stats.collector.get_bucket
+    get_resolution = mypaas.stats.collector.get_resolution
+    MONTH = mypaas.stats.collector.MONTH  # noqa: N806
+
+    # Resolution is chosen to stay below max_points
+    day = 86400
+    assert get_resolution(0, day, 300) == 600
+    assert get_resolution(0, 3 * day, 300) == 1800
+    assert get_resolution(0, 3 * day, 72) == 3600
+    assert get_resolution(0, 30 * day, 300) == 6 * 3600
+    assert get_resolution(0, 30 * day, 30) == day
+    assert get_resolution(0, 300 * day, 100) == MONTH
+    assert get_resolution(0, 3000 * day, 10) == MONTH
+
+    # Buckets are in UTC epoch time
+    t = 1600000000  # 2020-09-13 12:26:40 UTC
+    assert get_bucket(t, 600) == t - 400
+    assert get_bucket(t + 0.5, 3600) == t - 1600
+    assert get_bucket(t, day) == t - 12 * 3600 - 1600
+    assert time.gmtime(get_bucket(t, MONTH))[:6] == (2020, 9, 1, 0, 0, 0)
+
+    # The collector produces aggregations per bucket, with a matching time_key
+    clean_db()
+    collector = StatsCollector(db_dir)
+    monitor = collector._get_monitor("aa")
+    for i in range(4):
+        earlier = time.time() - (i + 1) * 600
+        monitor._current_aggr["time_start"] = earlier
+        monitor._current_aggr["time_key"] = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.gmtime(earlier // 600 * 600)
+        )
+        collector.put_one("aa", "foo|count", 1)
+        monitor.flush()
+    collector.put_one("aa", "foo|count", 1)
+    units = collector.get_data(["aa"], 2, 0)["aa"][1:-1]
+    assert collector.get_resolution(2, 0) == 600
+    assert sum(unit["foo|count"] for unit in units) == 5
+    assert len(units) == 5
+    for unit in units:
+        bucket = get_bucket(unit["time_start"], 600)
+        assert unit["time_key"] == time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.gmtime(bucket)
+        )
+    units = collector.get_data(["aa"], 2, 0, max_points=2)["aa"][1:-1]
+    assert collector.get_resolution(2, 0, 2) == day
+    assert sum(unit["foo|count"] for unit in units) == 5
+    assert 1 <= len(units) <= 2  # just after midnight there are two days
+    assert all(unit["time_key"].endswith(" 00:00:00") for unit in units)
+
+
+def test_collector_key_data():
+    clean_db()
+
+    collector = StatsCollector(db_dir)
+    collector.put("aa", {"foo|count": 2, "bar|num": 3})
+    monitor = collector._monitors["aa"]
+    monitor.flush()
+    collector.put("aa", {"foo|count": 1})
+
+    assert collector.get_keys("aa", 1, 0) == ["bar|num", "foo|count"]
+
+    # Only the aggregations with the key, plus the stubs
+    data = collector.get_key_data("aa", "foo|count", 1, 0)
+    assert [aggr["time_key"] for aggr in data[:1] + data[-1:]] == ["x", "x"]
+    assert sum(aggr.get("foo|count", 0) for aggr in data) == 3
+    assert all("bar|num" not in aggr for aggr in data)
+    data = collector.get_key_data("aa", "foo|count", 1, 0, False)
+    assert sum(aggr.get("foo|count", 0) for aggr in data) == 2
+
+    # The rollup from the db is cached, until the monitor writes
+    collector.get_data(["aa"], 1, 0)
+    assert len(collector._rollups) == 1
+    rollup1 = list(collector._rollups.values())[0][2]
+    collector.get_data(["aa"], 1, 0)
+    assert list(collector._rollups.values())[0][2] is rollup1
+    monitor.flush()
+    data = collector.get_key_data("aa", "foo|count", 1, 0, False)
+    assert sum(aggr.get("foo|count", 0) for aggr in data) == 3
+    assert list(collector._rollups.values())[0][2] is not rollup1
+
+    # The cached data is not modified by merging the current aggr
+    collector.put("aa", {"foo|count": 4})
+    for i in range(2):
+        data = collector.get_key_data("aa", "foo|count", 1, 0)
+        assert sum(aggr.get("foo|count", 0) for aggr in data) == 7
+
+
+def test_collector_cat_summary():
+    clean_db()
+
+    collector = StatsCollector(db_dir)
+    for value in "aaaabbbccd":
+        collector.put("aa", {"foo|cat": value})
+    collector._monitors["aa"].flush()
+    collector.put("aa", {"foo|cat": "d"})
+    collector.put("aa", {"foo|cat": "e"})
+
+    summary = collector.get_cat_summary("aa", "foo|cat", 1, 0, top=2)
+    assert summary["total"] == 12
+    assert summary["top"] == [["a", 4], ["b", 3]]
+    assert summary["other"] == 5 and summary["nother"] == 3
+    assert summary["t1"] < summary["t2"]
+
+    summary = collector.get_cat_summary("aa", "foo|cat", 1, 0, False, top=10)
+    assert summary["total"] == 10
+    assert summary["top"][-1] == ["d", 1]
+    assert summary["other"] == summary["nother"] == 0
+
+    # It uses the same (cached) rollup as get_keys()
+    collector._rollups.clear()
+    collector.get_keys("aa", 1, 0)
+    rollup = list(collector._rollups.values())[0][2]
+    collector.get_cat_summary("aa", "foo|cat", 1, 0)
+    assert len(collector._rollups) == 1
+    assert list(collector._rollups.values())[0][2] is rollup
+
+    summary = collector.get_cat_summary("nope", "foo|cat", 1, 0)
+    assert summary["total"] == 0 and summary["top"] == []
+
+
+def test_collector_delta():
+    clean_db()
+
+    collector = StatsCollector(db_dir)
+    collector.put("aa", {"foo|count": 2})
+    collector._monitors["aa"].flush()
+    collector.put("aa", {"foo|count": 1})
+
+    # Take the data that a client would have (without the current aggr)
+    data = collector.get_data(["aa"], 1, 0, False)["aa"]
+    last_time_key = data[-2]["time_key"]
+
+    # The last block is included, because it may have changed
+    delta = collector.get_delta("aa", 1, 0, 600, last_time_key)
+    assert delta[0]["time_key"] == last_time_key
+    assert sum(aggr.get("foo|count", 0) for aggr in delta) == 3
+    delta = collector.get_delta("aa", 1, 0, 600, last_time_key, False)
+    assert sum(aggr.get("foo|count", 0) for aggr in delta) == 2
+
+    # Only the newer blocks, and the current one
+    delta = collector.get_delta("aa", 1, 0, 600, "9999")
+    assert sum(aggr.get("foo|count", 0) for aggr in delta) == 1
+    assert collector.get_delta("aa", 1, 0, 600, "9999", False) == []
+
+    # The rollup is shared with get_data()
+    assert len(collector._rollups) == 1
+
+    with raises(ValueError):
+        collector.get_delta("aa", 1, 0, 601, "")
+
+
+def test_columns():
+    data = [
+        {"time_key": "x", "time_start": 100, "time_stop": 100},
+        {"time_key": "2020-01-01", "time_start": 110, "time_stop": 120, "a|count": 3},
+        {"time_key": "2020-01-02", "time_start": 120, "time_stop": 130},
+        {"time_key": "2020-01-03", "time_start": 130, "time_stop": 140, "a|count": 4},
+        {"time_key": "x", "time_start": 200, "time_stop": 200},
+    ]
+    columns = to_columns(data, "a|count")
+    assert columns["t1"] == 100 and columns["t2"] == 200
+    assert "time_key" not in columns  # the client derives these
+    assert columns["time_start"] == [110, 130]
+    assert columns["count"] == [3, 4]
+    assert decode_binary(encode_binary(columns)) == columns
+    # The times are integers, in uint32 arrays after the float64 arrays
+    assert columns["arrays"] == ["count", "time_start", "time_stop"]
+    assert columns["int_arrays"] == ["time_start", "time_stop"]
+    bb = encode_binary(columns)
+    assert bb[-16:] == struct.pack("<4I", 110, 130, 120, 140)
+    assert all(isinstance(t, int) for t in decode_binary(bb)["time_stop"])
+
+    num = {"min": 1.0, "max": 3.0, "n": 2, "mean": 2.0, "magic": 2.0}
+    data[3]["b|num"] = num
+    columns = to_columns(data, "b|num")
+    assert columns["arrays"] == list(num) + ["time_start", "time_stop"]
+    assert [columns[field][0] for field in num] == list(num.values())
+    bb = encode_binary(columns)
+    assert decode_binary(bb) == columns
+
+    # Categorical data can only be json
+    data[1]["c|cat"] = {"foo": 3}
+    columns = to_columns(data, "c|cat")
+    assert columns["cat"] == [{"foo": 3}]
+    assert columns["arrays"] == ["time_start", "time_stop"]
+    with raises(ValueError):
+        encode_binary(columns)
+
+    assert to_columns([], "a|count")["time_start"] == []
+
+
+def test_downsample():
+    # LTTB keeps the first, last, and the spikes
+    xs = list(range(100))
+    ys = [1.0] * 100
+    ys[37] = 9.0
+    indices = lttb(xs, ys, 10)
+    assert len(indices) == 10
+    assert indices[0] == 0 and indices[-1] == 99
+    assert 37 in indices
+    assert indices == sorted(indices)
+    assert lttb(xs, ys, 200) == xs
+    assert lttb(xs, ys, 2) == [0, 99]
+
+    # Minmax keeps the lowest min and highest max of each bucket
+    mins = [1.0] * 100
+    mins[12] = -5.0
+    indices = minmax(mins, ys, 10)
+    assert len(indices) <= 12
+    assert 0 in indices and 12 in indices and 37 in indices
+    assert indices[-1] == 99  # the last (partial) block is always kept
+    assert minmax(mins, ys, 3)[-1] == 99
+
+    # Downsampling aggregations keeps the time range and the spikes in max
+    def num(v):
+        return {"min": v, "max": v, "n": 1, "mean": v, "magic": 0.0}
+
+    data = [{"time_key": "x", "time_start": 0, "time_stop": 0}]
+    for i, v in enumerate(ys):
+        aggr = {"time_key": str(i), "time_start": 10 * i, "time_stop": 10 * i + 10}
+        aggr["a|num"] = num(v)
+        data.append(aggr)
+    data.append({"time_key": "x", "time_start": 1000, "time_stop": 1000})
+    for method in ("lttb", "minmax"):
+        result = downsample_aggregations(data, "a|num", 10, method)
+        assert len(result) <= 14
+        assert result[0] is data[0] and result[-1] is data[-1]
+        blocks = result[1:-1]
+        assert blocks[0]["time_start"] == 0 and blocks[-1]["time_stop"] == 1000
+        assert blocks[-1]["time_start"] == data[-2]["time_start"]
+        for b1, b2 in zip(blocks[:-1], blocks[1:]):
+            assert b1["time_stop"] == b2["time_start"]
+        assert max(b["a|num"]["max"] for b in blocks) == 9.0
+    assert downsample_aggregations(data, "a|num", 200) is data
+    with raises(ValueError):
+        downsample_aggregations(data, "a|num", 10, "foo")
+
+
+def test_compression():
+    assert select_encoding("") == ""
+    assert select_encoding("gzip, deflate") == "gzip"
+    assert select_encoding("deflate, gzip;q=0") == ""
+    assert select_encoding("gzip, br") == ("br" if compression.brotli else "gzip")
+
+    class StubRequest:
+        def __init__(self, accept_encoding):
+            self.headers = {"accept-encoding": accept_encoding}
+
+    body = "<html>" + "x" * 1000 + "</html>"
+    request = StubRequest("gzip")
+    status, headers, bb = compress_response(request, 200, {}, body)
+    assert headers["content-encoding"] == "gzip"
+    assert headers["content-type"] == "text/html"
+    assert headers["vary"] == "accept-encoding"
+    assert gzip.decompress(bb) == body.encode()
+
+    # Dicts become json, small bodies are not compressed
+    status, headers, bb = compress_response(request, 200, {}, {"foo": 3})
+    assert bb == b'{"foo": 3}'
+    assert headers["content-type"] == "application/json"
+    assert "content-encoding" not in headers
+
+    # Only if the client accepts it, and only for 200
+    response = compress_response(StubRequest(""), 200, {}, body)
+    assert "content-encoding" not in response[1]
+    assert compress_response(request, 404, {}, body) == (404, {}, body)
+
+    # Etags are weak, because the variants share them, also for 304
+    headers = {"etag": '"abc"'}
+    for status in (200, 304):
+        response = compress_response(request, status, headers, body)
+        assert response[1]["etag"] == 'W/"abc"'
+        assert response[1]["vary"] == "accept-encoding"
+    assert headers == {"etag": '"abc"'}
+    request.headers["if-none-match"] = 'W/"abc"'
+    compression.normalize_if_none_match(request)
+    assert request.headers["if-none-match"] == '"abc"'
+
+    # Only the compressed bodies of static assets are cached
+    compression._compress_cached.cache_clear()
+    compress_response(request, 200, {}, body + "y")
+    assert compression._compress_cached.cache_info().currsize == 0
+    compress_response(request, 200, {}, body + "y", cache=True)
+    assert compression._compress_cached.cache_info().currsize == 1
+
+
+def test_metrics():
+    clean_db()
+
+    collector = StatsCollector(db_dir)
+    collector.put("aaa", {"requests|count": 3, "cpu|num|%": 2, "x-y|dcount": "id1"})
+    collector.put("aaa", {"cpu|num|%": 4, "ua|cat": "firefox"})
+    collector.put('b"b', {"requests|count": 1})
+
+    exporter = MetricsExporter(collector)
+    text = exporter.get_text()
+    lines = text.splitlines()
+    assert text.endswith("# EOF\n")
+    assert "# TYPE mypaas_requests counter" in lines
+    assert 'mypaas_requests_total{group="aaa"} 3' in lines
+    assert 'mypaas_requests_total{group="b\\"b"} 1' in lines
+    assert 'mypaas_x_y_dcount_total{group="aaa"} 1' in lines
+    assert "# TYPE mypaas_cpu_percent summary" in lines
+    assert "# UNIT mypaas_cpu_percent percent" in lines
+    assert 'mypaas_cpu_percent_count{group="aaa"} 2' in lines
+    assert 'mypaas_cpu_percent_sum{group="aaa"} 6' in lines
+    assert 'mypaas_cpu_min_percent{group="aaa"} 2' in lines
+    assert 'mypaas_cpu_max_percent{group="aaa"} 4' in lines
+    assert 'mypaas_cpu_last_percent{group="aaa"} 4' in lines
+    assert "ua" not in text
+    # Families are not interleaved
+    assert lines.count("# TYPE mypaas_requests counter") == 1
+    i = lines.index("# TYPE mypaas_requests counter")
+    assert lines[i + 1].startswith("mypaas_requests_total")
+    assert lines[i + 3].startswith("mypaas_requests_total")
+
+    # Groups that did not change are not re-generated
+    families = exporter._cache['b"b'][3]
+    collector.put("aaa", {"requests|count": 1})
+    text = exporter.get_text()
+    assert 'mypaas_requests_total{group="aaa"} 4' in text
+    assert exporter._cache['b"b'][3] is families
+
+    # A name clash between types is resolved with a type suffix
+    collector.put("ccc", {"cpu_min_percent|count": 1})
+    lines = exporter.get_text().splitlines()
+    assert "# TYPE mypaas_cpu_min_percent counter" in lines
+    assert 'mypaas_cpu_min_percent_total{group="ccc"} 1' in lines
+    assert "# TYPE mypaas_cpu_min_gauge_percent gauge" in lines
+    assert "# UNIT mypaas_cpu_min_gauge_percent percent" in lines
+    assert 'mypaas_cpu_min_gauge_percent{group="aaa"} 2' in lines
+
+
 # %% Server
 
 
+def test_client_js_cache():
+    cache_dir = tempfile.mkdtemp()
+    transpiled = []
+    ori_transpile = clientjs.transpile
+    clientjs.transpile = lambda: transpiled.append(1) or ori_transpile()
+    try:
+        js1 = clientjs.load_client_js(cache_dir)
+        assert len(transpiled) == 1
+        filenames = os.listdir(cache_dir)
+        assert filenames == [f"client_{clientjs.get_source_hash()}.js"]
+        # The second time, it's read from the cache
+        js2 = clientjs.load_client_js(cache_dir)
+        assert len(transpiled) == 1
+        assert js1 == js2 == mypaas.stats.server.JS
+    finally:
+        clientjs.transpile = ori_transpile
+
+
+# A minimal DOM, so that the panel classes can run in Node
+PANELS_HARNESS = """
+var urls = [];
+function Node() {
+    this.classList = {add: function () {}, remove: function () {}};
+    this.appendChild = function () {};
+    this.clientWidth = 400;
+}
+var document = {createElement: function () { return new Node(); }};
+var window = {
+    ndays: 1, daysago: 0, info: {}, encodeURIComponent: encodeURIComponent,
+    addEventListener: function () {},
+    fetch: function (url) { urls.push(url); return new Promise(function () {}); },
+};
+var current_per_db = {};
+"""
+
+
+def test_client_panels():
+    if not shutil.which("node"):
+        print("Skipping test_client_panels: node is not available")
+        return
+    js = PANELS_HARNESS + clientjs.transpile()
+    js += """
+    var panel = new CategoricalPanel(new Node(), "db", "foo|cat", "foo", "");
+    panel.load();
+    panel.loading = false;
+    panel.data = {};
+    panel.apply_delta("", []);
+    new InfoPanel(new Node(), "db", "info", "system info", "").load();
+    console.log(JSON.stringify(urls));
+    """
+    p = subprocess.run(["node", "-e", js], stdout=subprocess.PIPE, check=True)
+    urls = json.loads(p.stdout.decode())
+    # Categorical panels load their summary, and reload it on a delta
+    assert len(urls) == 2
+    assert all(url.startswith("/api/cat?") for url in urls)
+    assert "&key=foo%7Ccat&" in urls[0]
+
+
+def test_startup_time():
+    # Import what the stats server's entry point imports, in a fresh process.
+    # The first time the client code is transpiled, after that it's cached.
+    code = "; ".join(
+        [
+            "import sys, time",
+            "t0 = time.perf_counter()",
+            "import mypaas.stats",
+            "print(time.perf_counter() - t0, 'pscript' in sys.modules)",
+        ]
+    )
+    env = os.environ.copy()
+    env["HOME"] = tempfile.mkdtemp()
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(mypaas.__file__))
+    results = []
+    for i in range(2):
+        p = subprocess.run(
+            [sys.executable, "-c", code],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        t, transpiled = p.stdout.decode().split()
+        results.append((float(t), transpiled == "True"))
+    print(f"stats import: {results[0][0]:0.3f}s cold, {results[1][0]:0.3f}s cached")
+    assert results[1][1] is False  # pscript was not even imported
+
+
+def test_stream_stats():
+    clean_db()
+
+    collector = StatsCollector(db_dir)
+    collector.put("aaa", {"foo|count": 3})
+    publisher = mypaas.stats.server.get_stats_publisher(collector)
+    assert mypaas.stats.server.get_stats_publisher(collector) is publisher
+
+    class StubRequest(asgineer.BaseRequest):
+        def __init__(self, nsends):
+            super().__init__({"type": "http"})
+            self._nsends = nsends
+            self.sent = []
+
+        async def accept(self, status, headers):
+            self.status = status
+            self.headers_sent = headers
+
+        async def send(self, data):
+            self.sent.append(data)
+
+        async def sleep_while_connected(self, seconds):
+            if len(self.sent) >= self._nsends:
+                raise asgineer.DisconnectedError()
+
+    async def stream(request, groups):
+        await mypaas.stats.server.stream_stats(request, collector, groups)
+        publisher._task.cancel()
+
+    request = StubRequest(2)
+    asyncio.new_event_loop().run_until_complete(stream(request, ["aaa", "zzz"]))
+    assert request.status == 200
+    assert request.headers_sent["content-type"] == "text/event-stream"
+
+    # Each message has the quickstats, and the aggr of the known groups
+    assert len(request.sent) == 2
+    events = request.sent[0].decode().strip().split("\n\n")
+    assert len(events) == 2
+    assert events[0].startswith("event: quickstats\ndata: {")
+    assert events[1].startswith("event: aggr\ndata: {")
+    msg = json.loads(events[1].split("data: ", 1)[1])
+    assert msg["group"] == "aaa"
+    assert msg["aggr"]["foo|count"] == 3
+
+    # Disconnecting unsubscribes
+    assert len(publisher._subscribers) == 0
+    assert publisher._group_subscriptions == {}
+    assert publisher.get_messages(["aaa"]).count(b"event:") == 1
+
+
 def test_server():
     clean_db()
 
@@ -461,6 +1273,98 @@ def test_server():
         assert b"bbb" in r.body
         assert b"ccc" in r.body
 
+        # Sparklines are served from memory
+        collector.put("aaa", {"cpu|num|%": 3.14159, "mem|num|iB": 2**21})
+        r = server.request("GET", "/sparklines")
+        assert r.status == 200
+        sparklines = json.loads(r.body.decode())
+        assert list(sparklines.keys()) == ["aaa"]
+        assert [v for v in sparklines["aaa"]["cpu"] if v is not None] == [3.1]
+        assert [v for v in sparklines["aaa"]["mem"] if v is not None] == [2.0]
+
+        # Quickstats are served from a snapshot, with etag
+        collector.put("system", {"cpu|num|%": 42})
+        r = server.request("GET", "/quickstats")
+        assert r.status == 200
+        assert json.loads(r.body.decode())["system-cpu"] == "42.0 %"
+        etag = r.headers["etag"]
+        r = server.request("GET", "/quickstats", headers={"if-none-match": etag})
+        assert r.status == 304
+        assert r.body == b""
+
+        # Memory usage per group
+        r = server.request("GET", "/memory")
+        assert r.status == 200
+        usage = json.loads(r.body.decode())
+        assert set(usage["groups"].keys()) == {"aaa", "bbb", "ccc", "system"}
+        assert usage["total"] == sum(usage["groups"].values())
+
+        # Metrics of the current aggregations
+        r = server.request("GET", "/metrics")
+        assert r.status == 200
+        assert r.headers["content-type"].startswith("application/openmetrics-text")
+        assert 'mypaas_foo_count{group="ccc"} 1' in r.body.decode()
+
+        # The current aggregation is included when showing today
+        r = server.request("GET", "/stats?groups=aaa")
+        assert r.status == 200
+        assert b'var current_per_db = {"aaa": {' in r.body
+        r = server.request("GET", "/stats?groups=aaa&daysago=1")
+        assert b"var current_per_db = {};" in r.body
+
+        # The page only has the keys, the data is loaded per panel
+        r = server.request("GET", "/stats?groups=aaa,nope")
+        assert b'var keys_per_db = {"aaa": ["cpu|num|%", ' in r.body
+        assert b'"nope": []' in r.body
+        r = server.request("GET", "/api/data?group=aaa&key=foo|num&ndays=2")
+        assert r.status == 200
+        data = json.loads(r.body.decode())
+        assert [aggr["time_key"] for aggr in data[:1] + data[-1:]] == ["x", "x"]
+        assert sum(aggr["foo|num"]["n"] for aggr in data[1:-1]) == 1
+        r = server.request("GET", "/api/data?group=aaa&key=foo|num&current=0")
+        assert json.loads(r.body.decode()) == []
+
+        # Also in columnar format, optionally binary
+        url = "/api/data?group=aaa&key=foo|num&format=columns&ndays=1"
+        r = server.request("GET", url)
+        columns = json.loads(r.body.decode())
+        assert columns["n"] == [1]
+        assert columns["resolution"] == 600
+        r = server.request("GET", url + "&max_points=1")
+        assert json.loads(r.body.decode())["resolution"] == 86400
+        r = server.request("GET", url.replace("=columns", "=binary"))
+        assert r.headers["content-type"] == "application/octet-stream"
+        assert decode_binary(r.body) == columns
+        r = server.request("GET", url + "&downsample=lttb")
+        assert json.loads(r.body.decode())["n"] == [1]
+        assert server.request("GET", url + "&downsample=foo").status == 400
+        assert server.request("GET", url + "&max_points=abc").status == 400
+        assert server.request("GET", "/api/data?group=aaa").status == 400
+
+        # Deltas, for clients that update their data
+        url = "/api/delta?groups=aaa,nope&since=,&resolution=600&ndays=1"
+        r = server.request("GET", url)
+        assert r.status == 200
+        delta = json.loads(r.body.decode())
+        assert list(delta.keys()) == ["aaa"]
+        assert sum(aggr.get("foo|num", {}).get("n", 0) for aggr in delta["aaa"]) == 1
+        url = "/api/delta?groups=aaa&since=&resolution=601"
+        assert server.request("GET", url).status == 400
+        url = "/api/delta?groups=aaa,bbb&since=&resolution=600"
+        assert server.request("GET", url).status == 400
+
+        # Summaries of cat keys
+        collector.put("aaa", {"ua|cat": "firefox"})
+        r = server.request("GET", "/api/cat?group=aaa&key=ua|cat&top=5")
+        assert r.status == 200
+        summary = json.loads(r.body.decode())
+        assert summary["top"] == [["firefox", 1]] and summary["other"] == 0
+        assert server.request("GET", "/api/cat?group=aaa&key=foo|num").status == 400
+        r = server.request("GET", "/api/cat?group=aaa&key=ua|cat&top=x")
+        assert r.status == 400
+        assert server.request("GET", "/api/cat?group=x&key=ua|cat").status == 404
+        assert server.request("GET", "/api/data?group=nope&key=a|num").status == 404
+
         # Empty stats redirects
         r = server.request("GET", "/stats")
         assert r.status == 302
@@ -474,6 +1378,53 @@ def test_server():
         assert r.status == 200
         assert b"padding:" in r.body
 
+        # Responses are compressed if the client accepts it
+        headers = {"accept-encoding": "gzip"}
+        r = server.request("GET", "/client.js", headers=headers)
+        assert r.headers["content-encoding"] == "gzip"
+        assert b"on_init" in gzip.decompress(r.body)
+        etag = r.headers["etag"]
+        r = server.request("GET", "/client.js", headers={"if-none-match": etag})
+        assert r.status == 304
+        r = server.request("GET", "/stats?groups=aaa", headers=headers)
+        assert r.headers["content-encoding"] == "gzip"
+        assert b"keys_per_db" in gzip.decompress(r.body)
+
+        # Historic views are cacheable, and the 304 does not need the collector
+        ori_margin = mypaas.stats.server.HISTORIC_MARGIN
+        mypaas.stats.server.HISTORIC_MARGIN = 0  # avoid flakyness around midnight
+        try:
+            r = server.request("GET", "/stats?groups=aaa&daysago=1")
+            assert "etag" not in server.request("GET", "/stats?groups=aaa").headers
+            assert r.headers["cache-control"].endswith(", immutable")
+            assert r.headers["etag"].startswith('W/"')
+            etag = r.headers["etag"]
+            headers = {"if-none-match": etag}
+            r = server.request("GET", "/stats?groups=aaa&daysago=1", headers=headers)
+            assert r.status == 304
+            r = server.request("GET", "/stats?groups=aaa&daysago=2", headers=headers)
+            assert r.status == 200
+            url = "/api/data?group=aaa&key=foo|num&daysago=1&format=binary"
+            etag = server.request("GET", url).headers["etag"]
+            collector._monitors.clear()
+            r = server.request("GET", url, headers={"if-none-match": etag})
+            assert r.status == 304
+        finally:
+            mypaas.stats.server.HISTORIC_MARGIN = ori_margin
+
+        # Live data without the current aggr has an etag that follows the db
+        url = "/api/data?group=aaa&key=foo|num&current=0"
+        etag = server.request("GET", url).headers["etag"]
+        r = server.request("GET", url, headers={"if-none-match": etag})
+        assert r.status == 304
+        assert r.headers["cache-control"] == "no-cache"
+        collector.put("aaa", {"foo|num": 4})
+        collector._monitors["aaa"].flush()
+        r = server.request("GET", url, headers={"if-none-match": etag})
+        assert r.status == 200
+        assert r.headers["etag"] != etag
+        assert "etag" not in server.request("GET", url[:-10]).headers
+
         # Invalid
         assert server.request("PUT", "/").status == 405
         assert server.request("GET", "/no_valid_page").status == 404